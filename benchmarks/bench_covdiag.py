@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+speed of covdiag (O(t*n) shrinkage intensity, optionally without the dense prior),
+against the previous implementation that summed the n*n matrix y.T*y
+
+run from the repository root: python benchmarks/bench_covdiag.py
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from covdiag import covdiag
+
+#%%
+def covdiag_prev(x):
+
+    t,n=np.shape(x)
+    x=x-np.mean(x,axis=0)
+    sample=np.cov(x,rowvar=False,bias=True)
+    prior=np.zeros((n,n))
+    np.fill_diagonal(prior,np.diag(sample))
+    d=1/n*np.linalg.norm(sample-prior,ord='fro')**2
+    y=x**2
+    r2=1/n/t**2*np.sum(np.dot(y.T,y))-1/n/t*np.sum(sample**2)
+    shrinkage=max(0,min(1,r2/d))
+
+    return shrinkage*prior+(1-shrinkage)*sample
+
+def best_of(fun,n=3):
+
+    t=[]
+    for _ in range(n):
+        t0=time.perf_counter()
+        fun()
+        t.append(time.perf_counter()-t0)
+
+    return min(t)
+
+#%%
+if __name__=='__main__':
+
+    ntrls=300
+    rng=np.random.default_rng(0)
+
+    print('features   previous (s)   covdiag (s)   no prior (s)   speed-up   max abs diff')
+    for nfeat in [64,640,3200]:
+        x=rng.standard_normal((ntrls,nfeat))+rng.standard_normal((ntrls,1)) # some shared variance, so that shrinkage<1
+
+        t_prev=best_of(lambda: covdiag_prev(x))
+        t_new=best_of(lambda: covdiag(x))
+        t_sparse=best_of(lambda: covdiag(x,dense_prior=False))
+        err=np.max(np.abs(covdiag_prev(x)-covdiag(x,dense_prior=False)))
+
+        print('%8d   %12.4f   %11.4f   %12.4f   %7.1fx   %.1e' % (nfeat,t_prev,t_new,t_sparse,t_prev/t_sparse,err))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+latency of scoring single new trials with the fitted decoders (ThetaDecoder, NominalDecoder),
+against calling dist_theta/dist_nominal on each new trial (which re-estimates means and covariances)
+
+run from the repository root: python benchmarks/bench_online.py
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mahal_decoders import ThetaDecoder,NominalDecoder,dist_theta,dist_nominal
+
+#%%
+def latencies(fun,n=200):
+
+    t=[]
+    for i in range(n):
+        t0=time.perf_counter()
+        fun(i)
+        t.append(time.perf_counter()-t0)
+
+    return 1000*np.array(t) # ms
+
+#%%
+if __name__=='__main__':
+
+    ntrls,ntps=400,100
+    rng=np.random.default_rng(0)
+
+    print('channels   decoder    fit (s)   median (ms)   95th pct (ms)   function, 8 trials (ms)')
+    for nchans in [32,64,128]:
+        theta=rng.uniform(-np.pi,np.pi,ntrls)
+        conditions=np.arange(ntrls)%4
+        X=rng.standard_normal((ntrls,nchans,ntps))+np.cos(theta)[:,None,None]*rng.standard_normal((1,nchans,1))
+        X_new=rng.standard_normal((200,nchans,ntps))
+
+        for name,dec,labels,fun in [('theta',ThetaDecoder(),theta,dist_theta),('nominal',NominalDecoder(),conditions,dist_nominal)]:
+            t0=time.perf_counter()
+            dec.fit(X,labels)
+            t_fit=time.perf_counter()-t0
+
+            t=latencies(lambda i: dec.transform(X_new[i:i+1],labels[i:i+1]))
+            # (batches of 8 new trials, with all conditions, which dist_nominal needs)
+            t_fun=latencies(lambda i: fun(X_new[i:i+8],labels[i:i+8],X,labels,n_reps=1,balanced_train_bins=False,verbose=False),n=5)
+
+            print('%8d   %-7s   %8.3f   %11.3f   %13.3f   %23.1f' % (nchans,name,t_fit,np.median(t),np.percentile(t,95),np.median(t_fun)))
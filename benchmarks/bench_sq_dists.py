@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+speed of the stacked |a|^2+|b|^2-2ab distance kernel (fold_utils.sq_dists),
+against a loop over time points with scipy's cdist, as used before in the decoders
+
+run from the repository root: python benchmarks/bench_sq_dists.py
+"""
+import os
+import sys
+import time
+import numpy as np
+from scipy.spatial import distance
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fold_utils import sq_dists
+
+#%%
+def best_of(fun,n=3):
+
+    t=[]
+    for _ in range(n):
+        t0=time.perf_counter()
+        fun()
+        t.append(time.perf_counter()-t0)
+
+    return min(t)
+
+def cdist_loop(m,X):
+
+    dists=np.empty((m.shape[0],m.shape[1],X.shape[1]))
+    for tp in range(m.shape[0]):
+        dists[tp]=distance.cdist(m[tp],X[tp],'euclidean')
+
+    return dists
+
+#%%
+if __name__=='__main__':
+
+    nclasses,ntrls,ntps=16,100,20
+    rng=np.random.default_rng(0)
+
+    print('features   cdist (s)   sq_dists (s)   speed-up   max abs diff')
+    for nfeat in [64,640,6400]:
+        m=rng.standard_normal((ntps,nclasses,nfeat))
+        X=rng.standard_normal((ntps,ntrls,nfeat))
+
+        t_cdist=best_of(lambda: cdist_loop(m,X))
+        t_gemm=best_of(lambda: np.sqrt(sq_dists(m,X)))
+        err=np.max(np.abs(cdist_loop(m,X)-np.sqrt(sq_dists(m,X))))
+
+        print('%8d   %9.4f   %12.4f   %8.1fx   %.1e' % (nfeat,t_cdist,t_gemm,t_cdist/t_gemm,err))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark suite of the decoders, RSA, data formatting and cluster test, on synthetic EEG data with known effects
+
+times dist_theta_kfold, dist_theta_kfold_ct, dist_nominal_kfold, mahal_CV_RSA, dat_prep_4d_time_course and cluster_test
+over a grid of (trials, channels, time points, folds, reps), and writes the wall time and peak RSS of each case to JSON,
+each case runs in a fresh process (so peak RSS is that of the case), with fixed seeds, so results of different commits are comparable
+
+run from the repository root:
+    python benchmarks/bench_suite.py --out bench.json                      (default grid)
+    python benchmarks/bench_suite.py --grid small --out bench.json         (quick check)
+    python benchmarks/bench_suite.py --out new.json --compare old.json     (ratios to the results of another commit)
+"""
+import os
+import sys
+import io
+import json
+import inspect
+import time
+import platform
+import argparse
+import resource
+import itertools
+import subprocess
+import contextlib
+import multiprocessing
+import numpy as np
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+
+GRIDS={'small':dict(ntrls=[200],nchans=[32],ntps=[60],n_folds=[8],n_reps=[2]),
+       'default':dict(ntrls=[200,400],nchans=[32,64],ntps=[60,120],n_folds=[8],n_reps=[2,5])}
+
+FUNCTIONS=['dist_theta_kfold','dist_theta_kfold_ct','dist_nominal_kfold','mahal_CV_RSA','dat_prep_4d_time_course','cluster_test']
+
+#%% synthetic data
+def synthetic_eeg(ntrls,nchans,ntps,hz=500,effect=(.3,.6),snr=.5,seed=0):
+
+    '''
+    trial by channel by time data with a known orientation (and condition) effect
+
+    noise is correlated across channels (random mixing) and smooth in time (autoregressive), the effect is a cosine/sine
+    tuning of random channel patterns to the orientation theta, and a channel pattern per condition,
+    within the effect window (in s, time 0 is the first time point after a 0.1 s baseline)
+
+    returns X (trials*channels*time), theta (trials, 16 orientations), conditions (trials, 4 conditions), time_dat (s)
+    '''
+
+    rng=np.random.default_rng(seed)
+
+    time_dat=np.arange(ntps)/hz-.1
+    theta=rng.choice(np.arange(-np.pi,np.pi,np.pi/8),ntrls)
+    conditions=rng.integers(0,4,ntrls)
+
+    noise=rng.standard_normal((ntrls,nchans,ntps))
+    for tp in range(1,ntps):
+        noise[:,:,tp]=.9*noise[:,:,tp-1]+np.sqrt(1-.9**2)*noise[:,:,tp]
+    mixing=rng.standard_normal((nchans,nchans))/np.sqrt(nchans)
+    X=np.einsum('ij,tjk->tik',mixing,noise)
+
+    window=(time_dat>=effect[0])&(time_dat<effect[1])
+    patterns=rng.standard_normal((2,nchans))
+    cond_patterns=rng.standard_normal((4,nchans))
+    signal=np.cos(theta)[:,None]*patterns[0]+np.sin(theta)[:,None]*patterns[1]+cond_patterns[conditions]
+    X[:,:,window]+=snr*signal[:,:,None]
+
+    return X,theta,conditions,time_dat
+
+#%% cases
+def bind(fun,*args,**kwargs):
+
+    # fun with args and the kwargs it accepts, so that older commits (e.g. without seed or verbose) can be run as well
+
+    params=inspect.signature(fun).parameters
+    if not any(p.kind==p.VAR_KEYWORD for p in params.values()):
+        kwargs={k:v for k,v in kwargs.items() if k in params}
+
+    return lambda: fun(*args,**kwargs)
+
+def run_case(name,ntrls,nchans,ntps,n_folds,n_reps):
+
+    # runs one case (in a fresh process), returns wall time (s) and peak RSS (MB) of the process
+
+    from mahal_decoders import dist_theta_kfold,dist_theta_kfold_ct,dist_nominal_kfold
+    from cv_rsa import mahal_CV_RSA
+    from dat_4d_formatting import dat_prep_4d_time_course
+    from util_funcs import cluster_test
+
+    X,theta,conditions,time_dat=synthetic_eeg(ntrls,nchans,ntps)
+
+    if name=='dist_theta_kfold':
+        fun=bind(dist_theta_kfold,X,theta,n_folds=n_folds,n_reps=n_reps,verbose=False,seed=0)
+    elif name=='dist_theta_kfold_ct':
+        fun=bind(dist_theta_kfold_ct,X,theta,n_folds=n_folds,n_reps=n_reps,verbose=False,seed=0)
+    elif name=='dist_nominal_kfold':
+        fun=bind(dist_nominal_kfold,X,conditions,n_folds=n_folds,n_reps=n_reps,verbose=False,seed=0)
+    elif name=='mahal_CV_RSA':
+        fun=bind(mahal_CV_RSA,X,conditions[:,None],n_folds=n_folds,n_reps=n_reps,verbose=False,seed=0)
+    elif name=='dat_prep_4d_time_course':
+        fun=bind(dat_prep_4d_time_course,X,time_dat,[time_dat[50],time_dat[-1]],window_length=100,span=10,steps=4)
+    elif name=='cluster_test':
+        # cross-temporal observed data, and a null distribution of 100 permutations
+        rng=np.random.default_rng(0)
+        datrnd=rng.standard_normal((ntps,ntps,100))
+        datobs=rng.standard_normal((ntps,ntps))
+        datobs[ntps//2:,ntps//2:]+=2
+        fun=bind(cluster_test,datobs,datrnd)
+
+    with contextlib.redirect_stderr(io.StringIO()): # progress bars
+        t0=time.perf_counter()
+        fun()
+        wall=time.perf_counter()-t0
+
+    # ru_maxrss is in kB on linux, in bytes on macOS
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/(2**20 if sys.platform=='darwin' else 2**10)
+
+    return wall,peak
+
+def run_isolated(case,repeat=1):
+
+    # best wall time of repeat runs, each in a fresh process, and the largest peak RSS
+
+    walls,peaks=[],[]
+    ctx=multiprocessing.get_context('spawn')
+    for _ in range(repeat):
+        with ctx.Pool(1) as pool:
+            wall,peak=pool.apply(run_case,case)
+        walls.append(wall)
+        peaks.append(peak)
+
+    return min(walls),max(peaks)
+
+def git_commit():
+
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],cwd=ROOT,capture_output=True,text=True).stdout.strip()
+    except OSError:
+        return None
+
+#%%
+if __name__=='__main__':
+
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--grid',default='default',choices=sorted(GRIDS))
+    parser.add_argument('--functions',nargs='+',default=FUNCTIONS,choices=FUNCTIONS)
+    parser.add_argument('--repeat',type=int,default=1,help='runs per case, the best wall time is recorded')
+    parser.add_argument('--out',default='bench.json')
+    parser.add_argument('--compare',default=None,help='JSON of another commit, prints time and memory ratios (new/old)')
+    args=parser.parse_args()
+
+    grid=GRIDS[args.grid]
+    keys=['ntrls','nchans','ntps','n_folds','n_reps']
+    old={}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old={(r['function'],)+tuple(r[k] for k in keys):r for r in json.load(f)['results']}
+
+    results=[]
+    print('function                    trials  chans    tps  folds   reps   time (s)   peak (MB)'+('   time ratio   peak ratio' if old else ''))
+    for name in args.functions:
+        for params in itertools.product(*[grid[k] for k in keys]):
+            wall,peak=run_isolated((name,)+params,repeat=args.repeat)
+            results.append(dict(function=name,**dict(zip(keys,params)),wall_time=wall,peak_rss_mb=peak))
+
+            line='%-26s %7d %6d %6d %6d %6d %10.3f %11.1f' % ((name,)+params+(wall,peak))
+            if (name,)+params in old:
+                prev=old[(name,)+params]
+                line+='   %10.2f   %10.2f' % (wall/prev['wall_time'],peak/prev['peak_rss_mb'])
+            print(line)
+
+    meta=dict(commit=git_commit(),grid=args.grid,repeat=args.repeat,python=platform.python_version(),numpy=np.__version__,
+              machine=platform.machine(),processor=platform.processor(),cpus=os.cpu_count(),date=time.strftime('%Y-%m-%d %H:%M:%S'))
+    with open(args.out,'w') as f:
+        json.dump(dict(meta=meta,results=results),f,indent=1)
+    print('written to',args.out)
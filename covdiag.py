@@ -1,7 +1,7 @@
 
 import numpy as np
 
-def covdiag(x):
+def covdiag(x,dense_prior=True):
     
     '''
     x (t*n): t iid observations on n random variables
@@ -9,6 +9,9 @@ def covdiag(x):
     
     Shrinks towards diagonal matrix
     as described in Ledoit and Wolf, 2004
+    
+    dense_prior = True/False (default True), whether the n*n prior (diagonal) matrix is built,
+                  False sets the diagonal of the estimator directly (same estimate, less memory)
     '''
     
     t,n=np.shape(x)
@@ -19,17 +22,272 @@ def covdiag(x):
     #get sample covariance matrix
     sample=np.cov(x,rowvar=False,bias=True)
     
-    #compute prior
-    prior=np.zeros((n,n))
-    np.fill_diagonal(prior,np.diag(sample))
+    sample_var=np.diag(sample)
+    sample_ss=np.vdot(sample,sample)
     
-    #compute shrinkage parameters
-    d=1/n*np.linalg.norm(sample-prior,ord='fro')**2
+    #compute shrinkage parameters, without n*n intermediates
+    #(the squared off-diagonal norm, and the sum of y.T*y as the squared row sums of y)
+    d=1/n*(sample_ss-np.sum(sample_var**2))
     y=x**2
-    r2=1/n/t**2*np.sum(np.dot(y.T,y))-1/n/t*np.sum(sample**2)
+    r2=1/n/t**2*np.sum(np.sum(y,axis=1)**2)-1/n/t*sample_ss
     
     #compute the estimator
     shrinkage=max(0,min(1,r2/d))
-    sigma=shrinkage*prior+(1-shrinkage)*sample
+    if dense_prior:
+        prior=np.zeros((n,n))
+        np.fill_diagonal(prior,sample_var)
+        sigma=shrinkage*prior+(1-shrinkage)*sample
+    else:
+        sigma=(1-shrinkage)*sample
+        np.fill_diagonal(sigma,sample_var)
     
     return sigma
+
+def covdiag_batched(x,time_axis=-1):
+    
+    '''
+    x (t*n*T, or T*t*n if time_axis=0): t iid observations on n random variables, at T time points
+    sigma (T*n*n): covdiag estimator of each time point
+    shrinkage (T): shrinkage intensity of each time point
+    
+    Same estimator as covdiag, for all time points in one vectorized pass
+    '''
+    
+    # time points become the leading (batch) dimension (contiguous for fast stacked matmul)
+    x=np.ascontiguousarray(np.moveaxis(np.asarray(x),time_axis,0))
+    
+    T,t,n=np.shape(x)
+    
+    # de-mean
+    x=x-np.mean(x,axis=1,keepdims=True)
+    
+    #get sample covariance matrices, and their diagonals (the priors)
+    sample=np.matmul(np.swapaxes(x,1,2),x)/t
+    sample_var=np.diagonal(sample,axis1=1,axis2=2)
+    sample_ss=np.einsum('tij,tij->t',sample,sample)
+    
+    #compute shrinkage parameters
+    d=1/n*(sample_ss-np.sum(sample_var**2,axis=1))
+    y=x**2
+    r2=1/n/t**2*np.sum(np.sum(y,axis=2)**2,axis=1)-1/n/t*sample_ss
+    with np.errstate(divide='ignore',invalid='ignore'):
+        shrinkage=np.clip(r2/d,0,1)
+    shrinkage[np.isnan(shrinkage)]=1 # same as max(0,min(1,nan)) in covdiag
+    
+    #compute the estimators
+    sigma=(1-shrinkage)[:,None,None]*sample
+    sigma[:,np.arange(n),np.arange(n)]=sample_var
+    
+    return sigma,shrinkage
+
+def covdiag_inv_factors(x,time_axis=-1):
+    
+    '''
+    x (t*n*T, or T*t*n if time_axis=0): t iid observations on n random variables, at T time points
+    dinv (T*n), R (T*n*t): inverse of the covdiag estimator of each time point, in factored form inv(sigma)=diag(dinv)-R*R.T
+    shrinkage (T): shrinkage intensity of each time point
+    
+    The covdiag estimator is a diagonal matrix plus a rank-t update, sigma=diag(shrinkage*var)+(1-shrinkage)/t*x.T*x,
+    so its inverse follows from a t*t system (Woodbury identity), without forming any n*n matrix (useful if n>t)
+    Requires shrinkage>0, dinv is inf otherwise
+    '''
+    
+    # time points become the leading (batch) dimension (contiguous for fast stacked matmul)
+    x=np.ascontiguousarray(np.moveaxis(np.asarray(x),time_axis,0))
+    
+    T,t,n=np.shape(x)
+    
+    # de-mean
+    x=x-np.mean(x,axis=1,keepdims=True)
+    
+    #sample variances, and the sum of squares of the sample covariance (from the t*t gram matrix)
+    y=x**2
+    sample_var=np.sum(y,axis=1)/t
+    gram=np.matmul(x,np.swapaxes(x,1,2))
+    sample_ss=np.einsum('tij,tij->t',gram,gram)/t**2
+    
+    #compute shrinkage parameters, same as covdiag
+    d=1/n*(sample_ss-np.sum(sample_var**2,axis=1))
+    r2=1/n/t**2*np.sum(np.sum(y,axis=2)**2,axis=1)-1/n/t*sample_ss
+    with np.errstate(divide='ignore',invalid='ignore'):
+        shrinkage=np.clip(r2/d,0,1)
+    shrinkage[np.isnan(shrinkage)]=1 # same as max(0,min(1,nan)) in covdiag
+    
+    #Woodbury, with D=diag(shrinkage*var) and B=sqrt((1-shrinkage)/t)*x.T:
+    #inv(sigma)=inv(D)-inv(D)*B*inv(L*L.T)*B.T*inv(D), with L*L.T=I+B.T*inv(D)*B, so R.T=inv(L)*B.T*inv(D)
+    with np.errstate(divide='ignore'):
+        dinv=1/(shrinkage[:,None]*sample_var)
+    scale=np.sqrt((1-shrinkage)/t)[:,None,None]
+    Bt_dinv=scale*x*np.where(np.isfinite(dinv),dinv,0)[:,None,:]
+    L=np.linalg.cholesky(np.eye(t,dtype=x.dtype)+np.matmul(Bt_dinv,scale*np.swapaxes(x,1,2)))
+    R=np.swapaxes(np.linalg.solve(L,Bt_dinv),1,2)
+    
+    return dinv,R,shrinkage
+
+def covdiag_scatter(x):
+    
+    '''
+    x (t*n*T): all t observations on n random variables, at T time points
+    scatter: dict with the full-data sums used by covdiag_downdate (all with time points along the first axis),
+             of the data centered on the full-data mean (for numerical stability):
+             center (T*n), S1 (T*n), S2 (T*n*n) scatter matrices and q (T*t) squared norms of the observations
+    '''
+    
+    center=np.mean(x,axis=0).T
+    xc=np.ascontiguousarray(np.moveaxis(x,-1,0))-center[:,None,:]
+    
+    return dict(center=center,S1=np.sum(xc,axis=1),S2=np.matmul(np.swapaxes(xc,1,2),xc),q=np.sum(xc**2,axis=2))
+    
+def covdiag_downdate(x,scatter,out_index):
+    
+    '''
+    x (t*n*T): all observations, as passed to covdiag_scatter
+    scatter: output of covdiag_scatter (or the same time points of it)
+    out_index: observations to leave out, e.g. the test trials of a fold
+    sigma (T*n*n), shrinkage (T): same as covdiag_batched of the remaining observations
+    
+    The sums of the remaining observations are the full-data sums minus those of the left-out observations,
+    so only the left-out observations enter an n*n product (the shrinkage needs O(t*n) per time point)
+    '''
+    
+    center,S1,S2,q=scatter['center'],scatter['S1'],scatter['S2'],scatter['q']
+    
+    keep=np.ones(x.shape[0],dtype=bool)
+    keep[out_index]=False
+    t=np.sum(keep)
+    n=x.shape[1]
+    
+    #subtract the sums of the left-out observations
+    x_out=np.ascontiguousarray(np.moveaxis(x[out_index],-1,0))-center[:,None,:]
+    mu=(S1-np.sum(x_out,axis=1))/t
+    sample=(S2-np.matmul(np.swapaxes(x_out,1,2),x_out))/t-mu[:,:,None]*mu[:,None,:]
+    sample_var=np.diagonal(sample,axis1=1,axis2=2)
+    sample_ss=np.einsum('tij,tij->t',sample,sample)
+    
+    #squared norms of the de-meaned remaining observations, |x-mu|^2=|x|^2-2*x*mu+|mu|^2 (x centered on center)
+    xmu=np.einsum('knT,Tn->Tk',x[keep],mu)-np.sum(center*mu,axis=1)[:,None]
+    a=q[:,keep]-2*xmu+np.sum(mu**2,axis=1)[:,None]
+    
+    #compute shrinkage parameters, same as covdiag
+    d=1/n*(sample_ss-np.sum(sample_var**2,axis=1))
+    r2=1/n/t**2*np.sum(a**2,axis=1)-1/n/t*sample_ss
+    with np.errstate(divide='ignore',invalid='ignore'):
+        shrinkage=np.clip(r2/d,0,1)
+    shrinkage[np.isnan(shrinkage)]=1 # same as max(0,min(1,nan)) in covdiag
+    
+    #compute the estimators
+    sigma=(1-shrinkage)[:,None,None]*sample
+    sigma[:,np.arange(n),np.arange(n)]=sample_var
+    
+    return sigma,shrinkage
+
+class CovdiagStream:
+    
+    '''
+    incremental covdiag estimator, for observations that arrive in chunks (e.g. trials read from disk, or online),
+    or that are split over workers: each chunk only updates running sums, partial estimators can be merged,
+    and the estimate is the same as covdiag (covdiag_batched) of all observations
+    
+    running sums of the observations x (centered on a fixed center, for numerical stability), at each time point:
+    t, S1=sum(x), S2=sum(x*x.T), and for the shrinkage intensity, with q=|x|^2: Q1=sum(q), Q2=sum(q^2), Qx=sum(q*x)
+    
+    est=CovdiagStream()
+    est.update(x) # x (t*n*T, or t*n): a chunk of observations, as often as needed
+    est.merge(other) # adds the observations of another estimator (e.g. of another worker)
+    sigma,shrinkage=est.estimate() # T*n*n and T (n*n and scalar for t*n chunks)
+    '''
+    
+    def __init__(self):
+        
+        self.t=0
+        self.center=None
+    
+    def update(self,x):
+        
+        # adds a chunk of observations x (t*n*T, or t*n)
+        
+        x=np.asarray(x)
+        self.single=x.ndim==2
+        if self.single:
+            x=x[:,:,None]
+        
+        if self.center is None: # center on the mean of the first chunk
+            self.center=np.mean(x,axis=0).T
+            T,n=self.center.shape
+            self.S1,self.S2=np.zeros((T,n)),np.zeros((T,n,n))
+            self.Q1,self.Q2,self.Qx=np.zeros(T),np.zeros(T),np.zeros((T,n))
+        
+        xc=np.ascontiguousarray(np.moveaxis(x,-1,0))-self.center[:,None,:]
+        q=np.sum(xc**2,axis=2)
+        
+        self.t+=x.shape[0]
+        self.S1+=np.sum(xc,axis=1)
+        self.S2+=np.matmul(np.swapaxes(xc,1,2),xc)
+        self.Q1+=np.sum(q,axis=1)
+        self.Q2+=np.sum(q**2,axis=1)
+        self.Qx+=np.einsum('Tk,Tkn->Tn',q,xc)
+        
+        return self
+    
+    def merge(self,other):
+        
+        '''
+        adds the observations of another CovdiagStream, whose sums are shifted to the center of this one
+        (x+delta, with delta the difference of the centers)
+        '''
+        
+        if other.t==0:
+            return self
+        if self.t==0:
+            self.__dict__.update({k:np.copy(v) if isinstance(v,np.ndarray) else v for k,v in other.__dict__.items()})
+            return self
+        
+        t,S1,S2,Q1,Q2,Qx=other.t,other.S1,other.S2,other.Q1,other.Q2,other.Qx
+        delta=other.center-self.center
+        e=np.sum(delta**2,axis=1)
+        S1_delta=np.sum(S1*delta,axis=1)
+        S2_delta=np.einsum('Tij,Tj->Ti',S2,delta)
+        
+        self.t+=t
+        self.Q2+=Q2+4*np.sum(delta*S2_delta,axis=1)+t*e**2+4*np.sum(Qx*delta,axis=1)+2*e*Q1+4*e*S1_delta
+        self.Qx+=Qx+Q1[:,None]*delta+2*S2_delta+2*S1_delta[:,None]*delta+e[:,None]*S1+t*e[:,None]*delta
+        self.Q1+=Q1+2*S1_delta+t*e
+        self.S2+=S2+S1[:,:,None]*delta[:,None,:]+delta[:,:,None]*S1[:,None,:]+t*delta[:,:,None]*delta[:,None,:]
+        self.S1+=S1+t*delta
+        
+        return self
+    
+    def estimate(self):
+        
+        '''
+        sigma (T*n*n), shrinkage (T): covdiag estimator of all observations so far
+        (n*n and scalar if the chunks were t*n)
+        '''
+        
+        t=self.t
+        n=self.S1.shape[1]
+        
+        #sample covariance matrices, with mu the mean relative to the center
+        mu=self.S1/t
+        sample=self.S2/t-mu[:,:,None]*mu[:,None,:]
+        sample_var=np.diagonal(sample,axis1=1,axis2=2)
+        sample_ss=np.einsum('tij,tij->t',sample,sample)
+        
+        #sum of the squared |x-mu|^2 of all observations, from the running sums
+        m=np.sum(mu**2,axis=1)
+        a2=self.Q2-4*np.sum(mu*self.Qx,axis=1)+4*np.einsum('Ti,Tij,Tj->T',mu,self.S2,mu)+2*m*self.Q1-4*m*np.sum(mu*self.S1,axis=1)+t*m**2
+        
+        #compute shrinkage parameters, same as covdiag
+        d=1/n*(sample_ss-np.sum(sample_var**2,axis=1))
+        r2=1/n/t**2*a2-1/n/t*sample_ss
+        with np.errstate(divide='ignore',invalid='ignore'):
+            shrinkage=np.clip(r2/d,0,1)
+        shrinkage[np.isnan(shrinkage)]=1 # same as max(0,min(1,nan)) in covdiag
+        
+        #compute the estimators
+        sigma=(1-shrinkage)[:,None,None]*sample
+        sigma[:,np.arange(n),np.arange(n)]=sample_var
+        
+        if self.single:
+            return sigma[0],shrinkage[0]
+        return sigma,shrinkage
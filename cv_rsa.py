@@ -8,16 +8,16 @@ cross-validated RSA using mahalanobis distance
 """
 # import os
 # os.environ["OPENBLAS_NUM_THREADS"] = '1'
-from sklearn.model_selection import RepeatedStratifiedKFold,RepeatedKFold
+from sklearn.model_selection import RepeatedKFold
 from scipy.stats import zscore
 import numpy as np
-import random
 from numpy.linalg import pinv,inv
-from progress.bar import ChargingBar
-from scipy.stats import pearsonr,spearmanr 
+from scipy.stats import rankdata
 import pandas as pd
+from covdiag import covdiag_batched,covdiag_inv_factors,CovdiagStream
+from fold_utils import resolve_seed,run_units,open_out,time_blocks,fold_prep,FoldPlan,stage,profiled,Progress
 #%% covariance with shrinkage estimator
-def covdiag(x):
+def covdiag(x,dense_prior=True):
     
     '''
     x (t*n): t iid observations on n random variables
@@ -25,6 +25,9 @@ def covdiag(x):
     
     Shrinks towards diagonal matrix
     as described in Ledoit and Wolf, 2004
+    
+    dense_prior = True/False (default True), whether the n*n prior (diagonal) matrix is built,
+                  False sets the diagonal of the estimator directly (same estimate, less memory)
     '''
     
     t,n=np.shape(x)
@@ -35,23 +38,257 @@ def covdiag(x):
     #get sample covariance matrix
     sample=np.cov(x,rowvar=False,bias=True)
     
-    #compute prior
-    prior=np.zeros((n,n))
-    np.fill_diagonal(prior,np.diag(sample))
+    sample_var=np.diag(sample)
+    sample_ss=np.vdot(sample,sample)
     
-    #compute shrinkage parameters
-    d=1/n*np.linalg.norm(sample-prior,ord='fro')**2
+    #compute shrinkage parameters, without n*n intermediates
+    #(the squared off-diagonal norm, and the sum of y.T*y as the squared row sums of y)
+    d=1/n*(sample_ss-np.sum(sample_var**2))
     y=x**2
-    r2=1/n/t**2*np.sum(np.dot(y.T,y))-1/n/t*np.sum(sample**2)
+    r2=1/n/t**2*np.sum(np.sum(y,axis=1)**2)-1/n/t*sample_ss
     
     #compute the estimator
     shrinkage=max(0,min(1,r2/d))
-    sigma=shrinkage*prior+(1-shrinkage)*sample
+    if dense_prior:
+        prior=np.zeros((n,n))
+        np.fill_diagonal(prior,sample_var)
+        sigma=shrinkage*prior+(1-shrinkage)*sample
+    else:
+        sigma=(1-shrinkage)*sample
+        np.fill_diagonal(sigma,sample_var)
     
     return sigma
+#%% one train/test split of the cross-validated RSA functions
+def _balanced_index(shared,units,fold_plan):
+
+    '''
+    balanced training and test trials of all units, taken from fold_plan (see FoldPlan)
+    returns dict {(0,)+key: training trials, (1,)+key: test trials}, each n_conds*count_min
+    '''
+
+    index={}
+    for unit in units: # blocks of time points share the key, and thus the trials
+        key=unit[2]
+        if shared['balanced_train_dat']:
+            index[(0,)+key]=fold_plan.balanced(0,*key)
+        if shared['balanced_test_dat']:
+            index[(1,)+key]=fold_plan.balanced(0,*key,test=True)
+
+    return index
+
+def _data_trials(shared,train_index,test_index,key):
+
+    '''
+    trials of the data used for the training and test trials of a split,
+    for a null RDM (null_decoding, shared['null_seed']), the trials are randomly permuted within the training and within
+    the test trials of each split (fixed by the seed and the key), so the class counts, and the balanced trials, of the split
+    are those of the actual conditions
+    '''
+
+    if shared['null_seed'] is None:
+        return train_index,test_index
+
+    rng=np.random.default_rng(np.random.SeedSequence(shared['null_seed'],spawn_key=(4,)+tuple(int(k) for k in key)))
+
+    return rng.permutation(train_index),rng.permutation(test_index)
+
+def _cv_dists(a,b):
+
+    '''
+    a (...*n_conds*n): (whitened) training class means, e.g. time*conditions*channels
+    b (...*n_conds*n): test class means
+
+    returns the cross-validated distances (...*n_conds*n_conds) of all condition pairs, (a_i-a_j)*(b_i-b_j).T,
+    from the single stacked product G=a*b.T, as G_ii+G_jj-G_ij-G_ji (symmetric)
+    '''
+
+    G=np.matmul(a,np.swapaxes(b,-1,-2))
+    d=np.diagonal(G,axis1=-2,axis2=-1)
+
+    return d[...,:,None]+d[...,None,:]-G-np.swapaxes(G,-1,-2)
+
+def _cv_dists_ct(a,b):
+
+    '''
+    a (T_trn*n_conds*n): whitened training class means of a block of training time points
+    b (T_tst*n_conds*n): test class means
+
+    returns the cross-validated distances (n_conds*n_conds*T_trn*T_tst) of all condition pairs and all pairs of time points,
+    as _cv_dists, with G of all time points from a single (T_trn*n_conds)*(T_tst*n_conds) matrix product
+    '''
+
+    ntps_trn,n_conds,nchans=a.shape
+    G=np.dot(a.reshape(-1,nchans),b.reshape(-1,nchans).T).reshape(ntps_trn,n_conds,b.shape[0],n_conds)
+    d=np.einsum('aibi->iab',G) # G_ii of each pair of time points
+
+    return d[:,None]+d[None,:]-G.transpose(1,3,0,2)-G.transpose(3,1,0,2)
+
+def _corr_pairs(a,b,rank=False):
+
+    '''
+    a (T*n_conds*n): training class means, b (T*n_conds*n): test class means
+
+    returns the pearson (or spearman, if rank) correlations (n_conds*n_conds*T) between the patterns of all condition pairs,
+    RDM[j,i]=corr(a_i,b_j), ranked along the channels once (ties get their average rank, as spearmanr),
+    and correlated with a single stacked product of the normalized patterns
+    '''
+
+    if rank:
+        a,b=rankdata(a,axis=-1),rankdata(b,axis=-1)
+
+    with np.errstate(invalid='ignore',divide='ignore'): # constant patterns are nan, as with pearsonr/spearmanr
+        a=a-np.mean(a,axis=-1,keepdims=True)
+        a/=np.linalg.norm(a,axis=-1,keepdims=True)
+        b=b-np.mean(b,axis=-1,keepdims=True)
+        b/=np.linalg.norm(b,axis=-1,keepdims=True)
+
+    return np.matmul(b,np.swapaxes(a,-1,-2)).transpose(1,2,0)
+
+def _pooled_precision(dat_cov,cov_float64=True):
+
+    '''
+    dat_cov (t*n*T): training data used for the covariance
+
+    returns the inverse (n*n) of the covdiag estimate of the covariance pooled over all time points
+    (each time point centered across trials), accumulated per block of time points (see covdiag.CovdiagStream)
+    and inverted from a single eigen-decomposition
+    '''
+
+    t,n,ntps=np.shape(dat_cov)
+
+    est=CovdiagStream()
+    for tps in time_blocks(ntps,8*t*n):
+        x=dat_cov[:,:,tps]
+        x=np.moveaxis(x-np.mean(x,axis=0),-1,0).reshape(-1,n) # (time points*trials)*n
+        est.update(x.astype(np.float64) if cov_float64 else x)
+    sigma,_=est.estimate()
+
+    evals,evecs=np.linalg.eigh(sigma)
+    evals=evals.clip(1e-10) # same as the whitening of the decoders
+
+    return np.matmul(evecs/evals,evecs.T)
+
+def _precision_unit(shared,train_index,test_index,key):
+
+    '''
+    returns the pooled inverse covariance (n*n, see _pooled_precision) of the (balanced) training trials of the split,
+    computed once per split and shared by all its blocks of training time points (mahalanobis_ct, cov_tp=False)
+    '''
+
+    _,train_dat_cov,train_dat_res_cov=fold_prep(shared['data_trn'][_data_trials(shared,train_index,test_index,key)[0],:,:],shared['conds_id'][train_index],len(shared['u_conds']),
+                                              shared['index'].get((0,)+key),balanced_cov=shared['balanced_cov'],residual_cov=shared['residual_cov'])
+    if shared['residual_cov']:
+        train_dat_cov=train_dat_res_cov
+
+    with stage('covdiag'):
+        return _pooled_precision(train_dat_cov,cov_float64=shared['cov_float64'])
+
+def _rsa_unit(shared,train_index,test_index,key,tps=None):
+
+    '''
+    shared      = dict with data, data_trn, conds_id and the settings of the RSA function
+    key         = (irep,ifold), used to look up the balanced trials of the split (shared['index'])
+    tps         = block (slice) of training time points (None: all), 'mahalanobis_ct' only,
+                  only the pairs of time points within shared['band'] (train time*test time, None: all) are computed,
+                  with cov_tp=False, the inverse covariance of the split is taken from shared['precision'] (see _precision_unit)
+
+    returns the RDM of the split, n_conds*n_conds*time (n_conds*n_conds*train time*test time if metric is 'mahalanobis_ct')
+    '''
+
+    data=shared['data']
+    conds_id=shared['conds_id']
+    u_conds=shared['u_conds']
+    metric=shared['metric']
+    n_conds=len(u_conds)
+    _, nchans, ntps=np.shape(data)
+
+    train_data,test_data=_data_trials(shared,train_index,test_index,key)
+    X_train, X_test = shared['data_trn'][train_data,:,:], data[test_data,:,:]
+    y_train, y_test = conds_id[train_index], conds_id[test_index]
+    pooled=metric in ('mahalanobis','mahalanobis_ct') and shared['cov_metric'] and not shared['cov_tp']
+
+    offset=0
+    if tps is not None: # same key for all blocks, so the balanced trials are identical across blocks
+        X_train=X_train[:,:,tps]
+        offset=tps.start
+
+    # class means of the (balanced) training and test trials, and the (balanced) training data used for the covariance
+    m_trn,train_dat_cov,train_dat_res_cov=fold_prep(X_train,y_train,n_conds,shared['index'].get((0,)+key),
+                                                    balanced_cov=shared['balanced_cov'],residual_cov=shared['residual_cov'])
+    if shared['residual_cov']:
+        train_dat_cov=train_dat_res_cov
+    m_tst,_,_=fold_prep(X_test,y_test,n_conds,shared['index'].get((1,)+key))
+
+    if pooled: # one inverse covariance of all (training) time points
+        if tps is None:
+            with stage('covdiag'):
+                sigma_inv=_pooled_precision(train_dat_cov,cov_float64=shared['cov_float64'])
+        else: # a block of training time points, the inverse of the split was computed before the blocks
+            sigma_inv=shared['precision'][key]
+    ntps_trn=m_trn.shape[2]
+
+    if metric=='mahalanobis_ct':
+        RDM=np.zeros((n_conds,n_conds,ntps_trn,ntps),dtype=data.dtype)
+    else:
+        RDM=np.zeros((n_conds,n_conds,ntps),dtype=data.dtype)
+
+    if metric in ('mahalanobis','mahalanobis_ct'):
+        dual=nchans>train_dat_cov.shape[0] # more features than training trials, the inverse follows from a trials*trials system
+
+        for tps in time_blocks(ntps_trn,8*nchans*min(nchans,train_dat_cov.shape[0])): # covariances of a block of time points at once
+            # training class means times the inverse covariance, time points*conditions*channels
+            m_blk=np.moveaxis(m_trn[:,:,tps],-1,0)
+            if pooled: # same inverse covariance for all time points
+                m_w=np.matmul(m_blk,sigma_inv)
+            else:
+                cov_dat=train_dat_cov[:,:,tps]
+                if shared['cov_float64']:
+                    cov_dat=cov_dat.astype(np.float64)
+
+                with stage('covdiag'):
+                    if dual: # inv(sigma)=diag(dinv)-R*R.T
+                        dinv,R,_=covdiag_inv_factors(cov_dat)
+                        ok=np.max(dinv,axis=1)<1e10
+                        with np.errstate(invalid='ignore'):
+                            m_w=m_blk*dinv[:,None,:]-np.matmul(np.matmul(m_blk,R),np.swapaxes(R,1,2))
+                        for i in np.where(~ok)[0]: # (almost) no shrinkage, use the pseudo-inverse
+                            m_w[i]=np.matmul(m_blk[i],pinv(covdiag_batched(cov_dat[:,:,i:i+1])[0][0]))
+                    else:
+                        m_w=np.matmul(m_blk,pinv(covdiag_batched(cov_dat)[0]))
+            m_w=m_w.astype(data.dtype,copy=False)
+
+            with stage('distances'):
+                m_tst_t=np.moveaxis(m_tst,-1,0) # test time points*conditions*channels
+                if metric=='mahalanobis':
+                    RDM[:,:,tps]=np.moveaxis(_cv_dists(m_w,m_tst_t[tps]),0,-1)
+                else: # all pairs of training and test time points (within the band), one product per sub-block of training time points
+                    for sub in time_blocks(m_w.shape[0],3*8*ntps*n_conds**2):
+                        itps=slice(tps.start+sub.start,tps.start+sub.stop)
+                        cols=slice(None)
+                        if shared.get('band') is not None:
+                            cols=np.flatnonzero(shared['band'][offset+itps.start:offset+itps.stop].any(axis=0))
+                        RDM[:,:,itps,cols]=_cv_dists_ct(m_w[sub],m_tst_t[cols])
+
+    elif metric=='euclidean':
+        with stage('distances'):
+            RDM[:]=np.moveaxis(_cv_dists(np.moveaxis(m_trn,-1,0),np.moveaxis(m_tst,-1,0)),0,-1)
+
+    else:
+        with stage('distances'):
+            RDM[:]=_corr_pairs(np.moveaxis(m_trn,-1,0),np.moveaxis(m_tst,-1,0),rank=metric=='spearman')
+
+    return RDM
 #%%
+@profiled
 def mahal_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,cov_metric='covdiag',cov_tp=True,balanced_train_dat=True,balanced_test_dat=True,
-                 balanced_cov=True,residual_cov=False,null_decoding=False,average=True):
+                 balanced_cov=True,residual_cov=False,null_decoding=False,average=True,n_jobs=1,seed=None,fold_plan=None,dtype=float,cov_float64=True,verbose=True,profiler=None):
+    
+    '''
+    cross-validated mahalanobis RSA, RDM (n_conds*n_conds*time, or n_reps*... if not average)
+    
+    null_decoding   = null RDM, the trials are randomly permuted within the training and the test trials of each split
+                      (fixed by seed), a single null RDM per call, so a null distribution takes one call per seed
+    '''
     
     if len(data.shape)<3:
         data=np.expand_dims(data,axis=-1)
@@ -62,6 +299,7 @@ def mahal_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,cov_metric='
         data_trn=np.expand_dims(data_trn,axis=-1)
     
         
+    data,data_trn=np.asarray(data,dtype=dtype),np.asarray(data_trn,dtype=dtype)
     ntrls, nchans, ntps=np.shape(data)  
     
     # get all unique conditions combinations
@@ -70,78 +308,36 @@ def mahal_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,cov_metric='
     conds_id=conds_id[:ntrls]
     u_conds=np.unique(conds_id)
     n_conds=len(u_conds)
+
+    # train/test splits and balanced trials
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only generate the splits once
+        fold_plan=FoldPlan.cached(conds_id,n_folds,n_reps,seed,n_classes=n_conds)
+    fold_plan.check(conds_id,kfold=True)
+    # fixed for all splits, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_folds,n_reps=fold_plan.n_folds,fold_plan.n_reps
     
     #%%
-    RDM=np.zeros((n_reps,n_folds,n_conds,n_conds,ntps))
-    RDM[:]=np.nan
-    
-    rskf = RepeatedStratifiedKFold(n_splits=n_folds, n_repeats=n_reps)
-    
-    x_dummy=np.zeros(ntrls)
-    
-    split_counter=0
+    RDM=np.zeros((1 if average else n_reps,n_conds,n_conds,ntps),dtype=dtype) # running mean over folds (and repetitions, if average)
     
-    # bar = ChargingBar('Processing', max=ntps*n_reps*n_folds*n_conds)
-    bar = ChargingBar('Processing', max=n_reps*n_folds)
-    
-    for train_index, test_index in rskf.split(X=x_dummy,y=conds_id):
-        
-        irep=int(np.floor(split_counter/n_folds))
-        ifold=int(np.floor(split_counter-(irep*n_folds)))        
-        
-        split_counter=split_counter+1
-        
-        X_train, X_test = data_trn[train_index,:,:], data[test_index,:,:]
-        y_train, y_test = conds_id[train_index], conds_id[test_index]
-        
-        m_trn=np.zeros((n_conds,nchans,ntps))
-        m_tst=np.zeros((n_conds,nchans,ntps))
-        
-        train_dat_cov = np.empty((0,nchans,ntps))
-        
-        if balanced_train_dat:
-            count_min=min(np.bincount(y_train))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_train[y_train==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_trn[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                if balanced_cov:
-                    if residual_cov:
-                        train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                    else:
-                        train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_trn[idx,:,:]=np.mean(X_train[y_train==c,:,:],axis=0)
-                     
-        if balanced_test_dat:
-            count_min=min(np.bincount(y_test))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_test[y_test==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_tst[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_tst[idx,:,:]=np.mean(X_test[y_test==c,:,:],axis=0)
-                
-        if not balanced_cov:
-            train_dat_cov=X_train
-            
-        if cov_metric and not cov_tp:
-            train_dat_cov=np.mean(train_dat_cov,axis=-1,keepdims=False) 
-            sigma=pinv(covdiag(train_dat_cov))       
-        for itp in range(ntps):
-            sigma=pinv(covdiag(train_dat_cov[:,:,itp])) 
-            
-            for icond in range(n_conds):
-                temp_dists=np.matmul(np.matmul((m_trn[icond,:,itp]-m_trn[:,:,itp]),sigma),(m_tst[icond,:,itp]-m_tst[:,:,itp]).T)
-                RDM[irep,ifold,:,icond,itp]=np.diag(temp_dists)
+    shared=dict(data=data,data_trn=data_trn,conds_id=conds_id,u_conds=u_conds,metric='mahalanobis',balanced_train_dat=balanced_train_dat,
+                balanced_test_dat=balanced_test_dat,balanced_cov=balanced_cov,residual_cov=residual_cov,cov_metric=cov_metric,cov_tp=cov_tp,cov_float64=cov_float64,null_seed=seed if null_decoding else None)
+
+    units=[]
+    for irep,ifold,train_index,test_index in fold_plan.splits(): # all train/test folds, and repetitions
+        units.append((train_index,test_index,(irep,ifold)))
+
+    bar = Progress(n_reps*n_folds,callback=verbose)
+
+    shared['index']=_balanced_index(shared,units,fold_plan) # balanced trials of all units
+
+    for (_,_,(irep,ifold)),RDM_fold in zip(units,run_units(_rsa_unit,units,shared,n_jobs=n_jobs)):
+        RDM[0 if average else irep,:,:,:]+=RDM_fold/n_folds
         bar.next()
-    
-    bar.finish()            
-    RDM=np.mean(RDM,axis=1)
+
+    bar.finish()
     if average:
-        RDM=np.mean(RDM,axis=0)
+        RDM=RDM[0]/n_reps
     
     return RDM,cond_combs
 #%%
@@ -207,12 +403,41 @@ def RSA_GLM2(RDM,models,zscore_models=True,zscore_RDM=True,residual=False):
     return betas,RDM_res
 
 #%%
-def mahal_CV_RSA_ct(data,conditions,n_folds=8,n_reps=100,data_trn=None,cov_metric='covdiag',cov_tp=True,balanced_train_dat=True,balanced_test_dat=True,balanced_cov=True,residual_cov=False,null_decoding=False,average=True):
+@profiled
+def mahal_CV_RSA_ct(data,conditions,n_folds=8,n_reps=100,data_trn=None,cov_metric='covdiag',cov_tp=True,balanced_train_dat=True,balanced_test_dat=True,balanced_cov=True,residual_cov=False,null_decoding=False,average=True,n_jobs=1,seed=None,fold_plan=None,out_path=None,dtype=float,cov_float64=True,verbose=True,profiler=None,
+                    train_tps=None,test_tps=None,time_band=None):
+    
+    '''
+    cross-temporal cross-validated mahalanobis RSA, RDM (n_conds*n_conds*train time*test time, or n_reps*... if not average)
+    
+    train_tps,test_tps  = training and test time points (index or slice, default all), to compute a block of the full RDM
+    time_band           = only pairs of time points at most time_band time points apart (default None: all), others are nan
+    null_decoding       = null RDM, the trials are randomly permuted within the training and the test trials of each split
+                          (fixed by seed), a single null RDM per call, so a null distribution takes one call per seed
+    
+    per split, the class means of each training time point are whitened once, and the RDMs of all condition pairs and
+    test time points follow from one matrix product per block of training time points (see _cv_dists_ct),
+    accumulated over folds (and repetitions) into a running mean, memory-mapped to out_path if given
+    '''
     
     if data_trn is None:
         data_trn=data
            
+    data,data_trn=np.asarray(data,dtype=dtype),np.asarray(data_trn,dtype=dtype)
+
+    # block of training/test time points, and the pairs of time points within the band
+    tps_trn=np.arange(data_trn.shape[2])[slice(None) if train_tps is None else train_tps]
+    tps_tst=np.arange(data.shape[2])[slice(None) if test_tps is None else test_tps]
+    if train_tps is not None:
+        data_trn=data_trn[:,:,tps_trn]
+    if test_tps is not None:
+        data=data[:,:,tps_tst]
+    band=None
+    if time_band is not None:
+        band=np.abs(tps_trn[:,None]-tps_tst[None,:])<=time_band
+
     ntrls, nchans, ntps=np.shape(data)  
+    ntps_trn=data_trn.shape[2]
     
     # get all unique conditions combinations
     cond_combs= np.unique(conditions, axis=0)  
@@ -220,87 +445,62 @@ def mahal_CV_RSA_ct(data,conditions,n_folds=8,n_reps=100,data_trn=None,cov_metri
     conds_id=conds_id[:ntrls]
     u_conds=np.unique(conds_id)
     n_conds=len(u_conds)
+
+    # train/test splits and balanced trials
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only generate the splits once
+        fold_plan=FoldPlan.cached(conds_id,n_folds,n_reps,seed,n_classes=n_conds)
+    fold_plan.check(conds_id,kfold=True)
+    # fixed for all splits, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_folds,n_reps=fold_plan.n_folds,fold_plan.n_reps
     
     #%%
-    RDM=np.zeros((n_reps,n_conds,n_conds,ntps,ntps))
-    RDM_folds=np.zeros((n_folds,n_conds,n_conds,ntps,ntps))
-    RDM[:]=np.nan
-    RDM_folds[:]=np.nan
-    
-    rskf = RepeatedStratifiedKFold(n_splits=n_folds, n_repeats=n_reps)
-    
-    x_dummy=np.zeros(ntrls)
+    # running mean over folds (and repetitions, if average), memory-mapped to out_path if given
+    RDM=open_out(out_path,'RDM',(1 if average else n_reps,n_conds,n_conds,ntps_trn,ntps),dtype=dtype)
     
-    split_counter=0
-    
-    # bar = ChargingBar('Processing', max=ntps*n_reps*n_folds*n_conds)
-    bar = ChargingBar('Processing', max=n_reps*n_folds)
-    
-    for train_index, test_index in rskf.split(X=x_dummy,y=conds_id):
-        
-        irep=int(np.floor(split_counter/n_folds))
-        ifold=int(np.floor(split_counter-(irep*n_folds)))        
-        
-        split_counter=split_counter+1
-        
-        X_train, X_test = data_trn[train_index,:,:], data[test_index,:,:]
-        y_train, y_test = conds_id[train_index], conds_id[test_index]
-        
-        m_trn=np.zeros((n_conds,nchans,ntps))
-        m_tst=np.zeros((n_conds,nchans,ntps))
-        
-        train_dat_cov = np.empty((0,nchans,ntps))
-        
-        if balanced_train_dat:
-            count_min=min(np.bincount(y_train))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_train[y_train==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_trn[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                if balanced_cov:
-                    if residual_cov:
-                        train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                    else:
-                        train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_trn[idx,:,:]=np.mean(X_train[y_train==c,:,:],axis=0)
-                     
-        if balanced_test_dat:
-            count_min=min(np.bincount(y_test))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_test[y_test==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_tst[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_tst[idx,:,:]=np.mean(X_test[y_test==c,:,:],axis=0)
-                
-        if not balanced_cov:
-            train_dat_cov=X_train
-            
-        if cov_metric and not cov_tp:
-            train_dat_cov=np.mean(train_dat_cov,axis=-1,keepdims=False) 
-            sigma=pinv(covdiag(train_dat_cov))       
-        for itp in range(ntps):
-            sigma=pinv(covdiag(train_dat_cov[:,:,itp]))
-            for itp2 in range(ntps):
-                for icond in range(n_conds):
-                    temp_dists=np.matmul(np.matmul((m_trn[icond,:,itp]-m_trn[:,:,itp]),sigma),(m_tst[icond,:,itp2]-m_tst[:,:,itp2]).T)
-                    RDM_folds[ifold,:,icond,itp,itp2]=np.diag(temp_dists)             
-        if ifold+1==n_folds:
-            RDM[irep,:,:,:,:]=np.mean(RDM_folds,axis=0)
-            
-        bar.next()
-    #%%
-    bar.finish()            
+    shared=dict(data=data,data_trn=data_trn,conds_id=conds_id,u_conds=u_conds,metric='mahalanobis_ct',balanced_train_dat=balanced_train_dat,
+                balanced_test_dat=balanced_test_dat,balanced_cov=balanced_cov,residual_cov=residual_cov,cov_metric=cov_metric,cov_tp=cov_tp,cov_float64=cov_float64,null_seed=seed if null_decoding else None,band=band)
+
+    # each work unit handles one block of training time points
+    blocks=time_blocks(ntps_trn,8*n_conds**2*ntps)
+
+    units,splits=[],[]
+    for irep,ifold,train_index,test_index in fold_plan.splits(): # all train/test folds, and repetitions
+        splits.append((train_index,test_index,(irep,ifold)))
+        for tps in blocks:
+            units.append((train_index,test_index,(irep,ifold),tps))
+
+    bar = Progress(n_reps*n_folds*ntps_trn,callback=verbose)
+
+    shared['index']=_balanced_index(shared,units,fold_plan) # balanced trials of all units
+    if cov_metric and not cov_tp: # pooled inverse covariance of each split (from all training time points), shared by its blocks
+        shared['precision']=dict(zip([key for _,_,key in splits],run_units(_precision_unit,splits,shared,n_jobs=n_jobs)))
+
+    for (_,_,(irep,ifold),tps),RDM_fold in zip(units,run_units(_rsa_unit,units,shared,n_jobs=n_jobs)):
+        RDM[0 if average else irep,:,:,tps,:]+=RDM_fold/n_folds
+        bar.next(tps.stop-tps.start)
+
+    bar.finish()
     if average:
-        RDM=np.mean(RDM,axis=0)
+        RDM=RDM[0]
+        for tps in blocks:
+            RDM[:,:,tps,:]/=n_reps
+    if band is not None: # pairs of time points outside the band
+        for tps in blocks:
+            RDM[...,tps,:]=np.where(band[tps],RDM[...,tps,:],np.nan)
     
     return RDM,cond_combs
 
 #%%
-def euclid_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balanced_train_dat=True,balanced_test_dat=True,null_decoding=False,average=True):
+@profiled
+def euclid_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balanced_train_dat=True,balanced_test_dat=True,null_decoding=False,average=True,n_jobs=1,seed=None,fold_plan=None,dtype=float,verbose=True,profiler=None):
+    
+    '''
+    cross-validated euclidean RSA, RDM (n_conds*n_conds*time, or n_reps*... if not average)
+    
+    null_decoding   = null RDM, the trials are randomly permuted within the training and the test trials of each split
+                      (fixed by seed), a single null RDM per call, so a null distribution takes one call per seed
+    '''
     
     if len(data.shape)<3:
         data=np.expand_dims(data,axis=-1)
@@ -311,6 +511,7 @@ def euclid_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balanced_tr
         data_trn=np.expand_dims(data_trn,axis=-1)
     
         
+    data,data_trn=np.asarray(data,dtype=dtype),np.asarray(data_trn,dtype=dtype)
     ntrls, nchans, ntps=np.shape(data)  
     
     # get all unique conditions combinations
@@ -319,69 +520,49 @@ def euclid_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balanced_tr
     conds_id=conds_id[:ntrls]
     u_conds=np.unique(conds_id)
     n_conds=len(u_conds)
+
+    # train/test splits and balanced trials
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only generate the splits once
+        fold_plan=FoldPlan.cached(conds_id,n_folds,n_reps,seed,n_classes=n_conds)
+    fold_plan.check(conds_id,kfold=True)
+    # fixed for all splits, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_folds,n_reps=fold_plan.n_folds,fold_plan.n_reps
     
     #%%
-    RDM=np.zeros((n_reps,n_folds,n_conds,n_conds,ntps))
-    RDM[:]=np.nan
-    
-    rskf = RepeatedStratifiedKFold(n_splits=n_folds, n_repeats=n_reps)
-    
-    x_dummy=np.zeros(ntrls)
+    RDM=np.zeros((1 if average else n_reps,n_conds,n_conds,ntps),dtype=dtype) # running mean over folds (and repetitions, if average)
     
-    split_counter=0
-    
-    # bar = ChargingBar('Processing', max=ntps*n_reps*n_folds*n_conds)
-    bar = ChargingBar('Processing', max=n_reps*n_folds)
-    
-    for train_index, test_index in rskf.split(X=x_dummy,y=conds_id):
-        
-        irep=int(np.floor(split_counter/n_folds))
-        ifold=int(np.floor(split_counter-(irep*n_folds)))        
-        
-        split_counter=split_counter+1
-        
-        X_train, X_test = data_trn[train_index,:,:], data[test_index,:,:]
-        y_train, y_test = conds_id[train_index], conds_id[test_index]
-        
-        m_trn=np.zeros((n_conds,nchans,ntps))
-        m_tst=np.zeros((n_conds,nchans,ntps))
-        
-        if balanced_train_dat:
-            count_min=min(np.bincount(y_train))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_train[y_train==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_trn[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_trn[idx,:,:]=np.mean(X_train[y_train==c,:,:],axis=0)
-                     
-        if balanced_test_dat:
-            count_min=min(np.bincount(y_test))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_test[y_test==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_tst[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_tst[idx,:,:]=np.mean(X_test[y_test==c,:,:],axis=0)
-                
-                  
-        for itp in range(ntps):
-            for icond in range(n_conds):
-                temp_dists=np.matmul((m_trn[icond,:,itp]-m_trn[:,:,itp]),(m_tst[icond,:,itp]-m_tst[:,:,itp]).T)
-                RDM[irep,ifold,:,icond,itp]=np.diag(temp_dists)
+    shared=dict(data=data,data_trn=data_trn,conds_id=conds_id,u_conds=u_conds,metric='euclidean',balanced_train_dat=balanced_train_dat,
+                balanced_test_dat=balanced_test_dat,balanced_cov=False,residual_cov=False,null_seed=seed if null_decoding else None)
+
+    units=[]
+    for irep,ifold,train_index,test_index in fold_plan.splits(): # all train/test folds, and repetitions
+        units.append((train_index,test_index,(irep,ifold)))
+
+    bar = Progress(n_reps*n_folds,callback=verbose)
+
+    shared['index']=_balanced_index(shared,units,fold_plan) # balanced trials of all units
+
+    for (_,_,(irep,ifold)),RDM_fold in zip(units,run_units(_rsa_unit,units,shared,n_jobs=n_jobs)):
+        RDM[0 if average else irep,:,:,:]+=RDM_fold/n_folds
         bar.next()
-    
-    bar.finish()            
-    RDM=np.mean(RDM,axis=1)
+
+    bar.finish()
     if average:
-        RDM=np.mean(RDM,axis=0)
+        RDM=RDM[0]/n_reps
     
     return RDM,cond_combs
 
 #%% don't use
-def corr_spear_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balanced_train_dat=True,balanced_test_dat=True,null_decoding=False,average=True):
+@profiled
+def corr_spear_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balanced_train_dat=True,balanced_test_dat=True,null_decoding=False,average=True,n_jobs=1,seed=None,fold_plan=None,dtype=float,verbose=True,profiler=None):
+    
+    '''
+    cross-validated spearman correlation RSA, RDM (n_conds*n_conds*time, or n_reps*... if not average)
+    
+    null_decoding   = null RDM, the trials are randomly permuted within the training and the test trials of each split
+                      (fixed by seed), a single null RDM per call, so a null distribution takes one call per seed
+    '''
     
     if len(data.shape)<3:
         data=np.expand_dims(data,axis=-1)
@@ -392,6 +573,7 @@ def corr_spear_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balance
         data_trn=np.expand_dims(data_trn,axis=-1)
     
         
+    data,data_trn=np.asarray(data,dtype=dtype),np.asarray(data_trn,dtype=dtype)
     ntrls, nchans, ntps=np.shape(data)  
     
     # get all unique conditions combinations
@@ -400,104 +582,49 @@ def corr_spear_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balance
     conds_id=conds_id[:ntrls]
     u_conds=np.unique(conds_id)
     n_conds=len(u_conds)
+
+    # train/test splits and balanced trials
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only generate the splits once
+        fold_plan=FoldPlan.cached(conds_id,n_folds,n_reps,seed,n_classes=n_conds)
+    fold_plan.check(conds_id,kfold=True)
+    # fixed for all splits, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_folds,n_reps=fold_plan.n_folds,fold_plan.n_reps
     
     #%%
-    RDM=np.zeros((n_reps,n_folds,n_conds,n_conds,ntps))
-    RDM[:]=np.nan
-    
-    rskf = RepeatedStratifiedKFold(n_splits=n_folds, n_repeats=n_reps)
-    
-    x_dummy=np.zeros(ntrls)
-    
-    split_counter=0
-    
-    # bar = ChargingBar('Processing', max=ntps*n_reps*n_folds*n_conds)
-    bar = ChargingBar('Processing', max=n_reps*n_folds)
-    
-    for train_index, test_index in rskf.split(X=x_dummy,y=conds_id):
-        
-        irep=int(np.floor(split_counter/n_folds))
-        ifold=int(np.floor(split_counter-(irep*n_folds)))        
-        
-        split_counter=split_counter+1
-        
-        X_train, X_test = data_trn[train_index,:,:], data[test_index,:,:]
-        y_train, y_test = conds_id[train_index], conds_id[test_index]
-        
-        m_trn=np.zeros((n_conds,nchans,ntps))
-        m_tst=np.zeros((n_conds,nchans,ntps))
-        
-        if balanced_train_dat:
-            count_min=min(np.bincount(y_train))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_train[y_train==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_trn[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_trn[idx,:,:]=np.mean(X_train[y_train==c,:,:],axis=0)
-                     
-        if balanced_test_dat:
-            count_min=min(np.bincount(y_test))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_test[y_test==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_tst[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_tst[idx,:,:]=np.mean(X_test[y_test==c,:,:],axis=0)
-                
-                  
-        for itp in range(ntps):
-            for icond in range(n_conds):
-                for icond2 in range(n_conds):
-                    # out=pearsonr(m_trn[icond,:,itp],m_tst[icond2,:,itp])
-                    out=spearmanr(m_trn[icond,:,itp],m_tst[icond2,:,itp])
-                    
-                    RDM[irep,ifold,icond2,icond,itp]=out[0]
-                
-                # m_trn_df=pd.DataFrame(m_trn[:,:,itp].T)
-                
-                # corr_trn=-(np.asarray(m_trn_df.corr())-1)
-                
-                # m_tst_df=pd.DataFrame(m_tst[:,:,itp].T)
-                
-                # corr_tst=-(np.asarray(m_tst_df.corr())-1)
-                
-                # corrs_diff=corr_trn-corr_tst
-                
-                # m_trn_df.corrwith(m_tst_df,method='pearson')
-                
-                # # m_trn_df[:].corr(m_tst_df)
-                
-                # corr_tst=-(np.asarray(m_tst_df.corr())-1)
-                
+    RDM=np.zeros((1 if average else n_reps,n_conds,n_conds,ntps),dtype=dtype) # running mean over folds (and repetitions, if average)
     
-                
-                # corr_trn_tst=np.corrcoef(m_trn[:,:,itp],m_tst[:,:,itp],'full')
-                
-                # dist_trn=(m_trn[icond,:,itp]-m_trn[:,:,itp])
-                # dist_tst=(m_tst[icond,:,itp]-m_tst[:,:,itp])
-                
-                # pearsonr(m_trn[:,:,itp],m_tst[:,:,itp])
-                
-                # temp1=np.corrcoef(m_trn[icond,:,itp],m_tst[:,:,itp])
-                # temp1=temp1[~np.eye(temp1.shape[0],dtype=bool)].reshape(temp1.shape[0],-1)
-                
-                
-                # temp_dists=np.matmul((m_trn[icond,:,itp]-m_trn[:,:,itp]),(m_tst[icond,:,itp]-m_tst[:,:,itp]).T)
-                # RDM[irep,ifold,:,icond,itp]=np.diag(temp_dists)
+    shared=dict(data=data,data_trn=data_trn,conds_id=conds_id,u_conds=u_conds,metric='spearman',balanced_train_dat=balanced_train_dat,
+                balanced_test_dat=balanced_test_dat,balanced_cov=False,residual_cov=False,null_seed=seed if null_decoding else None)
+
+    units=[]
+    for irep,ifold,train_index,test_index in fold_plan.splits(): # all train/test folds, and repetitions
+        units.append((train_index,test_index,(irep,ifold)))
+
+    bar = Progress(n_reps*n_folds,callback=verbose)
+
+    shared['index']=_balanced_index(shared,units,fold_plan) # balanced trials of all units
+
+    for (_,_,(irep,ifold)),RDM_fold in zip(units,run_units(_rsa_unit,units,shared,n_jobs=n_jobs)):
+        RDM[0 if average else irep,:,:,:]+=RDM_fold/n_folds
         bar.next()
-    
-    bar.finish()            
-    RDM=np.mean(RDM,axis=1)
+
+    bar.finish()
     if average:
-        RDM=np.mean(RDM,axis=0)
+        RDM=RDM[0]/n_reps
     
     return RDM,cond_combs
 
 #%% don't use
-def corr_pears_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balanced_train_dat=True,balanced_test_dat=True,null_decoding=False,average=True):
+@profiled
+def corr_pears_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balanced_train_dat=True,balanced_test_dat=True,null_decoding=False,average=True,n_jobs=1,seed=None,fold_plan=None,dtype=float,verbose=True,profiler=None):
+    
+    '''
+    cross-validated pearson correlation RSA, RDM (n_conds*n_conds*time, or n_reps*... if not average)
+    
+    null_decoding   = null RDM, the trials are randomly permuted within the training and the test trials of each split
+                      (fixed by seed), a single null RDM per call, so a null distribution takes one call per seed
+    '''
     
     if len(data.shape)<3:
         data=np.expand_dims(data,axis=-1)
@@ -508,6 +635,7 @@ def corr_pears_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balance
         data_trn=np.expand_dims(data_trn,axis=-1)
     
         
+    data,data_trn=np.asarray(data,dtype=dtype),np.asarray(data_trn,dtype=dtype)
     ntrls, nchans, ntps=np.shape(data)  
     
     # get all unique conditions combinations
@@ -516,99 +644,36 @@ def corr_pears_CV_RSA(data,conditions,n_folds=8,n_reps=100,data_trn=None,balance
     conds_id=conds_id[:ntrls]
     u_conds=np.unique(conds_id)
     n_conds=len(u_conds)
+
+    # train/test splits and balanced trials
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only generate the splits once
+        fold_plan=FoldPlan.cached(conds_id,n_folds,n_reps,seed,n_classes=n_conds)
+    fold_plan.check(conds_id,kfold=True)
+    # fixed for all splits, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_folds,n_reps=fold_plan.n_folds,fold_plan.n_reps
     
     #%%
-    RDM=np.zeros((n_reps,n_folds,n_conds,n_conds,ntps))
-    RDM[:]=np.nan
-    
-    rskf = RepeatedStratifiedKFold(n_splits=n_folds, n_repeats=n_reps)
-    
-    x_dummy=np.zeros(ntrls)
-    
-    split_counter=0
-    
-    # bar = ChargingBar('Processing', max=ntps*n_reps*n_folds*n_conds)
-    bar = ChargingBar('Processing', max=n_reps*n_folds)
-    
-    for train_index, test_index in rskf.split(X=x_dummy,y=conds_id):
-        
-        irep=int(np.floor(split_counter/n_folds))
-        ifold=int(np.floor(split_counter-(irep*n_folds)))        
-        
-        split_counter=split_counter+1
-        
-        X_train, X_test = data_trn[train_index,:,:], data[test_index,:,:]
-        y_train, y_test = conds_id[train_index], conds_id[test_index]
-        
-        m_trn=np.zeros((n_conds,nchans,ntps))
-        m_tst=np.zeros((n_conds,nchans,ntps))
-        
-        if balanced_train_dat:
-            count_min=min(np.bincount(y_train))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_train[y_train==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_trn[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_trn[idx,:,:]=np.mean(X_train[y_train==c,:,:],axis=0)
-                     
-        if balanced_test_dat:
-            count_min=min(np.bincount(y_test))
-            for idx,c in enumerate(u_conds):
-                temp_dat=X_test[y_test==c,:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m_tst[idx,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-        else:
-            for idx,c in enumerate(u_conds):
-                m_tst[idx,:,:]=np.mean(X_test[y_test==c,:,:],axis=0)
-                
-                  
-        for itp in range(ntps):
-            for icond in range(n_conds):
-                for icond2 in range(n_conds):
-                    out=pearsonr(m_trn[icond,:,itp],m_tst[icond2,:,itp])
-                    # out=spearmanr(m_trn[icond,:,itp],m_tst[icond2,:,itp])
-                    
-                    RDM[irep,ifold,icond2,icond,itp]=out[0]
-                
-                # m_trn_df=pd.DataFrame(m_trn[:,:,itp].T)
-                
-                # corr_trn=-(np.asarray(m_trn_df.corr())-1)
-                
-                # m_tst_df=pd.DataFrame(m_tst[:,:,itp].T)
-                
-                # corr_tst=-(np.asarray(m_tst_df.corr())-1)
-                
-                # corrs_diff=corr_trn-corr_tst
-                
-                # m_trn_df.corrwith(m_tst_df,method='pearson')
-                
-                # # m_trn_df[:].corr(m_tst_df)
-                
-                # corr_tst=-(np.asarray(m_tst_df.corr())-1)
-                
+    RDM=np.zeros((1 if average else n_reps,n_conds,n_conds,ntps),dtype=dtype) # running mean over folds (and repetitions, if average)
     
-                
-                # corr_trn_tst=np.corrcoef(m_trn[:,:,itp],m_tst[:,:,itp],'full')
-                
-                # dist_trn=(m_trn[icond,:,itp]-m_trn[:,:,itp])
-                # dist_tst=(m_tst[icond,:,itp]-m_tst[:,:,itp])
-                
-                # pearsonr(m_trn[:,:,itp],m_tst[:,:,itp])
-                
-                # temp1=np.corrcoef(m_trn[icond,:,itp],m_tst[:,:,itp])
-                # temp1=temp1[~np.eye(temp1.shape[0],dtype=bool)].reshape(temp1.shape[0],-1)
-                
-                
-                # temp_dists=np.matmul((m_trn[icond,:,itp]-m_trn[:,:,itp]),(m_tst[icond,:,itp]-m_tst[:,:,itp]).T)
-                # RDM[irep,ifold,:,icond,itp]=np.diag(temp_dists)
+    shared=dict(data=data,data_trn=data_trn,conds_id=conds_id,u_conds=u_conds,metric='pearson',balanced_train_dat=balanced_train_dat,
+                balanced_test_dat=balanced_test_dat,balanced_cov=False,residual_cov=False,null_seed=seed if null_decoding else None)
+
+    units=[]
+    for irep,ifold,train_index,test_index in fold_plan.splits(): # all train/test folds, and repetitions
+        units.append((train_index,test_index,(irep,ifold)))
+
+    bar = Progress(n_reps*n_folds,callback=verbose)
+
+    shared['index']=_balanced_index(shared,units,fold_plan) # balanced trials of all units
+
+    for (_,_,(irep,ifold)),RDM_fold in zip(units,run_units(_rsa_unit,units,shared,n_jobs=n_jobs)):
+        RDM[0 if average else irep,:,:,:]+=RDM_fold/n_folds
         bar.next()
-    
-    bar.finish()            
-    RDM=np.mean(RDM,axis=1)
+
+    bar.finish()
     if average:
-        RDM=np.mean(RDM,axis=0)
+        RDM=RDM[0]/n_reps
     
     return RDM,cond_combs
             
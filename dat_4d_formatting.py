@@ -11,7 +11,7 @@ import numpy as np
 from scipy.ndimage.filters import uniform_filter1d
 import warnings
 
-def dat_prep_4d_time_course(data,time_dat,toi,window_length=100,span=10,steps=10,relative_baseline=True,window_center='right',in_ms=True):
+def dat_prep_4d_time_course(data,time_dat,toi,window_length=100,span=10,steps=10,relative_baseline=True,window_center='right',in_ms=True,dtype=float):
     
     """
     create sliding window that combines channels and surrounding time-points
@@ -38,9 +38,12 @@ def dat_prep_4d_time_course(data,time_dat,toi,window_length=100,span=10,steps=10
                         'right' is chosen as default as it allows for interpration of effect onsets (but not offsets!)
                         since only previous time-points are included in the sliding window
     in_ms             = True/False (default True), whether magnitutes are in ms or time-points
+    dtype             = dtype of the formatted data (default float64), np.float32 halves the memory of dat_new 
+                        and of the subsequent decoding (see the dtype option of the decoders)
     
     """
     
+    data=np.asarray(data,dtype=dtype)
     
     time_dat=np.squeeze(time_dat)
     hz=float(np.round(1/np.diff(time_dat[:2]))) # determine sample-rate of input data
@@ -98,7 +101,7 @@ def dat_prep_4d_time_course(data,time_dat,toi,window_length=100,span=10,steps=10
     
     n_tps=len(time_new)    
                 
-    dat_new=np.empty([n_trls,int((window_length/span)*n_chans),n_tps])
+    dat_new=np.empty([n_trls,int((window_length/span)*n_chans),n_tps],dtype=dtype)
     
     for tp in range(n_tps): # loop over each time-point to make 
         ind=np.argmin(abs(time_dat-time_new[tp]))
@@ -123,7 +126,9 @@ def dat_prep_4d_time_course(data,time_dat,toi,window_length=100,span=10,steps=10
 
 
 
-def dat_prep_4d_section(data,time_dat=None,toi=None,span=10,hz=500,relative_baseline=True,in_ms=True):    
+def dat_prep_4d_section(data,time_dat=None,toi=None,span=10,hz=500,relative_baseline=True,in_ms=True,dtype=float):    
+    
+    data=np.asarray(data,dtype=dtype)
     
     if toi is not None:
         if time_dat is not None:
@@ -0,0 +1,639 @@
+# -*- coding: utf-8 -*-
+"""
+helpers shared by the cross-validated decoders (mahal_decoders.py) and RSA functions (cv_rsa.py)
+
+work units (one train/test split, or one repetition) can be run in a process pool,
+each unit gets its own seeded random generator, so results don't depend on the number of workers
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import functools
+import contextlib
+import tracemalloc
+import numpy as np
+from sklearn.model_selection import RepeatedStratifiedKFold
+from concurrent.futures import ProcessPoolExecutor
+
+#%% seeding
+def resolve_seed(seed=None):
+
+    # turn seed (None, int or SeedSequence) into an int, so that it can be handed to all work units
+
+    return np.random.SeedSequence(seed).entropy
+
+def unit_rng(seed,*key):
+
+    '''
+    random generator of a single work unit, e.g. key=(irep,ifold)
+    depends only on seed and key, not on the process that runs the unit
+    '''
+
+    return np.random.default_rng(np.random.SeedSequence(seed,spawn_key=(0,)+tuple(int(k) for k in key)))
+
+def split_seed(seed,*key):
+
+    # random_state for sklearn's splitting objects, independent of the unit generators
+
+    rng=np.random.default_rng(np.random.SeedSequence(seed,spawn_key=(1,)+tuple(int(k) for k in key)))
+
+    return int(rng.integers(2**31-1))
+
+#%% profiling and progress
+_profilers=[] # active profilers
+_no_stage=contextlib.nullcontext()
+
+class StageProfiler:
+
+    '''
+    cumulative wall time, number of calls and (optionally) peak allocation of the stages of the decoders and RSA functions
+    (splits, class_means, covdiag, eigh, distances, postproc, ..., and the decoder/RSA function itself), while the profiler is active
+
+    prof=StageProfiler()
+    dist_theta_kfold_ct(data,theta,profiler=prof) # or: with prof: (any code)
+    prof.report() # {stage: {'time': s, 'calls': n, 'peak_mb': MB}}, slowest stage first
+    prof.save('profile.json')
+
+    memory  = True/False (default False), peak allocation of each stage (MB above the allocation at its start),
+              traced with tracemalloc, which slows down the computation
+
+    stages can be nested (e.g. covdiag within the decoder), their times include the nested stages,
+    stages of work units run in worker processes (n_jobs) are recorded there, and added to the profiler
+    '''
+
+    def __init__(self,memory=False):
+
+        self.memory=memory
+        self.stats={}
+        self._stack=[] # open stages: [name,start time,allocation at start,peak allocation]
+        self._depth=0
+        self._tracing=False
+
+    def __enter__(self):
+
+        if self._depth==0:
+            if self.memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing=True
+            _profilers.append(self)
+        self._depth+=1
+
+        return self
+
+    def __exit__(self,*exc):
+
+        self._depth-=1
+        if self._depth==0:
+            _profilers.remove(self)
+            if self._tracing:
+                tracemalloc.stop()
+                self._tracing=False
+
+    def _enter(self,name):
+
+        frame=[name,time.perf_counter(),0,0]
+        if self.memory:
+            current,peak=tracemalloc.get_traced_memory()
+            for outer in self._stack: # the peak is reset for the new stage, so the open stages keep the peak so far
+                outer[3]=max(outer[3],peak)
+            tracemalloc.reset_peak()
+            frame[2]=frame[3]=current
+        self._stack.append(frame)
+
+    def _exit(self):
+
+        name,t0,start,peak=self._stack.pop()
+        elapsed=time.perf_counter()-t0
+        if self.memory:
+            peak=max(peak,tracemalloc.get_traced_memory()[1])
+            for outer in self._stack:
+                outer[3]=max(outer[3],peak)
+
+        self.merge({name:dict(time=elapsed,calls=1,peak_mb=(peak-start)/2**20)})
+
+    def merge(self,stats):
+
+        # adds the stats of another profiler (e.g. of a worker process)
+
+        for name,st in stats.items():
+            own=self.stats.setdefault(name,dict(time=0.,calls=0,peak_mb=0.))
+            own['time']+=st['time']
+            own['calls']+=st['calls']
+            own['peak_mb']=max(own['peak_mb'],st['peak_mb'])
+
+    def report(self):
+
+        return {name:dict(st) for name,st in sorted(self.stats.items(),key=lambda item: -item[1]['time'])}
+
+    def save(self,path):
+
+        with open(path,'w') as f:
+            json.dump(dict(memory=self.memory,stages=self.report()),f,indent=1)
+
+class _Stage:
+
+    __slots__=('name',)
+
+    def __init__(self,name):
+        self.name=name
+
+    def __enter__(self):
+        for profiler in _profilers:
+            profiler._enter(self.name)
+
+    def __exit__(self,*exc):
+        for profiler in _profilers:
+            profiler._exit()
+
+def stage(name):
+
+    # context of a stage, recorded by the active profilers (a shared no-op context if there are none)
+
+    return _Stage(name) if _profilers else _no_stage
+
+def profiled(fun):
+
+    '''
+    decorator of the decoders and RSA functions: activates their profiler argument (a StageProfiler, or None) while they run,
+    and records the function itself as a stage
+    '''
+
+    signature=inspect.signature(fun)
+
+    @functools.wraps(fun)
+    def wrapper(*args,**kwargs):
+        profiler=kwargs['profiler'] if 'profiler' in kwargs else signature.bind_partial(*args,**kwargs).arguments.get('profiler')
+        with (_no_stage if profiler is None else profiler),stage(fun.__name__):
+            return fun(*args,**kwargs)
+
+    return wrapper
+
+class Progress:
+
+    '''
+    throttled progress of the decoders and RSA functions, reported at most every interval seconds (and when finished),
+    so that next() costs about a clock read per call
+
+    total       = number of steps
+    callback    = True: progress bar on stderr, or a function callback(done,total,elapsed), False/None: no progress
+    '''
+
+    def __init__(self,total,callback=True,interval=.5,label='Processing'):
+
+        self.total=max(int(total),1)
+        self.callback=self._bar if callback is True else callback or None
+        self.interval=interval
+        self.label=label
+        self.done=0
+        self.t0=self.last=time.perf_counter()
+
+    def next(self,n=1):
+
+        self.done+=n
+        now=time.perf_counter()
+        if now-self.last>=self.interval and self.callback is not None:
+            self.last=now
+            self.callback(self.done,self.total,now-self.t0)
+
+    def finish(self):
+
+        if self.callback is None:
+            return
+        self.callback(self.done,self.total,time.perf_counter()-self.t0)
+        if self.callback==self._bar:
+            sys.stderr.write('\n')
+
+    def _bar(self,done,total,elapsed,width=32):
+
+        filled=int(width*min(done/total,1))
+        sys.stderr.write('\r%s |%s%s| %d/%d, %.1f s' % (self.label,'#'*filled,' '*(width-filled),done,total,elapsed))
+        sys.stderr.flush()
+
+#%% (parallel) execution of work units
+_shared={}
+
+def _init_worker(shared,n_threads):
+
+    _shared.clear()
+    _shared.update(shared)
+
+    if n_threads is not None: # avoid oversubscription, each worker gets its share of the BLAS threads
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(n_threads)
+
+def _run_unit(fun_unit):
+
+    fun,unit,memory=fun_unit
+
+    if memory is None: # not profiling
+        return fun(_shared,*unit)
+
+    # stages of the unit, recorded in the worker and added to the profiler of the main process (see run_units)
+    with StageProfiler(memory=memory) as profiler:
+        res=fun(_shared,*unit)
+
+    return res,profiler.stats
+
+def n_workers(n_jobs):
+
+    # number of worker processes, negative values count back from the number of cpus (-1: all cpus)
+
+    if n_jobs is None:
+        return 1
+    if n_jobs<0:
+        n_jobs=max(1,os.cpu_count()+1+n_jobs)
+
+    return int(n_jobs)
+
+def run_units(fun,units,shared,n_jobs=1):
+
+    '''
+    evaluates fun(shared,*unit) for each unit in units
+
+    fun     = module-level function (so it can be sent to worker processes)
+    units   = list of argument tuples, e.g. (train_index,test_index,irep,ifold)
+    shared  = dict with the data all units need, sent to each worker only once
+    n_jobs  = number of worker processes (1: no pool, -1: all cpus)
+
+    yields the results in the order of units, so any reduction over them is identical for any n_jobs
+    '''
+
+    n_jobs=min(n_workers(n_jobs),len(units))
+
+    if n_jobs<=1:
+        for unit in units:
+            yield fun(shared,*unit)
+        return
+
+    n_threads=max(1,os.cpu_count()//n_jobs)
+    chunksize=max(1,len(units)//(4*n_jobs))
+
+    profiler=_profilers[-1] if _profilers else None
+    memory=None if profiler is None else profiler.memory
+
+    with ProcessPoolExecutor(max_workers=n_jobs,initializer=_init_worker,initargs=(shared,n_threads)) as ex:
+        for res in ex.map(_run_unit,[(fun,unit,memory) for unit in units],chunksize=chunksize):
+            if profiler is not None:
+                res,stats=res
+                profiler.merge(stats)
+            yield res
+
+#%% distances
+def sq_dists(a,b):
+
+    '''
+    a (...*m*n): e.g. time*classes*features
+    b (...*k*n): e.g. time*trials*features
+
+    returns the squared euclidian distances (...*m*k) between all rows of a and b, at each leading (time) index,
+    computed as |a|^2+|b|^2-2ab with a single stacked matmul (multithreaded BLAS), clipped at 0 against negative round-off
+    '''
+
+    with stage('distances'):
+        d=np.matmul(a,np.swapaxes(b,-1,-2))
+        d*=-2
+        d+=np.einsum('...ij,...ij->...i',a,a)[...,:,None]
+        d+=np.einsum('...ij,...ij->...i',b,b)[...,None,:]
+
+        return np.maximum(d,0,out=d)
+
+#%% out-of-core output
+def open_out(out_path,name,shape,dtype=float):
+
+    '''
+    zero-initialized output array, memory-mapped to out_path/name.npy if out_path is given (in RAM otherwise)
+    the file can be re-opened later with np.load(..., mmap_mode='r')
+    '''
+
+    if out_path is None:
+        return np.zeros(shape,dtype=dtype)
+
+    os.makedirs(out_path,exist_ok=True)
+
+    return np.lib.format.open_memmap(os.path.join(out_path,name+'.npy'),mode='w+',dtype=dtype,shape=tuple(shape))
+
+def time_blocks(ntps,bytes_per_tp,max_bytes=2**28):
+
+    # split ntps time points into blocks (slices) of at most max_bytes, given the size of a single time point
+
+    block=int(max(1,min(ntps,max_bytes//max(1,bytes_per_tp))))
+
+    return [slice(i,min(i+block,ntps)) for i in range(0,ntps,block)]
+
+#%% reduction over repetitions
+class RunningMean:
+
+    '''
+    running mean of unit results that cover a subset of the trials (axis 1), and optionally
+    a block of the (training) time points (axis 2), e.g. classes*trials*time(*time),
+    so that memory does not scale with the number of repetitions
+
+    shape       = shape of the averaged result, trials along axis 1
+    n_reps      = number of repetitions
+    keep_reps   = True/False (default False), whether to also keep the result of each repetition,
+                  stored in reps with the repetitions along axis 2 (classes*trials*reps*time)
+    out         = zero-initialized array to accumulate into (e.g. from open_out), optional
+    reps_out    = array to store the repetitions in (only if keep_reps), optional
+    dtype       = dtype of the accumulated sum (and repetitions), if out is not given
+    '''
+
+    def __init__(self,shape,n_reps,keep_reps=False,out=None,reps_out=None,dtype=float):
+
+        self.sum=np.zeros(shape,dtype=dtype) if out is None else out
+        self.count=np.zeros(tuple(shape[1:3]),dtype=self.sum.dtype) # per trial and time point
+        self.reps=None
+
+        if keep_reps:
+            self.reps=np.empty(tuple(shape[:2])+(n_reps,)+tuple(shape[2:]),dtype=self.sum.dtype) if reps_out is None else reps_out
+            self.reps[:]=np.nan
+
+    def add(self,value,irep,index=None,tps=None):
+
+        # value of the trials in index (None: all trials) and time points tps (None: all), from repetition irep
+
+        if index is None:
+            index=slice(None)
+        if tps is None:
+            tps=slice(None)
+
+        self.sum[:,index,tps]+=value
+        self.count[index,tps]+=1
+
+        if self.reps is not None:
+            self.reps[:,index,irep,tps]=value
+
+    def mean(self,inplace=False):
+
+        '''
+        returns the running mean, trials/time points that were never tested are nan
+        inplace=True divides the accumulated sum in place (in blocks of time points), e.g. for memory-mapped output
+        '''
+
+        count=self.count.reshape((1,)+self.count.shape+(1,)*(self.sum.ndim-3))
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            if not inplace:
+                return self.sum/count
+
+            ntps=self.sum.shape[2]
+            for tps in time_blocks(ntps,self.sum[:,:,0].nbytes):
+                self.sum[:,:,tps]/=count[:,:,tps]
+
+        return self.sum
+
+#%% fold preparation
+def balanced_indices(ys,nclasses,seed,*key):
+
+    '''
+    ys      = list of integer class labels (0 to nclasses-1), e.g. of the training trials of each fold and repetition
+    seed    = seed of the decoder/RSA function (see resolve_seed)
+    key     = optional, e.g. to draw the training and test trials independently
+
+    draws count_min trials of each class without replacement (count_min: number of trials of the smallest class),
+    for all label sets at once, by sorting random keys within the classes
+
+    returns index (len(ys)*nclasses*max(counts), int32), the drawn trials (positions in ys[i]) of each label set,
+                  padded with -1, so that index[i,:,:counts[i]] are the balanced trials of ys[i]
+            counts (len(ys)), count_min of each label set
+    '''
+
+    rng=np.random.default_rng(np.random.SeedSequence(seed,spawn_key=(2,)+tuple(int(k) for k in key)))
+
+    lens=np.array([len(y) for y in ys])
+    labels=np.full((len(ys),lens.max()),nclasses,dtype=np.intp) # padding (label nclasses) is sorted last
+    labels[np.arange(lens.max())<lens[:,None]]=np.concatenate(ys)
+
+    # number of trials of each class (and padding) in each label set
+    n_class=np.bincount((labels+(nclasses+1)*np.arange(len(ys))[:,None]).ravel(),minlength=len(ys)*(nclasses+1)).reshape(len(ys),nclasses+1)
+    counts=n_class[:,:nclasses].min(axis=1)
+
+    # trials sorted by class, in random order within each class, take the first count_min of each class
+    order=np.lexsort((rng.random(labels.shape),labels),axis=-1)
+    starts=(np.cumsum(n_class,axis=1)-n_class)[:,:nclasses,None]
+    pos=starts+np.arange(counts.max())
+    index=np.take_along_axis(order,np.minimum(pos,labels.shape[1]-1).reshape(len(ys),-1),axis=1).reshape(pos.shape)
+    index[pos>=starts+counts[:,None,None]]=-1
+
+    return index.astype(np.int32),counts
+
+def label_permutations(ntrls,n_perm,seed):
+
+    '''
+    n_perm random permutations (n_perm*ntrls) of the trials, e.g. for the label-permutation null distributions of the decoders,
+    depends only on seed
+    '''
+
+    rng=np.random.default_rng(np.random.SeedSequence(seed,spawn_key=(3,)))
+
+    return rng.permuted(np.tile(np.arange(ntrls),(n_perm,1)),axis=1)
+
+def class_means(X,y,nclasses,index=None):
+
+    '''
+    X       = trials*n*time
+    y       = integer class labels (0 to nclasses-1) of the trials
+    index   = trials to average over per class (nclasses*count), e.g. from balanced_indices (None: all trials)
+
+    returns the class means (nclasses*n*time), as a single (classes*trials) weight matrix times X
+    '''
+
+    W=np.zeros((nclasses,X.shape[0]),dtype=X.dtype)
+    if index is None:
+        W[y,np.arange(len(y))]=1
+    else:
+        W[np.repeat(np.arange(nclasses),index.shape[1]),index.ravel()]=1
+    with np.errstate(invalid='ignore',divide='ignore'):
+        W/=W.sum(axis=1,keepdims=True) # empty classes are nan
+
+    return np.tensordot(W,X,axes=1)
+
+def fold_prep(X,y,nclasses,index=None,balanced_cov=False,residual_cov=False):
+
+    '''
+    class means of the training (or test) trials of a fold, and the data used for the covariance
+
+    X               = trials*n*time
+    y               = integer class labels (0 to nclasses-1) of the trials
+    index           = balanced trials of each class (nclasses*count_min, see balanced_indices), None: average over all trials
+    balanced_cov    = True/False, only use the balanced trials for the covariance (only if index is given)
+    residual_cov    = True/False, also return the balanced trials minus their class means (only if balanced_cov)
+
+    returns m (nclasses*n*time), cov_dat and res_cov_dat (X if not balanced_cov, cov_dat if not residual_cov),
+    the balanced trials are copied once into buffers of known size (nclasses*count_min)
+    '''
+
+    with stage('class_means'):
+        m=class_means(X,y,nclasses,index)
+
+        cov_dat=res_cov_dat=X
+        if index is not None and balanced_cov and index.size>0:
+            nclasses,count_min=index.shape
+            cov_dat=np.empty((nclasses*count_min,)+X.shape[1:],dtype=X.dtype)
+            np.take(X,index.ravel(),axis=0,out=cov_dat)
+            res_cov_dat=cov_dat
+            if residual_cov:
+                res_cov_dat=cov_dat.reshape((nclasses,count_min)+X.shape[1:])-m[:,None]
+                res_cov_dat=res_cov_dat.reshape(cov_dat.shape)
+
+        return m,cov_dat,res_cov_dat
+
+#%% fold plans
+class FoldPlan:
+
+    '''
+    train/test splits (repeated stratified k-fold) and balanced trials of the cross-validated decoders and RSA functions,
+    generated once (e.g. per subject) and reused for other data of the same trials (channel groups, frequency bands, time windows),
+    via their fold_plan option
+
+    labels          = integer class labels (0 to n_classes-1) of the trials, or sets*trials (e.g. the bins of each orientation space)
+    n_folds         = number of folds (None: no cross-validation, each repetition trains on all trials)
+    n_reps          = number of repetitions
+    seed            = None, int or SeedSequence (see resolve_seed)
+    n_classes       = number of classes (default: labels.max()+1)
+    share_splits    = True/False (default False), the same splits (stratified on the first label set) for all label sets,
+                      otherwise each label set has its own splits
+
+    attributes (int32):
+    fold            = fold of each trial (sets*reps*trials), None if n_folds is None
+    train_index     = balanced training trials (sets*reps*folds*n_classes*max count, padded with -1, see balanced_indices),
+                      positions within the training trials of the split
+    train_counts    = number of balanced training trials per class (sets*reps*folds)
+    test_index, test_counts = same for the test trials, None if n_folds is None
+
+    plans can be saved (save) and loaded (FoldPlan.load), FoldPlan.cached returns the same plan for the same labels and settings
+    '''
+
+    _cache={}
+    _cache_size=32
+
+    def __init__(self,labels,n_folds=8,n_reps=10,seed=None,n_classes=None,share_splits=False,_arrays=None):
+
+        labels=np.asarray(labels)
+        self.single=labels.ndim==1 # labels of a single set, for the sklearn seed
+        self.labels=np.atleast_2d(labels).astype(np.int32)
+        self.n_folds=None if n_folds is None else int(n_folds)
+        self.n_reps=int(n_reps)
+        self.seed=resolve_seed(seed)
+        self.n_classes=int(self.labels.max())+1 if n_classes is None else int(n_classes)
+        self.share_splits=bool(share_splits)
+
+        if _arrays is not None: # loaded plan
+            for name in ('fold','train_index','train_counts','test_index','test_counts'):
+                setattr(self,name,_arrays.get(name))
+            return
+
+        nsets,ntrls=self.labels.shape
+        nfolds=1 if self.n_folds is None else self.n_folds
+
+        self.fold=None
+        if self.n_folds is not None:
+            self.fold=np.empty((nsets,self.n_reps,ntrls),dtype=np.int32)
+            for iset in range(nsets):
+                if self.share_splits and iset>0:
+                    self.fold[iset]=self.fold[0]
+                    continue
+                key=() if self.single or self.share_splits else (iset,)
+                rskf=RepeatedStratifiedKFold(n_splits=self.n_folds,n_repeats=self.n_reps,random_state=split_seed(self.seed,*key))
+                for split_counter,(_,test_index) in enumerate(rskf.split(X=np.zeros(ntrls),y=self.labels[iset])):
+                    irep,ifold=divmod(split_counter,self.n_folds)
+                    self.fold[iset,irep,test_index]=ifold
+
+        # balanced trials of all splits at once
+        splits=[(iset,train_index,test_index) for iset in range(nsets) for _,_,train_index,test_index in self.splits(iset)]
+
+        index,counts=balanced_indices([self.labels[iset] if train_index is None else self.labels[iset][train_index] for iset,train_index,_ in splits],
+                                     self.n_classes,self.seed,0)
+        self.train_index=index.reshape((nsets,self.n_reps,nfolds)+index.shape[1:])
+        self.train_counts=counts.reshape(nsets,self.n_reps,nfolds).astype(np.int32)
+
+        self.test_index=self.test_counts=None
+        if self.n_folds is not None:
+            index,counts=balanced_indices([self.labels[iset][test_index] for iset,_,test_index in splits],self.n_classes,self.seed,1)
+            self.test_index=index.reshape((nsets,self.n_reps,nfolds)+index.shape[1:])
+            self.test_counts=counts.reshape(nsets,self.n_reps,nfolds).astype(np.int32)
+
+    @staticmethod
+    def digest(labels):
+
+        # hash of the labels (and their shape), to recognize the trials a plan was made for
+
+        labels=np.ascontiguousarray(np.atleast_2d(labels),dtype=np.int32)
+
+        return hashlib.sha1(str(labels.shape).encode()+labels.tobytes()).hexdigest()
+
+    @classmethod
+    def cached(cls,labels,n_folds=8,n_reps=10,seed=None,n_classes=None,share_splits=False):
+
+        '''
+        same as FoldPlan(...), but memoized by the hash of the labels and (n_folds,n_reps,seed,n_classes,share_splits),
+        so repeated calls on the same trials only generate the splits once (seed=None always makes a new plan)
+        '''
+
+        with stage('splits'):
+            if seed is None:
+                return cls(labels,n_folds,n_reps,seed,n_classes,share_splits)
+
+            key=(cls.digest(labels),np.asarray(labels).ndim,n_folds,n_reps,resolve_seed(seed),n_classes,bool(share_splits))
+            if key not in cls._cache:
+                if len(cls._cache)>=cls._cache_size: # drop the oldest plan
+                    cls._cache.pop(next(iter(cls._cache)))
+                cls._cache[key]=cls(labels,n_folds,n_reps,seed,n_classes,share_splits)
+
+            return cls._cache[key]
+
+    def check(self,labels,share_splits=None,kfold=None):
+
+        # raises a ValueError if the plan was not made for these labels (or sharing of the splits, or cross-validation)
+
+        if self.digest(labels)!=self.digest(self.labels) or np.asarray(labels).ndim!=(1 if self.single else 2):
+            raise ValueError('fold_plan was made for other labels (trials, conditions or orientation bins)')
+        if share_splits is not None and bool(share_splits)!=self.share_splits:
+            raise ValueError('fold_plan was made with share_splits='+str(self.share_splits))
+        if kfold is not None and kfold!=(self.n_folds is not None):
+            raise ValueError('fold_plan was made with n_folds='+str(self.n_folds))
+
+    def splits(self,iset=0):
+
+        '''
+        yields irep, ifold, train_index and test_index of each split of label set iset, ordered by repetition and fold
+        (train_index and test_index are None if n_folds is None)
+        '''
+
+        for irep in range(self.n_reps):
+            if self.n_folds is None:
+                yield irep,0,None,None
+                continue
+            for ifold in range(self.n_folds):
+                test_mask=self.fold[iset,irep]==ifold
+                yield irep,ifold,np.flatnonzero(~test_mask),np.flatnonzero(test_mask)
+
+    def balanced(self,iset=0,irep=0,ifold=0,test=False):
+
+        # balanced training (or test) trials of a split (n_classes*count_min), positions within its training (test) trials
+
+        index,counts=(self.test_index,self.test_counts) if test else (self.train_index,self.train_counts)
+
+        return index[iset,irep,ifold,:,:counts[iset,irep,ifold]]
+
+    def save(self,path):
+
+        # saves the plan to a .npz file
+
+        arrays={name:getattr(self,name) for name in ('fold','train_index','train_counts','test_index','test_counts') if getattr(self,name) is not None}
+        np.savez(path,labels=self.labels,single=self.single,n_folds=-1 if self.n_folds is None else self.n_folds,n_reps=self.n_reps,
+                 seed=str(self.seed),n_classes=self.n_classes,share_splits=self.share_splits,**arrays)
+
+    @classmethod
+    def load(cls,path):
+
+        # loads a plan saved with save
+
+        with np.load(path) as f:
+            arrays={name:f[name] for name in ('fold','train_index','train_counts','test_index','test_counts') if name in f}
+            n_folds=int(f['n_folds'])
+            labels=f['labels'][0] if bool(f['single']) else f['labels']
+
+            return cls(labels,None if n_folds<0 else n_folds,int(f['n_reps']),int(str(f['seed'])),int(f['n_classes']),bool(f['share_splits']),_arrays=arrays)
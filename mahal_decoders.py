@@ -1,10 +1,11 @@
 
-from sklearn.model_selection import RepeatedStratifiedKFold
 from scipy.spatial import distance
 import numpy as np
-import random
 from numpy.linalg import inv
 import warnings
+from functools import lru_cache
+from covdiag import covdiag_batched,covdiag_inv_factors,covdiag_scatter,covdiag_downdate
+from fold_utils import resolve_seed,run_units,RunningMean,open_out,time_blocks,sq_dists,fold_prep,FoldPlan,class_means,balanced_indices,label_permutations,stage,profiled,Progress
 
 
 def circ_dist(x,y,all_pairs=False):
@@ -26,7 +27,7 @@ def circ_dist(x,y,all_pairs=False):
         
     return circ_dists
 
-def covdiag(x):
+def covdiag(x,dense_prior=True):
     
     '''
     x (t*n): t iid observations on n random variables
@@ -34,6 +35,9 @@ def covdiag(x):
     
     Shrinks towards diagonal matrix
     as described in Ledoit and Wolf, 2004
+    
+    dense_prior = True/False (default True), whether the n*n prior (diagonal) matrix is built,
+                  False sets the diagonal of the estimator directly (same estimate, less memory)
     '''
     
     t,n=np.shape(x)
@@ -44,20 +48,26 @@ def covdiag(x):
     #get sample covariance matrix
     sample=np.cov(x,rowvar=False,bias=True)
     
-    #compute prior
-    prior=np.zeros((n,n))
-    np.fill_diagonal(prior,np.diag(sample))
+    sample_var=np.diag(sample)
+    sample_ss=np.vdot(sample,sample)
     
-    #compute shrinkage parameters
-    d=1/n*np.linalg.norm(sample-prior,ord='fro')**2
+    #compute shrinkage parameters, without n*n intermediates
+    #(the squared off-diagonal norm, and the sum of y.T*y as the squared row sums of y)
+    d=1/n*(sample_ss-np.sum(sample_var**2))
     y=x**2
-    r2=1/n/t**2*np.sum(np.dot(y.T,y))-1/n/t*np.sum(sample**2)
+    r2=1/n/t**2*np.sum(np.sum(y,axis=1)**2)-1/n/t*sample_ss
     
     #compute the estimator
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         shrinkage=max(0,min(1,r2/d))
-    sigma=shrinkage*prior+(1-shrinkage)*sample
+    if dense_prior:
+        prior=np.zeros((n,n))
+        np.fill_diagonal(prior,sample_var)
+        sigma=shrinkage*prior+(1-shrinkage)*sample
+    else:
+        sigma=(1-shrinkage)*sample
+        np.fill_diagonal(sigma,sample_var)
     
     return sigma
 
@@ -69,28 +79,495 @@ def cosfun(theta,mu,basis_smooth,amplitude='default',offset='default'):
         offset=.5
     return (offset+amplitude*np.cos(theta-mu))**basis_smooth
 
+@lru_cache(maxsize=64)
+def _basis_kernel(u_theta,basis_smooth):
+
+    # bins*bins smoothing kernel of basis_set_fun (rows sum to 1), cached by the bin centers (tuple) and basis_smooth
+
+    u_theta=np.array(u_theta)
+    kernel=cosfun(u_theta[None,:],u_theta[:,None],basis_smooth)
+    kernel/=np.sum(kernel,axis=1,keepdims=True)
+    kernel.setflags(write=False)
+
+    return kernel
+
 def basis_set_fun(theta_bins,u_theta,basis_smooth='default'):
         
     if basis_smooth=='default':
         basis_smooth=theta_bins.shape[0]-1
-        
-    smooth_bins=np.zeros(theta_bins.shape)
-    
-    for ci in range(theta_bins.shape[0]):
-        temp_kernel=cosfun(u_theta,u_theta[ci],basis_smooth)
-        temp_kernel=np.expand_dims(temp_kernel,axis=[1,2])
-        temp_kernel=np.tile(temp_kernel,(1,theta_bins.shape[1],theta_bins.shape[2]))
-        smooth_bins[ci,:,:]=np.sum(theta_bins*temp_kernel,axis=0)/sum(temp_kernel)                        
-    
-    return smooth_bins
 
+    kernel=_basis_kernel(tuple(np.ravel(u_theta).astype(float)),basis_smooth)
+    dtype=theta_bins.dtype if theta_bins.dtype.kind=='f' else float
+
+    # smoothed bins are the kernel applied along the first (bins) axis
+    return np.tensordot(kernel.astype(dtype,copy=False),theta_bins,axes=1)
+
+#%% batched mahalanobis distances, all time points of a fold at once
+def _tp_blocks(ntps,nchans,max_bytes=2**28):
+
+    # split time points into blocks, such that the stacked n*n matrices of a block stay below max_bytes
+
+    return time_blocks(ntps,8*nchans**2,max_bytes=max_bytes)
+
+def _whiten_stack(dat_cov,dat_cov_res,cov_float64=True,cov=None):
+
+    '''
+    dat_cov (t*n*T): training data used for centering
+    dat_cov_res (t*n*T): training data used for the covariance
+    cov_float64 = True/False (default True), whether shrinkage and eigen-decomposition are done in double precision,
+                  also for single precision data (the whitening matrices are returned in the dtype of dat_cov)
+    cov (T*n*n) = covariances of the time points if already known (e.g. from covdiag_downdate), optional
+
+    returns the whitening matrices (T*n*n) and centers (T*n) of all time points,
+    euclidian distance after whitening is identical to mahalanobis distance
+    '''
+
+    if cov is None:
+        if cov_float64:
+            dat_cov_res=dat_cov_res.astype(np.float64)
+        with stage('covdiag'):
+            cov,_=covdiag_batched(dat_cov_res)
+
+    with stage('eigh'):
+        evals,evecs=np.linalg.eigh(cov)
+    evals=evals.clip(1e-10) # avoid division by zero
+
+    W=(evecs/np.sqrt(evals)[:,None,:]).astype(dat_cov.dtype,copy=False)
+    mu=np.mean(dat_cov,axis=0).T
+
+    return W,mu
+
+def _mahal_dists_stack(m,X_test,dat_cov,dat_cov_res,cov_float64=True,cov_fun=None):
+
+    '''
+    m (classes*n*T): (averaged) training data of each class
+    X_test (trials*n*T): test trials
+    cov_fun = function returning the covariances of a block (slice) of time points, optional (default: covdiag of dat_cov_res)
+
+    returns the mahalanobis distances (classes*trials*T) between all classes and test trials, at each time point
+    '''
+
+    nclasses,nchans,ntps=np.shape(m)
+
+    dists=np.empty((nclasses,X_test.shape[0],ntps),dtype=X_test.dtype)
+
+    for tps in _tp_blocks(ntps,nchans):
+        W,mu=_whiten_stack(dat_cov[:,:,tps],dat_cov_res[:,:,tps],cov_float64=cov_float64,cov=None if cov_fun is None else cov_fun(tps))
+
+        # project class means and test trials into whitened pca space (time points x classes/trials x n)
+        m_w=np.matmul(np.ascontiguousarray(np.moveaxis(m[:,:,tps],-1,0))-mu[:,None,:],W)
+        X_w=np.matmul(np.ascontiguousarray(np.moveaxis(X_test[:,:,tps],-1,0))-mu[:,None,:],W)
+
+        dists[:,:,tps]=np.sqrt(sq_dists(m_w,X_w)).transpose(1,2,0)
+
+    return dists
+
+def _whiten_dual(dat_cov,dat_cov_res,cov_float64=True):
+
+    '''
+    dat_cov (t*n*T): training data used for centering
+    dat_cov_res (t*n*T): training data used for the covariance
+
+    trial space (dual) form of _whiten_stack, for more features than training trials (n>t):
+    returns dsq (T*n), R (T*n*t) and centers (T*n), with inv(sigma)=diag(dsq**2)-R*R.T, so that the squared
+    mahalanobis distance of v is |v*dsq|^2-|v*R|^2, at O(t^2*n) instead of O(n^3) per time point
+    ok (T): time points with enough shrinkage for the dual form (use _whiten_stack for the others)
+    '''
+
+    if cov_float64:
+        dat_cov_res=dat_cov_res.astype(np.float64)
+
+    with stage('covdiag'):
+        dinv,R,_=covdiag_inv_factors(dat_cov_res)
+    ok=np.max(dinv,axis=1)<1e10 # i.e. all eigenvalues above 1e-10, same as the clipping of _whiten_stack
+
+    with np.errstate(invalid='ignore'):
+        dsq=np.sqrt(dinv).astype(dat_cov.dtype)
+    R=R.astype(dat_cov.dtype,copy=False)
+    mu=np.mean(dat_cov,axis=0).T
+
+    return dsq,R,mu,ok
+
+def _dual_dists(m_c,X_c,dsq,R):
+
+    # mahalanobis distances between the (centered) rows of m_c and X_c, given the dual form of _whiten_dual
+
+    return np.sqrt(np.maximum(sq_dists(m_c*dsq,X_c*dsq)-sq_dists(np.matmul(m_c,R),np.matmul(X_c,R)),0))
+
+def _mahal_dists_dual(m,X_test,dat_cov,dat_cov_res,cov_float64=True):
+
+    '''
+    same as _mahal_dists_stack, in the trial space (dual) form, for more features than training trials
+    time points with (almost) no shrinkage fall back to _mahal_dists_stack
+    '''
+
+    nclasses,nchans,ntps=np.shape(m)
+
+    dists=np.empty((nclasses,X_test.shape[0],ntps),dtype=X_test.dtype)
+
+    for tps in time_blocks(ntps,8*nchans*(dat_cov_res.shape[0]+nclasses+X_test.shape[0])):
+        dsq,R,mu,ok=_whiten_dual(dat_cov[:,:,tps],dat_cov_res[:,:,tps],cov_float64=cov_float64)
+
+        m_c=np.ascontiguousarray(np.moveaxis(m[:,:,tps],-1,0))-mu[:,None,:]
+        X_c=np.ascontiguousarray(np.moveaxis(X_test[:,:,tps],-1,0))-mu[:,None,:]
+
+        with np.errstate(invalid='ignore'):
+            dists[:,:,tps]=_dual_dists(m_c,X_c,dsq[:,None,:],R).transpose(1,2,0)
+
+        for tp in np.arange(ntps)[tps][~ok]:
+            dists[:,:,tp:tp+1]=_mahal_dists_stack(m[:,:,tp:tp+1],X_test[:,:,tp:tp+1],dat_cov[:,:,tp:tp+1],dat_cov_res[:,:,tp:tp+1],cov_float64=cov_float64)
+
+    return dists
+
+def _euclid_dists_stack(m,X_test):
+
+    '''
+    m (classes*n*T): (averaged) training data of each class
+    X_test (trials*n*T): test trials
+
+    returns the euclidian distances (classes*trials*T) between all classes and test trials, at each time point
+    '''
+
+    nclasses,nchans,ntps=np.shape(m)
+
+    dists=np.empty((nclasses,X_test.shape[0],ntps),dtype=X_test.dtype)
+
+    for tps in time_blocks(ntps,8*nchans*(nclasses+X_test.shape[0])):
+        m_t=np.ascontiguousarray(np.moveaxis(m[:,:,tps],-1,0))
+        X_t=np.ascontiguousarray(np.moveaxis(X_test[:,:,tps],-1,0))
+        dists[:,:,tps]=np.sqrt(sq_dists(m_t,X_t)).transpose(1,2,0)
+
+    return dists
+
+#%% one work unit (train/test split, or repetition) of the distance-based decoders
+def _balanced_train_index(shared,units,fold_plan):
+
+    '''
+    balanced training trials of all units, and orientation spaces with shared folds, taken from fold_plan (see FoldPlan)
+    returns dict {key: trials (nclasses*count_min)}, with the key of the unit ((ans,)+key with shared folds), empty if not balanced_train_bins
+    '''
+
+    index={}
+    if shared['balanced_train_bins']:
+        for unit in units: # blocks of time points (cross-temporal) share the key, and thus the trials
+            y_train,key=unit[2],unit[4]
+            for key in ([(ans,)+key for ans in range(len(y_train))] if isinstance(y_train,list) else [key]):
+                # (ans,irep,ifold), (irep,ifold), (ans,irep) or (irep,), without orientation spaces/folds these are 0 in the plan
+                if fold_plan.n_folds is None:
+                    index[key]=fold_plan.balanced(*((0,)*(2-len(key))+key))
+                else:
+                    index[key]=fold_plan.balanced(*((0,)*(3-len(key))+key))
+
+    return index
+
+def _train_means(shared,X_train,y_train,angspace_temp,index=None):
+
+    '''
+    class means (classes*n*time) of the training trials X_train, smoothed with the basis set if angspace_temp is not None,
+    and the training data used for the covariance (train_dat_cov) and its residual (train_dat_res_cov)
+    '''
+
+    # average over same classes of training set, with index (balanced_train_bins) these averages are based on balanced trials,
+    # which can also be used for the covariance (balanced_cov), and its residual (residual_cov)
+    m,train_dat_cov,train_dat_res_cov=fold_prep(X_train,y_train,shared['nclasses'],index,
+                                                balanced_cov=shared['balanced_cov'],residual_cov=shared['residual_cov'])
+
+    if angspace_temp is not None: # smooth the averaged train data with basis set
+        m=basis_set_fun(m,angspace_temp,basis_smooth='default')
+
+    return m,train_dat_cov,train_dat_res_cov
+
+def _dist_unit(shared,train_index,test_index,y_train,angspace_temp,key,tps=None):
+
+    '''
+    shared          = dict with the data (X_tr, X_ts) and settings of the decoder
+    train_index     = training trials of X_tr (None: all)
+    test_index      = test trials of X_ts (None: all)
+    y_train         = class (0...nclasses-1) of each training trial
+    angspace_temp   = bin centers used for the basis set (None: no basis set)
+    key             = identifies the unit, e.g. (ans,irep,ifold), used to look up its balanced training trials (shared['index'])
+    tps             = block (slice) of training time points (None: all), cross-temporal only
+
+    y_train and angspace_temp can also be lists, one per orientation space (shared folds, without balanced covariance),
+    key is then (irep,ifold), and the covariance/whitening of the fold is shared by all orientation spaces,
+    with their classes stacked (ang_steps*nclasses) along the first axis of the output
+
+    returns the distances between the (averaged) training classes and the test trials,
+    classes*trials*time (or classes*trials*train time*test time if shared['cross_temporal'])
+    '''
+
+    X_train=shared['X_tr'] if train_index is None else shared['X_tr'][train_index,:,:]
+    X_test=shared['X_ts'] if test_index is None else shared['X_ts'][test_index,:,:]
+    if tps is not None: # same key for all blocks, so the balanced training trials are identical across blocks
+        X_train=X_train[:,:,tps]
+    dist_metric=shared['dist_metric']
+
+    index=shared['index'] # balanced training trials, see _balanced_train_index
+    if isinstance(y_train,list):
+        m=np.concatenate([_train_means(shared,X_train,y,angspace_ans,index.get((ans,)+key))[0]
+                          for ans,(y,angspace_ans) in enumerate(zip(y_train,angspace_temp))])
+        train_dat_cov=train_dat_res_cov=X_train
+    else:
+        m,train_dat_cov,train_dat_res_cov=_train_means(shared,X_train,y_train,angspace_temp,index.get(key))
+
+    nclasses=m.shape[0]
+
+    dual=X_train.shape[1]>train_dat_res_cov.shape[0] # more features than training trials, the dual form is cheaper
+
+    if not shared['cross_temporal']:
+        if dist_metric!='mahalanobis': # all time points at once
+            return _euclid_dists_stack(m,X_test)
+
+        if shared['new_version'] and dual: # mahalanobis distance in trial space, all time points at once
+            return _mahal_dists_dual(m,X_test,train_dat_cov,train_dat_res_cov,cov_float64=shared['cov_float64'])
+
+        cov_fun=None
+        if shared.get('scatter') is not None: # covariance of all training trials, downdated from the full-data sums
+            out_index=np.setdiff1d(np.arange(shared['X_tr'].shape[0]),train_index)
+            cov_fun=lambda tps: covdiag_downdate(shared['X_tr'][:,:,tps],{k:v[tps] for k,v in shared['scatter'].items()},out_index)[0]
+
+        if shared['new_version']: # euclidian distance in whitened pca space (identical to mahalanobis distance), all time points at once
+            return _mahal_dists_stack(m,X_test,train_dat_cov,train_dat_res_cov,cov_float64=shared['cov_float64'],cov_fun=cov_fun)
+
+        dists=np.empty((nclasses,X_test.shape[0],X_test.shape[2]),dtype=X_test.dtype)
+        for tps in _tp_blocks(X_test.shape[2],X_test.shape[1]):
+            covs=inv(covdiag_batched(train_dat_cov[:,:,tps])[0])
+            for i,tp in enumerate(range(X_test.shape[2])[tps]):
+                dists[:,:,tp]=distance.cdist(m[:,:,tp],X_test[:,:,tp],'mahalanobis', VI=covs[i]) # compute distances between all test trials, and average train trials
+
+        return dists
+
+    ntrls_tst,_,ntps=np.shape(X_test)
+    ntps_trn=X_train.shape[2]
+
+    dists_ct=np.empty((nclasses,ntrls_tst,ntps_trn,ntps),dtype=X_test.dtype)
+
+    # reshape test data for efficient distance computation
+    X_test_rs=np.moveaxis(X_test,-1,1)
+    X_test_rs=np.reshape(X_test_rs,(ntrls_tst*ntps,X_test.shape[1]),order='C')
+
+    for tps in _tp_blocks(ntps_trn,X_train.shape[1]): # covariances of a block of training time points at once
+
+        if dist_metric=='mahalanobis':
+            if shared['new_version'] and dual: # mahalanobis distance in trial space
+                dsq,R,mu,ok=_whiten_dual(train_dat_cov[:,:,tps],train_dat_res_cov[:,:,tps],cov_float64=shared['cov_float64'])
+            elif shared['new_version']: # with a lot of dimensions, first performing pca and then using euclidian distance is faster
+                W,mu=_whiten_stack(train_dat_cov[:,:,tps],train_dat_res_cov[:,:,tps],cov_float64=shared['cov_float64'])
+            else:
+                covs=inv(covdiag_batched(train_dat_cov[:,:,tps])[0])
+
+        for i,tp in enumerate(range(ntps_trn)[tps]):
+            m_train_tp=m[:,:,tp]
+
+            if dist_metric=='mahalanobis':
+                if shared['new_version'] and dual and ok[i]:
+                    dists=_dual_dists(m_train_tp-mu[i],X_test_rs-mu[i],dsq[i],R[i])
+                elif shared['new_version'] and dual: # (almost) no shrinkage at this time point, use the primal form
+                    W_tp,mu_tp=_whiten_stack(train_dat_cov[:,:,tp:tp+1],train_dat_res_cov[:,:,tp:tp+1],cov_float64=shared['cov_float64'])
+                    dists=np.sqrt(sq_dists(np.dot(m_train_tp-mu_tp[0],W_tp[0]),np.dot(X_test_rs-mu_tp[0],W_tp[0])))
+                elif shared['new_version']:
+                    # compute euclidan distance in whitented pca space (which is identical to mahalanobis distance)
+                    dists=np.sqrt(sq_dists(np.dot(m_train_tp-mu[i],W[i]),np.dot(X_test_rs-mu[i],W[i])))
+                else:
+                    dists=distance.cdist(m_train_tp,X_test_rs,'mahalanobis', VI=covs[i]) # compute distances between all test trials, and average train trials
+            else:
+                dists=np.sqrt(sq_dists(m_train_tp,X_test_rs))
+
+            dists_ct[:,:,tp,:]=dists.reshape(nclasses,ntrls_tst,ntps)
+
+    return dists_ct
+
+
+#%% label-permutation null distributions of the cross-validated decoders
+def _perm_dists(shared,X_train,X_test,y_perm,angspace_temp,key):
+
+    '''
+    y_perm  = permuted class labels of the training trials (n_perm*trials)
+    key     = (ans,irep,ifold), for the balanced training trials of each permutation
+
+    returns the distances (n_perm*classes*test trials*time) of all permutations,
+    only the class means depend on the labels, so unless the covariance does (balanced_cov),
+    the training and test trials are whitened once, and the class means of all permutations are one weight matrix times the whitened trials
+    '''
+
+    nclasses=shared['nclasses']
+    n_perm,ntrls_trn=y_perm.shape
+    ntrls_tst,nchans,ntps=np.shape(X_test)
+    mahal=shared['dist_metric']=='mahalanobis'
+
+    index=None
+    if shared['balanced_train_bins']:
+        index,counts=balanced_indices(y_perm,nclasses,shared['seed'],2,*key)
+
+    dists=np.empty((n_perm,nclasses,ntrls_tst,ntps),dtype=X_test.dtype)
+
+    if mahal and shared['balanced_cov'] and index is not None: # covariance of the balanced trials of each permutation
+        for iperm in range(n_perm):
+            m,train_dat_cov,train_dat_res_cov=_train_means(shared,X_train,y_perm[iperm],angspace_temp,index[iperm,:,:counts[iperm]])
+            dists[iperm]=_mahal_dists_stack(m,X_test,train_dat_cov,train_dat_res_cov,cov_float64=shared['cov_float64'])
+        return dists
+
+    # class weights (n_perm*classes*trials) of all permutations, see class_means
+    weights=np.zeros((n_perm,nclasses,ntrls_trn),dtype=X_test.dtype)
+    if index is None:
+        weights[np.arange(n_perm)[:,None],y_perm,np.arange(ntrls_trn)]=1
+    else:
+        iperm,iclass,_=np.nonzero(index>=0)
+        weights[iperm,iclass,index[index>=0]]=1
+    with np.errstate(invalid='ignore',divide='ignore'):
+        weights/=weights.sum(axis=2,keepdims=True) # empty classes are nan
+    if angspace_temp is not None: # the basis set smoothing is linear, so it can be applied to the weights
+        weights=np.moveaxis(basis_set_fun(np.moveaxis(weights,1,0),angspace_temp,basis_smooth='default'),0,1)
+    weights=weights.reshape(n_perm*nclasses,ntrls_trn)
+
+    for tps in time_blocks(ntps,8*nchans*(nchans+ntrls_trn+ntrls_tst+n_perm*nclasses)):
+        X_tr=np.ascontiguousarray(np.moveaxis(X_train[:,:,tps],-1,0))
+        X_ts=np.ascontiguousarray(np.moveaxis(X_test[:,:,tps],-1,0))
+        if mahal: # whitened once for all permutations
+            W,mu=_whiten_stack(X_train[:,:,tps],X_train[:,:,tps],cov_float64=shared['cov_float64'])
+            X_tr=np.matmul(X_tr-mu[:,None,:],W)
+            X_ts=np.matmul(X_ts-mu[:,None,:],W)
+
+        m=np.matmul(weights,X_tr) # time points*(n_perm*classes)*n
+        dists[:,:,:,tps]=np.sqrt(sq_dists(m,X_ts)).reshape(-1,n_perm,nclasses,ntrls_tst).transpose(1,2,3,0)
+
+    return dists
+
+def _perm_unit(shared,train_index,test_index,anss,angspace_temp,key):
+
+    '''
+    one train/test split of the permutation null distribution
+
+    anss            = label sets (orientation spaces) of the split, permuted labels are shared['y_perm'] (sets*n_perm*trials)
+    angspace_temp   = bin centers of each label set used for the basis set (None: no basis set)
+    key             = (irep,ifold), or (ans,irep,ifold)
+
+    returns the sum over the test trials of the decoding measure of each permutation (n_perm*time),
+    the cosine readout (dec_cos) if shared['cos'] is given (orientations), otherwise the distance difference,
+    both are linear in the distances, so the sums of all splits average to the trial mean over repetitions
+    '''
+
+    X_train=shared['X_tr'][train_index,:,:]
+    X_test=shared['X_ts'][test_index,:,:]
+    perm=shared['perm'][:,test_index] # original trials whose labels the test trials have in each permutation
+
+    stat=0
+    for ans,angspace_ans in zip(anss,angspace_temp):
+        y_perm=shared['y_perm'][ans]
+        dists=_perm_dists(shared,X_train,X_test,y_perm[:,train_index],angspace_ans,(ans,)+key[-2:])
+
+        if shared['cos'] is not None: # same as _theta_postproc
+            cos=shared['cos'][ans][:,perm].transpose(1,0,2) # n_perm*bins*test trials
+            dists-=np.mean(dists,axis=1,keepdims=True)
+            stat=stat-np.einsum('pbn,pbnt->pt',cos,dists)/shared['cos'].shape[0]/shared['cos'].shape[1]
+        else: # mean distance to the other classes minus the distance to the own class
+            nclasses=dists.shape[1]
+            own=np.take_along_axis(dists,y_perm[:,test_index][:,None,:,None],axis=1)[:,0]
+            stat=stat+np.sum((np.sum(dists,axis=1)-own)/(nclasses-1)-own,axis=1)
+
+    return stat
+
+def _perm_null(shared,units,n_reps,y_perm,perm,cos,seed,n_jobs=1):
+
+    '''
+    label-permutation null distribution of the kfold decoders, with the same splits as the decoding itself
+    units   = (train_index,test_index,anss,angspaces,key) of all splits
+    y_perm  = permuted class labels (sets*n_perm*trials) of the trials, perm (n_perm*trials) the permutations
+
+    returns the null distribution (time*n_perm) of the trial mean of the decoding measure,
+    permutations last, as expected by util_funcs.cluster_test
+    '''
+
+    shared=dict(shared,y_perm=y_perm,perm=perm,cos=cos,seed=seed)
+
+    null=0
+    with stage('permutations'):
+        for stat in run_units(_perm_unit,units,shared,n_jobs=n_jobs):
+            null=null+stat
+
+    return (null/(perm.shape[1]*n_reps)).T
+
+#%% post-processing of the cross-temporal decoders, in blocks of training time points (so memory-mapped output stays on disk)
+def _theta_cos(theta,angspace_full,ang_steps):
+
+    # cosine of the angular distance between each trial and each bin of angspace_full (bins of all orientation spaces, interleaved),
+    # centered, which is the same as centering the distances across all bins, ang_steps*bins*trials
+
+    cos_theta_dists=np.cos(circ_dist(angspace_full,theta,all_pairs=True).transpose())
+
+    return np.reshape(cos_theta_dists-np.mean(cos_theta_dists,axis=0),(ang_steps,-1,cos_theta_dists.shape[1]),order='F')
+
+def _theta_postproc(distances,theta,angspace_full,out_path=None):
+
+    '''
+    distances (ang_steps*bins*trials*time(*test time)): averaged distances, mean-centered across bins in place
+
+    returns dec_cos (trials*time(*test time)) and distances_ordered (ang_steps*bins*trials*time(*test time)),
+    with the distances ordered relative to the orientation of each trial,
+    both computed per block of time points, without copies of the full distances
+    '''
+
+    ang_steps,nbins,ntrls=np.shape(distances)[:3]
+    nflat=ang_steps*nbins
+
+    cos_theta_dists=_theta_cos(theta,angspace_full,ang_steps).astype(distances.dtype)
+
+    # order the distances, such that same angle distances are in the middle
+    # first, assign each theta to a bin from angspace_full
+    theta_bins=angspace_full[np.argmin(abs(circ_dist(angspace_full,theta,all_pairs=True)),axis=1)]
+
+    # then, get the index of the minimum distance between the theta_bins and angspace_full,
+    # each trial is rolled by shift_to minus that index, i.e. ordered bin k is bin k-shift of angspace_full
+    theta_bin_dists_min_ind=np.argmin(np.abs(circ_dist(angspace_full,theta_bins,all_pairs=True).transpose()),axis=0)
+    shift_to=np.where(np.round(angspace_full,10)==0)[0][0]
+    ind_flat=(np.arange(nflat)[:,None]-(shift_to-theta_bin_dists_min_ind)[None,:])%nflat # ordered bins*trials
+    ind_ans,ind_bin=ind_flat%ang_steps,ind_flat//ang_steps # the flat bins are interleaved (Fortran order) across orientation spaces
+    ind_trl=np.arange(ntrls)[None,:]
+
+    dec_cos=open_out(out_path,'dec_cos',(ntrls,)+distances.shape[3:],dtype=distances.dtype)
+    distances_ordered=open_out(out_path,'distances_ordered',(nflat,ntrls)+distances.shape[3:],dtype=distances.dtype)
+
+    for tps in time_blocks(distances.shape[3],distances[:,:,:,0].nbytes):
+        dist_blk=distances[:,:,:,tps]
+        dist_blk-=np.mean(dist_blk,axis=1,keepdims=True) # mean-center across bins of each orientation space
+
+        dec_cos[:,tps]=-np.einsum('abn,abn...->n...',cos_theta_dists,dist_blk)/nflat
+        distances_ordered[:,:,tps]=dist_blk[ind_ans,ind_bin,ind_trl] # a single gather of all trials
+
+    return np.squeeze(dec_cos),distances_ordered
+
+def _nominal_ct_postproc(distances,y,u_conds,out_path=None):
+
+    '''
+    distances (classes*trials*train time*test time): averaged distances
+    y (trials): class of each test trial
+
+    returns distance_difference, dec_acc and pred_cond (trials*train time*test time)
+    '''
+
+    _,ntrls,ntps_trn,ntps=np.shape(distances)
+
+    distance_difference=open_out(out_path,'distance_difference',(ntrls,ntps_trn,ntps),dtype=distances.dtype)
+    dec_acc=open_out(out_path,'dec_acc',(ntrls,ntps_trn,ntps),dtype=bool)
+    pred_cond=open_out(out_path,'pred_cond',(ntrls,ntps_trn,ntps),dtype=int)
+
+    for tps in time_blocks(ntps_trn,distances[:,:,0,:].nbytes):
+        dist_blk=distances[:,:,tps,:]
+
+        pred_cond[:,tps,:]=np.argmin(dist_blk,axis=0)
+        dec_acc[:,tps,:]=pred_cond[:,tps,:]==y[:,None,None]
+
+        for cond in u_conds:
+            temp1=dist_blk[np.setdiff1d(u_conds,cond),:,:,:]
+            temp2=temp1[:,y==cond,:,:]
+            distance_difference[y==cond,tps,:]=np.mean(temp2,axis=0,keepdims=False)-dist_blk[cond,y==cond,:,:]
+
+    return distance_difference,dec_acc,pred_cond
 
 #%%  distance-based orientation decoding using cross-validation
-def dist_theta_kfold(data,theta,n_folds=8,n_reps=10,data_trn=None,basis_set=True,angspace='default',ang_steps=4,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True):
+@profiled
+def dist_theta_kfold(data,theta,n_folds=8,n_reps=10,data_trn=None,basis_set=True,angspace='default',ang_steps=4,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True,n_jobs=1,seed=None,keep_reps=False,share_folds=False,fold_plan=None,dtype=float,cov_float64=True,downdate_cov=False,n_perm=0,profiler=None):
     
-    if verbose:
-        from progress.bar import ChargingBar
-
     if data_trn is None:
         data_trn=data
         
@@ -102,11 +579,19 @@ def dist_theta_kfold(data,theta,n_folds=8,n_reps=10,data_trn=None,basis_set=True
         ang_steps=1        
                 
     bin_width=np.diff(angspace)[0]
-    
-    x_dummy=np.zeros(len(theta)) # needed for sklearn splitting function
-    
-    X_ts=data
-    X_tr=data_trn    
+
+    # bins of each orientation space (ang_steps*trials), their train/test splits and balanced training trials
+    y_substs=np.stack([np.argmin(abs(circ_dist(angspace+ans*bin_width/ang_steps,theta,all_pairs=True)),axis=1) for ans in range(0,ang_steps)])
+    share_folds=share_folds and not balanced_cov # the covariance then only depends on the training trials, not on the bins
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only generate the splits once
+        fold_plan=FoldPlan.cached(y_substs,n_folds,n_reps,seed,n_classes=len(angspace),share_splits=share_folds)
+    fold_plan.check(y_substs,share_splits=share_folds,kfold=True)
+    # fixed for all work units, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_folds,n_reps=fold_plan.n_folds,fold_plan.n_reps
+    
+    X_ts=np.asarray(data,dtype=dtype)
+    X_tr=np.asarray(data_trn,dtype=dtype)
     if len(X_tr.shape)<3:
         X_tr=np.expand_dims(X_tr,axis=-1)
         
@@ -115,13 +600,11 @@ def dist_theta_kfold(data,theta,n_folds=8,n_reps=10,data_trn=None,basis_set=True
             
     ntrls, nchans, ntps=np.shape(X_ts)  
 
-    m_temp=np.zeros((len(angspace),nchans,ntps))
-    m=m_temp
       
     if verbose:
-        bar = ChargingBar('Processing', max=ntps*ang_steps*n_reps*n_folds)
+        bar = Progress(ntps*ang_steps*n_reps*n_folds,callback=verbose)
     
-    distances=np.empty((ang_steps,len(angspace),ntrls,ntps))
+    distances=np.empty((ang_steps,len(angspace),ntrls,ntps),dtype=dtype)
     
     distances[:]=np.NaN
 
@@ -133,137 +616,75 @@ def dist_theta_kfold(data,theta,n_folds=8,n_reps=10,data_trn=None,basis_set=True
 
     angspace_full=np.reshape(angspaces,(angspaces.shape[0]*angspaces.shape[1]),order='F')
 
-    theta_dists=circ_dist(angspace_full,theta,all_pairs=True)
-    theta_dists=theta_dists.transpose()  
-
-    theta_dists_temp=np.expand_dims(theta_dists,axis=-1)
-    theta_dists2=np.tile(theta_dists_temp,(1,1,ntps))
+    # full-data sums (ntps*nchans*nchans), from which each fold's covariance is downdated,
+    # only if the covariance uses all training trials, and there are fewer channels than training trials (see _whiten_dual otherwise)
+    scatter=None
+    if downdate_cov and dist_metric=='mahalanobis' and new_version and not balanced_cov and nchans<=X_tr.shape[0]*(n_folds-1)//n_folds:
+        scatter=covdiag_scatter(X_tr.astype(np.float64) if cov_float64 else X_tr)
 
-    for ans in range(0,ang_steps): # loop over all desired orientation spaces
-    
-        angspace_temp=angspace+ans*bin_width/ang_steps
-        
-        # convert orientations into bins
-        temp=np.argmin(abs(circ_dist(angspace_temp,theta,all_pairs=True)),axis=1)
-        ang_bin_temp=np.tile(angspace_temp,(len(theta),1))               
-        bin_orient_rads=ang_bin_temp[:,temp][0,:]
-        
-        y_subst=temp
-        y=bin_orient_rads
-                
-        rskf = RepeatedStratifiedKFold(n_splits=n_folds, n_repeats=n_reps) # get splitting object
-        
-        split_counter=0
-        
-        distances_temp=np.empty([len(angspace_temp),ntrls,n_reps,ntps])
-        distances_temp[:]=np.NaN
-               
-        for train_index, test_index in rskf.split(X=x_dummy,y=y_subst): # loop over all train/test folds, and repepitions
-            
-            X_train, X_test = X_tr[train_index,:,:], X_ts[test_index,:,:]
-            y_train, y_test = y[train_index], y[test_index]
-            y_subst_train, y_subst_test = y_subst[train_index], y_subst[test_index]
-                        
-            irep=int(np.floor(split_counter/n_folds))
-            split_counter=split_counter+1
-          
-            train_dat_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-            train_dat_cov[:]=np.NaN
+    shared=dict(X_tr=X_tr,X_ts=X_ts,nclasses=len(angspace),balanced_train_bins=balanced_train_bins,balanced_cov=balanced_cov,
+                residual_cov=residual_cov,dist_metric=dist_metric,new_version=new_version,cov_float64=cov_float64,cross_temporal=False,scatter=scatter)
 
-            train_dat_res_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-            train_dat_res_cov[:]=np.NaN
-            
-            if balanced_train_bins: # average over same orientaions of training set, but make sure these averages are based on balanced trials
-                count_min=min(np.bincount(y_subst_train))
-                for c in range(len(angspace_temp)):
-                    temp_dat=X_train[y_train==angspace_temp[c],:,:]
-                    ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                    m_temp[c,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                    if balanced_cov: # if desired, the data used for the covariance can also be balanced
-                        if residual_cov: # take the residual, note that this should only be done if the cov data is balanced!
-                            train_dat_res_cov = np.append(train_dat_res_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                        train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0)
-            else:
-                for c in range(len(angspace_temp)):
-                    m_temp[c,:,:]=np.mean(X_train[y_train==angspace_temp[c],:,:],axis=0)
-                    
-            if basis_set: # smooth the averaged train data with basis set
-                m=basis_set_fun(m_temp,angspace_temp,basis_smooth='default')
-            else:
-                m=m_temp
-            
-            if not balanced_cov:
-                train_dat_cov=X_train # use all train trials if cov is not balanced  
+    units=[]
+    if share_folds: # same splits for all orientation spaces (stratified on the bins of the first), one whitening per fold
+        for irep,ifold,train_index,test_index in fold_plan.splits(0): # all train/test folds, and repetitions
+            units.append((train_index,test_index,[y_subst[train_index] for y_subst in y_substs],[angspace_temp if basis_set else None for angspace_temp in angspaces],(irep,ifold)))
+    else:
+        for ans in range(0,ang_steps): # loop over all desired orientation spaces
+            for irep,ifold,train_index,test_index in fold_plan.splits(ans): # all train/test folds, and repetitions
+                units.append((train_index,test_index,y_substs[ans][train_index],angspaces[ans] if basis_set else None,(ans,irep,ifold)))
 
-            if np.isnan(train_dat_res_cov).all():
-                train_dat_res_cov=train_dat_cov                     
-                    
-            for tp in range(ntps):
-                m_train_tp=m[:,:,tp]
-                X_test_tp=X_test[:,:,tp]
-                
-                if dist_metric=='mahalanobis':
-                    dat_cov_tp=train_dat_cov[:,:,tp]
-                    dat_cov_res_tp=train_dat_res_cov[:,:,tp]
-                    if new_version: # with a lot of dimensions, first performing pca and then using euclidian distance is faster (when using cdist)
-                        cov=covdiag(dat_cov_res_tp) # use covariance of the training data for pca
-                        train_dat_cov_avg = dat_cov_tp.mean(axis=0)
-                        X_test_tp_centered = X_test_tp - train_dat_cov_avg
-                        m_train_tp_centered = m_train_tp -train_dat_cov_avg
-                        evals,evecs = np.linalg.eigh(cov)
-                        idx = evals.argsort()[::-1]
-                        evals = evals[idx]
-                        evecs = evecs[:,idx]
-                        evals=evals.clip(1e-10) # avoid division by zero
-                        evals_sqrt = np.sqrt(evals)
-                        # compute euclidan distance in whitented pca space (which is identical to mahalanobis distance)
-                        distances_temp[:,test_index,irep,tp] = distance.cdist(np.dot(m_train_tp_centered,evecs)/evals_sqrt, np.dot(X_test_tp_centered,evecs)/evals_sqrt, 'euclidean')
-                    else:
-                        cov=inv(covdiag(dat_cov_tp)) 
-                        distances_temp[:,test_index,irep,tp]=distance.cdist(m_train_tp,X_test_tp,'mahalanobis', VI=cov) # compute distances between all test trials, and average train trials
-                else:                    
-                    distances_temp[:,test_index,irep,tp]=distance.cdist(m_train_tp,X_test_tp,'euclidean')
-                   
-                if verbose:    
-                    bar.next()
-
-        distances[ans,:,:,:]=np.mean(distances_temp,axis=2,keepdims=False)
-    
-    distances=distances-np.mean(distances,axis=1,keepdims=True) # mean-center across trials
-    distances_flat=np.reshape(distances,(distances.shape[0]*distances.shape[1],distances.shape[2],distances.shape[3]),order='F')
-    distances_flat=distances_flat-np.mean(distances_flat,axis=0,keepdims=True) # mean-center across bins
-    dec_cos=np.squeeze(-np.mean(np.cos(theta_dists2)*distances_flat,axis=0))
+    shared['index']=_balanced_train_index(shared,units,fold_plan) # balanced training trials of all units
 
-    # order the distances, such that same angle distances are in the middle
-    # first, assign each theta to a bin from angspace_full
-    temp=np.argmin(abs(circ_dist(angspace_full,theta,all_pairs=True)),axis=1)
-    ang_bin_temp=np.tile(angspace_full,(len(theta),1))               
-    theta_bins=ang_bin_temp[:,temp][0,:]
+    results=run_units(_dist_unit,units,shared,n_jobs=n_jobs) # evaluated lazily, in the order of units
 
-    # then, sort the distances based on the distances between the theta_bins
-    theta_bin_dists=circ_dist(angspace_full,theta_bins,all_pairs=True)
-    theta_bin_dists=theta_bin_dists.transpose()
-    theta_bin_dists_abs=np.abs(theta_bin_dists)
-    # get index of the minimum distance
-    theta_bin_dists_min_ind=np.argmin(theta_bin_dists_abs,axis=0)
+    # running means over repetitions, of each orientation space
+    distances_temp=[RunningMean((len(angspace),ntrls,ntps),n_reps,keep_reps=keep_reps,dtype=dtype) for ans in range(0,ang_steps)]
 
-    distances_ordered=np.zeros((distances_flat.shape))
+    for (train_index,test_index,_,_,key),dists in zip(units,results):
+        irep=key[-2]
+        if share_folds: # all orientation spaces at once
+            for ans in range(0,ang_steps):
+                distances_temp[ans].add(dists[ans*len(angspace):(ans+1)*len(angspace)],irep,test_index)
+        else:
+            distances_temp[key[0]].add(dists,irep,test_index)
+        if verbose:
+            bar.next(ntps*(ang_steps if share_folds else 1))
 
-    shift_to=np.where(np.round(angspace_full,10)==0)[0][0]
-    for trl in range(len(theta)):
-        distances_ordered[:,trl,:] = np.roll(distances_flat[:,trl,:], int(shift_to - theta_bin_dists_min_ind[trl]), axis=0)
+    distances_reps=[] # per repetition, only if keep_reps
+    for ans in range(0,ang_steps):
+        distances[ans,:,:,:]=distances_temp[ans].mean()
+        if keep_reps:
+            distances_reps.append(distances_temp[ans].reps)
+    
+    # mean-center (in place) across bins, cosine readout, and the distances ordered relative to the orientation of each trial
+    with stage('postproc'):
+        dec_cos,distances_ordered=_theta_postproc(distances,theta,angspace_full)
+
+    # label-permutation null distribution (time*n_perm) of the trial mean of dec_cos, with the same splits,
+    # and the bins of the permuted orientations (the covariance and whitening are shared by all permutations)
+    out=()
+    if n_perm:
+        perm=label_permutations(ntrls,n_perm,seed)
+        y_perm=np.stack([y_subst[perm] for y_subst in y_substs])
+        if share_folds:
+            perm_units=[(train_index,test_index,list(range(ang_steps)),[angspace_temp if basis_set else None for angspace_temp in angspaces],key)
+                        for train_index,test_index,_,_,key in units]
+        else:
+            perm_units=[(train_index,test_index,[key[0]],[angspaces[key[0]] if basis_set else None],key) for train_index,test_index,_,_,key in units]
+        out=(_perm_null(shared,perm_units,n_reps,y_perm,perm,_theta_cos(theta,angspace_full,ang_steps).astype(dtype),seed,n_jobs=n_jobs),)
     
     if verbose:
         bar.finish()
     
-    return dec_cos,distances,distances_ordered,angspaces,angspace_full
+    if keep_reps:
+        return (dec_cos,distances,distances_ordered,angspaces,angspace_full,np.stack(distances_reps))+out
+    return (dec_cos,distances,distances_ordered,angspaces,angspace_full)+out
 
 #%%  orientation resconstrution using cross-validation, cross-temporal
-def dist_theta_kfold_ct(data,theta,n_folds=8,n_reps=10,data_trn=None,basis_set=True,angspace='default',ang_steps=4,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True):
+@profiled
+def dist_theta_kfold_ct(data,theta,n_folds=8,n_reps=10,data_trn=None,basis_set=True,angspace='default',ang_steps=4,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True,n_jobs=1,seed=None,keep_reps=False,share_folds=False,fold_plan=None,out_path=None,dtype=float,cov_float64=True,profiler=None):
     
-    if verbose:
-        from progress.bar import ChargingBar
-
     if data_trn is None:
         data_trn=data
         
@@ -275,11 +696,19 @@ def dist_theta_kfold_ct(data,theta,n_folds=8,n_reps=10,data_trn=None,basis_set=T
         ang_steps=1        
                 
     bin_width=np.diff(angspace)[0]
-    
-    x_dummy=np.zeros(len(theta)) # needed for sklearn splitting function
-    
-    X_ts=data
-    X_tr=data_trn    
+
+    # bins of each orientation space (ang_steps*trials), their train/test splits and balanced training trials
+    y_substs=np.stack([np.argmin(abs(circ_dist(angspace+ans*bin_width/ang_steps,theta,all_pairs=True)),axis=1) for ans in range(0,ang_steps)])
+    share_folds=share_folds and not balanced_cov # the covariance then only depends on the training trials, not on the bins
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only generate the splits once
+        fold_plan=FoldPlan.cached(y_substs,n_folds,n_reps,seed,n_classes=len(angspace),share_splits=share_folds)
+    fold_plan.check(y_substs,share_splits=share_folds,kfold=True)
+    # fixed for all work units, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_folds,n_reps=fold_plan.n_folds,fold_plan.n_reps
+    
+    X_ts=np.asarray(data,dtype=dtype)
+    X_tr=np.asarray(data_trn,dtype=dtype)
     if len(X_tr.shape)<3:
         X_tr=np.expand_dims(X_tr,axis=-1)
         
@@ -289,184 +718,78 @@ def dist_theta_kfold_ct(data,theta,n_folds=8,n_reps=10,data_trn=None,basis_set=T
     ntrls, nchans, ntps=np.shape(X_ts)  
     _,_,ntps_trn=np.shape(X_tr)
 
-    m_temp=np.zeros((len(angspace),nchans,ntps))
-    m=m_temp
     
     if dist_metric=='euclidean':
         cov_metric=False 
     
     if verbose:
-        bar = ChargingBar('Processing', max=ang_steps*n_reps*n_folds*ntps)
+        bar = Progress(ang_steps*n_reps*n_folds*ntps,callback=verbose)
     
-    dec_cos=np.empty((ang_steps,ntrls,ntps,ntps))
-    distances=np.empty((ang_steps,len(angspace),ntrls,ntps_trn,ntps))
-    
-    dec_cos[:]=np.NaN
-    distances[:]=np.NaN
+    # output, memory-mapped to out_path if given
+    distances=open_out(out_path,'distances',(ang_steps,len(angspace),ntrls,ntps_trn,ntps),dtype=dtype)
+    distances_reps=open_out(out_path,'distances_reps',(ang_steps,len(angspace),ntrls,n_reps,ntps_trn,ntps),dtype=dtype) if keep_reps else None
 
     angspaces=np.zeros((ang_steps,len(angspace)))
 
     for ans in range(0,ang_steps): # loop over all desired orientation spaces
-    
         angspace_temp=angspace+ans*bin_width/ang_steps
         angspaces[ans,:]=angspace_temp
 
     angspace_full=np.reshape(angspaces,(angspaces.shape[0]*angspaces.shape[1]),order='F')
 
-    theta_dists=circ_dist(angspace_full,theta,all_pairs=True)
-    theta_dists=theta_dists.transpose()  
+    shared=dict(X_tr=X_tr,X_ts=X_ts,nclasses=len(angspace),balanced_train_bins=balanced_train_bins,balanced_cov=balanced_cov,
+                residual_cov=residual_cov,dist_metric=dist_metric,new_version=new_version,cov_float64=cov_float64,cross_temporal=True)
 
-    # add two dimensions to theta_dists
-    theta_dists_temp=np.expand_dims(theta_dists,axis=-1)
+    # each work unit handles one block of training time points (of all orientation spaces, with shared folds)
+    blocks=time_blocks(ntps_trn,8*len(angspace)*(ang_steps if share_folds else 1)*ntrls*ntps)
 
-    theta_dists_temp=np.expand_dims(theta_dists_temp,axis=-1)
-    theta_dists2=np.tile(theta_dists_temp,(1,1,ntps_trn,ntps))
+    units=[]
+    if share_folds: # same splits for all orientation spaces (stratified on the bins of the first), one whitening per fold
+        for irep,ifold,train_index,test_index in fold_plan.splits(0): # all train/test folds, and repetitions
+            for tps in blocks:
+                units.append((train_index,test_index,[y_subst[train_index] for y_subst in y_substs],[angspace_temp if basis_set else None for angspace_temp in angspaces],(irep,ifold),tps))
+    else:
+        for ans in range(0,ang_steps): # loop over all desired orientation spaces
+            for irep,ifold,train_index,test_index in fold_plan.splits(ans): # all train/test folds, and repetitions
+                for tps in blocks:
+                    units.append((train_index,test_index,y_substs[ans][train_index],angspaces[ans] if basis_set else None,(ans,irep,ifold),tps))
 
-    for ans in range(0,ang_steps): # loop over all desired orientation spaces
-    
-        angspace_temp=angspace+ans*bin_width/ang_steps
-        
-        # convert orientations into bins
-        temp=np.argmin(abs(circ_dist(angspace_temp,theta,all_pairs=True)),axis=1)
-        ang_bin_temp=np.tile(angspace_temp,(len(theta),1))               
-        bin_orient_rads=ang_bin_temp[:,temp][0,:]
-        
-        y_subst=temp
-        y=bin_orient_rads
-                
-        rskf = RepeatedStratifiedKFold(n_splits=n_folds, n_repeats=n_reps) # get splitting object
-        
-        split_counter=0
-        
-        distances_temp=np.empty([len(angspace_temp),ntrls,n_reps,ntps_trn,ntps])
-        distances_temp[:]=np.NaN
-        
-        theta_dists=circ_dist(angspace_temp,y,all_pairs=True)
-        theta_dists=theta_dists.transpose()                
-        
-        # theta_dists_temp=np.expand_dims(theta_dists,axis=-1)
-        # theta_dists_temp=np.expand_dims(theta_dists_temp,axis=-1)
-        # theta_dists_temp=np.expand_dims(theta_dists_temp,axis=-1)
-        # theta_dists2=np.tile(theta_dists_temp,(1,1,n_reps,ntps,ntps))
-        theta_dists=np.tile(np.expand_dims(theta_dists,axis=-1),(1,1,ntps))
-        
-        angspace_dist=np.unique(np.round(theta_dists,10))
-        if -angspace_dist[-1]==angspace_dist[0]:
-            angspace_dist=np.delete(angspace_dist,len(angspace_dist)-1)
-               
-        for train_index, test_index in rskf.split(X=x_dummy,y=y_subst): # loop over all train/test folds, and repepitions
-            
-            X_train, X_test = X_tr[train_index,:,:], X_ts[test_index,:,:]
-            y_train, y_test = y[train_index], y[test_index]
-            y_subst_train, y_subst_test = y_subst[train_index], y_subst[test_index]
-                        
-            irep=int(np.floor(split_counter/n_folds))
-            split_counter=split_counter+1
-          
-            train_dat_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-            train_dat_cov[:]=np.NaN
+    shared['index']=_balanced_train_index(shared,units,fold_plan) # balanced training trials of all units
 
-            train_dat_res_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-            train_dat_res_cov[:]=np.NaN
-            
-            if balanced_train_bins: # average over same orientaions of training set, but make sure these averages are based on balanced trials
-                count_min=min(np.bincount(y_subst_train))
-                for c in range(len(angspace_temp)):
-                    temp_dat=X_train[y_train==angspace_temp[c],:,:]
-                    ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                    m_temp[c,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                    if balanced_cov:
-                        if residual_cov:
-                            train_dat_res_cov = np.append(train_dat_res_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                        train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0)
-            else:
-                for c in range(len(angspace_temp)):
-                    m_temp[c,:,:]=np.mean(X_train[y_train==angspace_temp[c],:,:],axis=0)
-                    
-            if basis_set: # smooth the averaged train data with basis set
-                m=basis_set_fun(m_temp,angspace_temp,basis_smooth='default')
-            else:
-                m=m_temp
-            
-            if not balanced_cov:
-                train_dat_cov=X_train # use all train trials if cov is not balanced
-
-            if np.isnan(train_dat_res_cov).all():
-                train_dat_res_cov=train_dat_cov  
-                               
-            # reshape test data for efficient distance computation
-            X_test_rs=np.moveaxis(X_test,-1,1)
-            X_test_rs=np.reshape(X_test_rs,(len(test_index)*ntps,X_test.shape[1]),order='C')
-
-            for tp in range(ntps_trn):
-                m_train_tp=m[:,:,tp]
-                       
-                if dist_metric=='mahalanobis':
-                    dat_cov_tp=train_dat_cov[:,:,tp]
-                    dat_cov_res_tp=train_dat_res_cov[:,:,tp]
-                    if new_version: # with a lot of dimensions, first performing pca and then using euclidian distance is faster (when using cdist)
-                        cov=covdiag(dat_cov_res_tp) # use covariance of the training data for pca
-                        train_dat_cov_avg = dat_cov_tp.mean(axis=0)
-                        X_test_rs_centered = X_test_rs - train_dat_cov_avg
-                        m_train_tp_centered = m_train_tp -train_dat_cov_avg
-                        evals,evecs = np.linalg.eigh(cov)
-                        idx = evals.argsort()[::-1]
-                        evals = evals[idx]
-                        evecs = evecs[:,idx]
-                        evals=evals.clip(1e-10) # avoid division by zero
-                        evals_sqrt = np.sqrt(evals)
-                        # compute euclidan distance in whitented pca space (which is identical to mahalanobis distance)
-                        dists = distance.cdist(np.dot(m_train_tp_centered,evecs)/evals_sqrt, np.dot(X_test_rs_centered,evecs)/evals_sqrt, 'euclidean')
-                    else:
-                        cov=inv(covdiag(dat_cov_tp))  
-                        dists=distance.cdist(m_train_tp,X_test_rs,'mahalanobis', VI=cov) # compute distances between all test trials, and average train trials
-                else:                    
-                    dists=distance.cdist(m_train_tp,X_test_rs,'euclidean')
-
-                distances_temp[:,test_index,irep,tp,:]=dists.reshape(len(angspace_temp),len(test_index),ntps)
-                
-                if verbose:
-                    bar.next()
+    results=run_units(_dist_unit,units,shared,n_jobs=n_jobs) # evaluated lazily, in the order of units
 
-        distances[ans,:,:,:,:]=np.mean(distances_temp,axis=2,keepdims=False)
-    
-    distances=distances-np.mean(distances,axis=1,keepdims=True)
-    
-    distances_flat=np.reshape(distances,(distances.shape[0]*distances.shape[1],distances.shape[2],distances.shape[3],distances.shape[4]),order='F')
-    distances_flat=distances_flat-np.mean(distances_flat,axis=0,keepdims=True)
-    dec_cos=np.squeeze(-np.mean(np.cos(theta_dists2)*distances_flat,axis=0))
+    # running means over repetitions, of each orientation space, accumulated directly in the output
+    distances_temp=[RunningMean(distances.shape[1:],n_reps,keep_reps=keep_reps,dtype=dtype,out=distances[ans],reps_out=None if distances_reps is None else distances_reps[ans])
+                    for ans in range(0,ang_steps)]
 
-    # order the distances, such that same angle distances are in the middle
-    # first, assign each theta to a bin from angspace_full
-    temp=np.argmin(abs(circ_dist(angspace_full,theta,all_pairs=True)),axis=1)
-    ang_bin_temp=np.tile(angspace_full,(len(theta),1))               
-    theta_bins=ang_bin_temp[:,temp][0,:]
+    for (train_index,test_index,_,_,key,tps),dists in zip(units,results):
+        irep=key[-2]
+        if share_folds: # all orientation spaces at once
+            for ans in range(0,ang_steps):
+                distances_temp[ans].add(dists[ans*len(angspace):(ans+1)*len(angspace)],irep,test_index,tps)
+        else:
+            distances_temp[key[0]].add(dists,irep,test_index,tps)
+        if verbose:
+            bar.next((tps.stop-tps.start)*(ang_steps if share_folds else 1))
 
-    # then, sort the distances based on the distances between the theta_bins
-    theta_bin_dists=circ_dist(angspace_full,theta_bins,all_pairs=True)
-    theta_bin_dists=theta_bin_dists.transpose()
-    theta_bin_dists_abs=np.abs(theta_bin_dists)
-    # get index of the minimum distance
-    theta_bin_dists_min_ind=np.argmin(theta_bin_dists_abs,axis=0)
+    for ans in range(0,ang_steps):
+        distances_temp[ans].mean(inplace=True)
 
-    distances_ordered=np.zeros((distances_flat.shape))
+    with stage('postproc'):
+        dec_cos,distances_ordered=_theta_postproc(distances,theta,angspace_full,out_path=out_path)
 
-    shift_to=np.where(angspace_full==0)[0][0]
-    for trl in range(len(theta)):
-        distances_ordered[:,trl,:,:] = np.roll(distances_flat[:,trl,:,:], int(shift_to - theta_bin_dists_min_ind[trl]), axis=0)
-    
     if verbose:
         bar.finish()
-    
-    return dec_cos,distances,distances_ordered,angspaces,angspace_full 
+
+    if keep_reps:
+        return dec_cos,distances,distances_ordered,angspaces,angspace_full,distances_reps
+    return dec_cos,distances,distances_ordered,angspaces,angspace_full
 
 #%%
 # without cross-validation; separate training and testing data
-def dist_theta(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspace='default',ang_steps=4,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True):
+@profiled
+def dist_theta(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspace='default',ang_steps=4,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True,n_jobs=1,seed=None,keep_reps=False,fold_plan=None,dtype=float,cov_float64=True,profiler=None):
     
-    if verbose:
-        from progress.bar import ChargingBar
-
     if type(angspace)==str:
         if angspace=='default':
             angspace=np.arange(-np.pi,np.pi,np.pi/8)
@@ -475,9 +798,18 @@ def dist_theta(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspace='
         ang_steps=1       
                 
     bin_width=np.diff(angspace)[0]
-    
-    X_test=data
-    X_train=data_trn    
+
+    # bins of the training trials of each orientation space (ang_steps*trials), and their balanced trials
+    y_substs_train=np.stack([np.argmin(abs(circ_dist(angspace+ans*bin_width/ang_steps,theta_trn,all_pairs=True)),axis=1) for ans in range(0,ang_steps)])
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only draw the balanced trials once
+        fold_plan=FoldPlan.cached(y_substs_train,None,n_reps,seed,n_classes=len(angspace))
+    fold_plan.check(y_substs_train,kfold=False)
+    # fixed for all work units, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_reps=fold_plan.n_reps
+    
+    X_test=np.asarray(data,dtype=dtype)
+    X_train=np.asarray(data_trn,dtype=dtype)
     if len(X_train.shape)<3:
         X_train=np.expand_dims(X_train,axis=-1)
         
@@ -486,14 +818,12 @@ def dist_theta(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspace='
             
     ntrls, nchans, ntps=np.shape(X_test)  
 
-    m_temp=np.zeros((len(angspace),nchans,ntps))
-    m=m_temp
     
     if verbose:
-        bar = ChargingBar('Processing', max=ntps*ang_steps*n_reps)
+        bar = Progress(ntps*ang_steps*n_reps,callback=verbose)
     
     dec_cos=np.empty((ang_steps,ntrls,ntps))
-    distances=np.empty((ang_steps,len(angspace),ntrls,ntps))
+    distances=np.empty((ang_steps,len(angspace),ntrls,ntps),dtype=dtype)
     
     dec_cos[:]=np.NaN
     distances[:]=np.NaN
@@ -506,138 +836,46 @@ def dist_theta(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspace='
 
     angspace_full=np.reshape(angspaces,(angspaces.shape[0]*angspaces.shape[1]),order='F')
 
-    theta_dists=circ_dist(angspace_full,theta,all_pairs=True)
-    theta_dists=theta_dists.transpose()  
+    shared=dict(X_tr=X_train,X_ts=X_test,nclasses=len(angspace),balanced_train_bins=balanced_train_bins,balanced_cov=balanced_cov,
+                residual_cov=residual_cov,dist_metric=dist_metric,new_version=new_version,cov_float64=cov_float64,cross_temporal=False)
 
-    theta_dists_temp=np.expand_dims(theta_dists,axis=-1)
-    theta_dists2=np.tile(theta_dists_temp,(1,1,ntps))
+    units=[]
+    for ans in range(0,ang_steps): # loop over all desired orientation spaces
+        for irep,_,_,_ in fold_plan.splits(ans):
+            units.append((None,None,y_substs_train[ans],angspaces[ans] if basis_set else None,(ans,irep)))
 
-    for ans in range(0,ang_steps):
-        angspace_temp=angspace+ans*bin_width/ang_steps
-        
-        temp=np.argmin(abs(circ_dist(angspace_temp,theta,all_pairs=True)),axis=1)
-        ang_bin_temp=np.tile(angspace_temp,(len(theta),1))        
-        
-        bin_orient_rads=ang_bin_temp[:,temp][0,:]
-        y_test=bin_orient_rads
-        
-        distances_temp=np.empty([len(angspace_temp),ntrls,n_reps,ntps])
-        distances_temp[:]=np.NaN
-        
-        theta_dists=circ_dist(angspace_temp,y_test,all_pairs=True);
-        theta_dists=theta_dists.transpose()                
-        
-        temp=np.argmin(abs(circ_dist(angspace_temp,theta_trn,all_pairs=True)),axis=1)
-        ang_bin_temp=np.tile(angspace_temp,(len(theta_trn),1))        
-        
-        bin_orient_rads=ang_bin_temp[:,temp][0,:]
-        y_subst_train=temp
-        y_train=bin_orient_rads
-                             
-        distances_temp=np.empty([len(angspace_temp),ntrls,n_reps,ntps])
-        distances_temp[:]=np.NaN
-        
-        angspace_dist=np.unique(np.round(theta_dists,10))
-        if -angspace_dist[-1]==angspace_dist[0]:
-            angspace_dist=np.delete(angspace_dist,len(angspace_dist)-1)
-                                       
-        for irep in range(n_reps):
-            train_dat_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-            train_dat_cov[:]=np.NaN
-
-            train_dat_res_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-            train_dat_res_cov[:]=np.NaN
-            
-            if balanced_train_bins:
-                count_min=min(np.bincount(y_subst_train))
-                for c in range(len(angspace_temp)):
-                    temp_dat=X_train[y_train==angspace_temp[c],:,:]
-                    ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                    m_temp[c,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                    if balanced_cov:
-                        if residual_cov:
-                            train_dat_res_cov = np.append(train_dat_res_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                        train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0) 
-            else:
-                for c in range(len(angspace_temp)):
-                    m_temp[c,:,:]=np.mean(X_train[y_train==angspace_temp[c],:,:],axis=0)
-                    
-            if basis_set:
-                m=basis_set_fun(m_temp,angspace_temp,basis_smooth='default')
-            else:
-                m=m_temp
-        
-            if not balanced_cov:
-                train_dat_cov=X_train 
+    shared['index']=_balanced_train_index(shared,units,fold_plan) # balanced training trials of all units
 
-            if np.isnan(train_dat_res_cov).all():
-                train_dat_res_cov=train_dat_cov  
-                    
-            for tp in range(ntps):
-                m_train_tp=m[:,:,tp]
-                X_test_tp=X_test[:,:,tp]
-                
-                if dist_metric=='mahalanobis':
-                    dat_cov_tp=train_dat_cov[:,:,tp]
-                    dat_cov_res_tp=train_dat_res_cov[:,:,tp]
-                    if new_version: # with a lot of dimensions, first performing pca and then using euclidian distance is faster (when using cdist)
-                        cov=covdiag(dat_cov_res_tp) # use covariance of the training data for pca
-                        train_dat_cov_avg = dat_cov_tp.mean(axis=0)
-                        X_test_tp_centered = X_test_tp - train_dat_cov_avg
-                        m_train_tp_centered = m_train_tp -train_dat_cov_avg
-                        evals,evecs = np.linalg.eigh(cov)
-                        idx = evals.argsort()[::-1]
-                        evals = evals[idx]
-                        evecs = evecs[:,idx]
-                        evals=evals.clip(1e-10) # avoid division by zero
-                        evals_sqrt = np.sqrt(evals)
-                        # compute euclidan distance in whitented pca space (which is identical to mahalanobis distance)
-                        distances_temp[:,:,irep,tp] = distance.cdist(np.dot(m_train_tp_centered,evecs)/evals_sqrt, np.dot(X_test_tp_centered,evecs)/evals_sqrt, 'euclidean')
-                    else:                                
-                        cov=inv(covdiag(dat_cov_tp))  
-                        distances_temp[:,:,irep,tp]=distance.cdist(m_train_tp,X_test_tp,'mahalanobis', VI=cov)
-                else:                    
-                    distances_temp[:,:,irep,tp]=distance.cdist(m_train_tp,X_test_tp,'euclidean')
-
-                if verbose:    
-                    bar.next()  
-
-        distances[ans,:,:,:]=np.mean(distances_temp,axis=2,keepdims=False)
-    
-    distances=distances-np.mean(distances,axis=1,keepdims=True)
-    distances_flat=np.reshape(distances,(distances.shape[0]*distances.shape[1],distances.shape[2],distances.shape[3]),order='F')
-    distances_flat=distances_flat-np.mean(distances_flat,axis=0,keepdims=True)
-    dec_cos=np.squeeze(-np.mean(np.cos(theta_dists2)*distances_flat,axis=0))
+    results=run_units(_dist_unit,units,shared,n_jobs=n_jobs) # evaluated lazily, in the order of units
 
-    # order the distances, such that same angle distances are in the middle
-    # first, assign each theta to a bin from angspace_full
-    temp=np.argmin(abs(circ_dist(angspace_full,theta,all_pairs=True)),axis=1)
-    ang_bin_temp=np.tile(angspace_full,(len(theta),1))               
-    theta_bins=ang_bin_temp[:,temp][0,:]
+    distances_reps=[] # per repetition, only if keep_reps
+    for ans in range(0,ang_steps):
 
-    # then, sort the distances based on the distances between the theta_bins
-    theta_bin_dists=circ_dist(angspace_full,theta_bins,all_pairs=True)
-    theta_bin_dists=theta_bin_dists.transpose()
-    theta_bin_dists_abs=np.abs(theta_bin_dists)
-    # get index of the minimum distance
-    theta_bin_dists_min_ind=np.argmin(theta_bin_dists_abs,axis=0)
+        distances_temp=RunningMean((len(angspace),ntrls,ntps),n_reps,keep_reps=keep_reps,dtype=dtype) # running mean over repetitions
 
-    distances_ordered=np.zeros((distances_flat.shape))
+        for (_,_,_,_,(_,irep)),dists in zip(units[ans*n_reps:(ans+1)*n_reps],results):
+            distances_temp.add(dists,irep,None)
+            if verbose:
+                bar.next(ntps)
 
-    shift_to=np.where(angspace_full==0)[0][0]
-    for trl in range(len(theta)):
-        distances_ordered[:,trl,:] = np.roll(distances_flat[:,trl,:], int(shift_to - theta_bin_dists_min_ind[trl]), axis=0)
+        distances[ans,:,:,:]=distances_temp.mean()
+        if keep_reps:
+            distances_reps.append(distances_temp.reps)
+    
+    # mean-center (in place) across bins, cosine readout, and the distances ordered relative to the orientation of each trial
+    with stage('postproc'):
+        dec_cos,distances_ordered=_theta_postproc(distances,theta,angspace_full)
     
     if verbose:
         bar.finish()
     
+    if keep_reps:
+        return dec_cos,distances,distances_ordered,angspaces,angspace_full,np.stack(distances_reps)
     return dec_cos,distances,distances_ordered,angspaces,angspace_full
 #%%  orientation resconstruction, no cross-validation, cross-temporal
-def dist_theta_ct(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspace='default',ang_steps=4,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True):
+@profiled
+def dist_theta_ct(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspace='default',ang_steps=4,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True,n_jobs=1,seed=None,keep_reps=False,fold_plan=None,out_path=None,dtype=float,cov_float64=True,profiler=None):
     
-    if verbose:
-        from progress.bar import ChargingBar
-
     if data_trn is None:
         data_trn=data
         
@@ -649,9 +887,18 @@ def dist_theta_ct(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspac
         ang_steps=1        
                 
     bin_width=np.diff(angspace)[0]
-    
-    X_ts=data
-    X_tr=data_trn    
+
+    # bins of the training trials of each orientation space (ang_steps*trials), and their balanced trials
+    y_substs_train=np.stack([np.argmin(abs(circ_dist(angspace+ans*bin_width/ang_steps,theta_trn,all_pairs=True)),axis=1) for ans in range(0,ang_steps)])
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only draw the balanced trials once
+        fold_plan=FoldPlan.cached(y_substs_train,None,n_reps,seed,n_classes=len(angspace))
+    fold_plan.check(y_substs_train,kfold=False)
+    # fixed for all work units, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_reps=fold_plan.n_reps
+    
+    X_ts=np.asarray(data,dtype=dtype)
+    X_tr=np.asarray(data_trn,dtype=dtype)
     if len(X_tr.shape)<3:
         X_tr=np.expand_dims(X_tr,axis=-1)
         
@@ -661,17 +908,13 @@ def dist_theta_ct(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspac
     ntrls, nchans_tst, ntps=np.shape(X_ts)
     ntrls_trn, nchans_trn, ntps_trn=np.shape(X_tr) 
 
-    m_temp=np.zeros((len(angspace),nchans_trn,ntps_trn))
-    m=m_temp
     
     if verbose:
-        bar = ChargingBar('Processing', max=ang_steps*n_reps*ntps_trn)
-    
-    dec_cos=np.empty((ang_steps,ntrls,ntps_trn,ntps))
-    distances=np.empty((ang_steps,len(angspace),ntrls,ntps_trn,ntps))
+        bar = Progress(ang_steps*n_reps*ntps_trn,callback=verbose)
     
-    dec_cos[:]=np.NaN
-    distances[:]=np.NaN
+    # output, memory-mapped to out_path if given
+    distances=open_out(out_path,'distances',(ang_steps,len(angspace),ntrls,ntps_trn,ntps),dtype=dtype)
+    distances_reps=open_out(out_path,'distances_reps',(ang_steps,len(angspace),ntrls,n_reps,ntps_trn,ntps),dtype=dtype) if keep_reps else None
 
     angspaces=np.zeros((ang_steps,len(angspace)))
 
@@ -681,150 +924,51 @@ def dist_theta_ct(data,theta,data_trn,theta_trn,n_reps=10,basis_set=True,angspac
 
     angspace_full=np.reshape(angspaces,(angspaces.shape[0]*angspaces.shape[1]),order='F')
 
-    theta_dists=circ_dist(angspace_full,theta,all_pairs=True)
-    theta_dists=theta_dists.transpose()  
+    shared=dict(X_tr=X_tr,X_ts=X_ts,nclasses=len(angspace),balanced_train_bins=balanced_train_bins,balanced_cov=balanced_cov,
+                residual_cov=residual_cov,dist_metric=dist_metric,new_version=new_version,cov_float64=cov_float64,cross_temporal=True)
 
-    theta_dists_temp=np.expand_dims(theta_dists,axis=-1)
-    theta_dists_temp=np.expand_dims(theta_dists_temp,axis=-1)
-    theta_dists2=np.tile(theta_dists_temp,(1,1,ntps_trn,ntps))
+    # each work unit handles one block of training time points
+    blocks=time_blocks(ntps_trn,8*len(angspace)*ntrls*ntps)
 
+    units=[]
     for ans in range(0,ang_steps): # loop over all desired orientation spaces
-        angspace_temp=angspace+ans*bin_width/ang_steps
-        
-        temp=np.argmin(abs(circ_dist(angspace_temp,theta,all_pairs=True)),axis=1)
-        ang_bin_temp=np.tile(angspace_temp,(len(theta),1))        
-        
-        bin_orient_rads=ang_bin_temp[:,temp][0,:]
-        y_test=bin_orient_rads
-        
-        distances_temp=np.empty([len(angspace_temp),ntrls,n_reps,ntps_trn,ntps])
-        distances_temp[:]=np.NaN
+        for irep,_,_,_ in fold_plan.splits(ans):
+            for tps in blocks:
+                units.append((None,None,y_substs_train[ans],angspaces[ans] if basis_set else None,(ans,irep),tps))
 
-        theta_dists=circ_dist(angspace_temp,y_test,all_pairs=True)
-        theta_dists=theta_dists.transpose()                
-        
-        # theta_dists_temp=np.expand_dims(theta_dists,axis=-1)
-        # theta_dists_temp=np.expand_dims(theta_dists_temp,axis=-1)
-        # theta_dists2=np.tile(theta_dists_temp,(1,1,n_reps,ntps))
-        # theta_dists=np.tile(np.expand_dims(theta_dists,axis=-1),(1,1,ntps))
-        
-        temp=np.argmin(abs(circ_dist(angspace_temp,theta_trn,all_pairs=True)),axis=1)
-        ang_bin_temp=np.tile(angspace_temp,(len(theta_trn),1))        
-        
-        bin_orient_rads=ang_bin_temp[:,temp][0,:]
-        y_subst_train=temp
-        y_train=bin_orient_rads
-                             
-        angspace_dist=np.unique(np.round(theta_dists,10))
-        if -angspace_dist[-1]==angspace_dist[0]:
-            angspace_dist=np.delete(angspace_dist,len(angspace_dist)-1)
-               
-        for irep in range(n_reps):
-            train_dat_cov = np.empty((0,X_tr.shape[1],X_tr.shape[2]))
-            train_dat_cov[:]=np.NaN
-
-            train_dat_res_cov = np.empty((0,X_tr.shape[1],X_tr.shape[2]))
-            train_dat_res_cov[:]=np.NaN
-            
-            if balanced_train_bins:
-                count_min=min(np.bincount(y_subst_train))
-                for c in range(len(angspace_temp)):
-                    temp_dat=X_tr[y_train==angspace_temp[c],:,:]
-                    ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                    m_temp[c,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                    if balanced_cov:
-                        if residual_cov:
-                            train_dat_res_cov = np.append(train_dat_res_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                        train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0) 
-            else:
-                for c in range(len(angspace_temp)):
-                    m_temp[c,:,:]=np.mean(X_tr[y_train==angspace_temp[c],:,:],axis=0)
-                    
-            if basis_set:
-                m=basis_set_fun(m_temp,angspace_temp,basis_smooth='default')
-            else:
-                m=m_temp
-        
-            if not balanced_cov:
-                train_dat_cov=X_tr # use all train trials if cov is not balanced
-
-            if np.isnan(train_dat_res_cov).all():
-                train_dat_res_cov=train_dat_cov  
-                               
-            # reshape test data for efficient distance computation
-            X_test_rs=np.moveaxis(X_ts,-1,1)
-            X_test_rs=np.reshape(X_test_rs,(X_ts.shape[0]*ntps,X_ts.shape[1]),order='C')
-
-            for tp in range(ntps_trn):
-                m_train_tp=m[:,:,tp]
-                       
-                if dist_metric=='mahalanobis':
-                    dat_cov_tp=train_dat_cov[:,:,tp]
-                    dat_cov_res_tp=train_dat_res_cov[:,:,tp]
-                    if new_version: # with a lot of dimensions, first performing pca and then using euclidian distance is faster (when using cdist)
-                        cov=covdiag(dat_cov_res_tp) # use covariance of the training data for pca
-                        train_dat_cov_avg = dat_cov_tp.mean(axis=0)
-                        X_test_rs_centered = X_test_rs - train_dat_cov_avg
-                        m_train_tp_centered = m_train_tp -train_dat_cov_avg
-                        evals,evecs = np.linalg.eigh(cov)
-                        idx = evals.argsort()[::-1]
-                        evals = evals[idx]
-                        evecs = evecs[:,idx]
-                        evals=evals.clip(1e-10) # avoid division by zero
-                        evals_sqrt = np.sqrt(evals)
-                        # compute euclidan distance in whitented pca space (which is identical to mahalanobis distance)
-                        dists = distance.cdist(np.dot(m_train_tp_centered,evecs)/evals_sqrt, np.dot(X_test_rs_centered,evecs)/evals_sqrt, 'euclidean')
-                    else:
-                        cov=inv(covdiag(dat_cov_tp))  
-                        dists=distance.cdist(m_train_tp,X_test_rs,'mahalanobis', VI=cov) # compute distances between all test trials, and average train trials
-                else:                    
-                    dists=distance.cdist(m_train_tp,X_test_rs,'euclidean')
-
-                distances_temp[:,:,irep,tp,:]=dists.reshape(len(angspace_temp),X_ts.shape[0],ntps)
-                
-                if verbose:
-                    bar.next()
+    shared['index']=_balanced_train_index(shared,units,fold_plan) # balanced training trials of all units
 
-        distances[ans,:,:,:,:]=np.mean(distances_temp,axis=2,keepdims=False)
-    
-    distances=distances-np.mean(distances,axis=1,keepdims=True)
-    distances_flat=np.reshape(distances,(distances.shape[0]*distances.shape[1],distances.shape[2],distances.shape[3],distances.shape[4]),order='F')
-    distances_flat=distances_flat-np.mean(distances_flat,axis=0,keepdims=True)
-    dec_cos=np.squeeze(-np.mean(np.cos(theta_dists2)*distances_flat,axis=0))
+    results=run_units(_dist_unit,units,shared,n_jobs=n_jobs) # evaluated lazily, in the order of units
 
-    # order the distances, such that same angle distances are in the middle
-    # first, assign each theta to a bin from angspace_full
-    temp=np.argmin(abs(circ_dist(angspace_full,theta,all_pairs=True)),axis=1)
-    ang_bin_temp=np.tile(angspace_full,(len(theta),1))               
-    theta_bins=ang_bin_temp[:,temp][0,:]
+    for ans in range(0,ang_steps):
 
-    # then, sort the distances based on the distances between the theta_bins
-    theta_bin_dists=circ_dist(angspace_full,theta_bins,all_pairs=True)
-    theta_bin_dists=theta_bin_dists.transpose()
-    theta_bin_dists_abs=np.abs(theta_bin_dists)
-    # get index of the minimum distance
-    theta_bin_dists_min_ind=np.argmin(theta_bin_dists_abs,axis=0)
+        # running mean over repetitions, accumulated directly in the output
+        distances_temp=RunningMean(distances.shape[1:],n_reps,keep_reps=keep_reps,dtype=dtype,out=distances[ans],reps_out=None if distances_reps is None else distances_reps[ans])
 
-    distances_ordered=np.zeros((distances_flat.shape))
+        for (_,_,_,_,(_,irep),tps),dists in zip(units[ans*n_reps*len(blocks):(ans+1)*n_reps*len(blocks)],results):
+            distances_temp.add(dists,irep,None,tps)
+            if verbose:
+                bar.next(tps.stop-tps.start)
+
+        distances_temp.mean(inplace=True)
+
+    with stage('postproc'):
+        dec_cos,distances_ordered=_theta_postproc(distances,theta,angspace_full,out_path=out_path)
 
-    shift_to=np.where(angspace_full==0)[0][0]
-    for trl in range(len(theta)):
-        distances_ordered[:,trl,:,:] = np.roll(distances_flat[:,trl,:,:], int(shift_to - theta_bin_dists_min_ind[trl]), axis=0)
-    
     if verbose:
         bar.finish()
-    
-    return dec_cos,distances,distances_ordered,angspaces,angspace_full 
+
+    if keep_reps:
+        return dec_cos,distances,distances_ordered,angspaces,angspace_full,distances_reps
+    return dec_cos,distances,distances_ordered,angspaces,angspace_full
+
 #%% categorical decoding using cross-validation   
-def dist_nominal_kfold(data,conditions,n_folds=8,n_reps=10,data_trn=None,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True):
-    
-    if verbose:
-        from progress.bar import ChargingBar
+@profiled
+def dist_nominal_kfold(data,conditions,n_folds=8,n_reps=10,data_trn=None,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True,n_jobs=1,seed=None,keep_reps=False,fold_plan=None,dtype=float,cov_float64=True,downdate_cov=False,n_perm=0,profiler=None):
     
     if data_trn is None:
         data_trn=data
         
-    x_dummy=np.zeros(len(conditions))
     u_conds=np.unique(conditions)
     
     # convert conditions to integers, in case they aren't
@@ -833,9 +977,17 @@ def dist_nominal_kfold(data,conditions,n_folds=8,n_reps=10,data_trn=None,balance
         y_subst[conditions==u_conds[c]]=c
     y_subst = y_subst.astype(int)
     u_conds=np.unique(y_subst)
+
+    # train/test splits and balanced training trials
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only generate the splits once
+        fold_plan=FoldPlan.cached(np.squeeze(y_subst),n_folds,n_reps,seed,n_classes=len(u_conds))
+    fold_plan.check(np.squeeze(y_subst),kfold=True)
+    # fixed for all work units, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_folds,n_reps=fold_plan.n_folds,fold_plan.n_reps
     
-    X_ts=data
-    X_tr=data_trn    
+    X_ts=np.asarray(data,dtype=dtype)
+    X_tr=np.asarray(data_trn,dtype=dtype)
     if len(X_tr.shape)<3:
         X_tr=np.expand_dims(X_tr,axis=-1)
         
@@ -844,107 +996,66 @@ def dist_nominal_kfold(data,conditions,n_folds=8,n_reps=10,data_trn=None,balance
                     
     ntrls, nchans, ntps=np.shape(X_ts)
     
-    m=np.zeros((len(u_conds),nchans,ntps))   
     
     if verbose:
-        bar = ChargingBar('Processing', max=ntps*n_reps*n_folds)
-    
-    rskf = RepeatedStratifiedKFold(n_splits=n_folds, n_repeats=n_reps)
-        
-    distances_temp=np.empty([len(u_conds),ntrls,n_reps,ntps])
-    distances_temp[:]=np.NaN  
-    
-    split_counter=0  
+        bar = Progress(ntps*n_reps*n_folds,callback=verbose)
     
+    distances_temp=RunningMean((len(u_conds),ntrls,ntps),n_reps,keep_reps=keep_reps,dtype=dtype) # running mean over repetitions
+
+    # full-data sums (ntps*nchans*nchans), from which each fold's covariance is downdated,
+    # only if the covariance uses all training trials, and there are fewer channels than training trials (see _whiten_dual otherwise)
+    scatter=None
+    if downdate_cov and dist_metric=='mahalanobis' and new_version and not balanced_cov and nchans<=X_tr.shape[0]*(n_folds-1)//n_folds:
+        scatter=covdiag_scatter(X_tr.astype(np.float64) if cov_float64 else X_tr)
+
+    shared=dict(X_tr=X_tr,X_ts=X_ts,nclasses=len(u_conds),balanced_train_bins=balanced_train_bins,balanced_cov=balanced_cov,
+                residual_cov=residual_cov,dist_metric=dist_metric,new_version=new_version,cov_float64=cov_float64,cross_temporal=False,scatter=scatter)
+
     y_subst=np.squeeze(y_subst)
-    for train_index, test_index in rskf.split(X=x_dummy,y=y_subst):
-                
-        X_train, X_test = X_tr[train_index,:,:], X_ts[test_index,:,:]
-        y_train, y_test = y_subst[train_index], y_subst[test_index]
-                    
-        irep=int(np.floor(split_counter/n_folds))
-        split_counter=split_counter+1
-      
-        train_dat_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-        train_dat_cov[:]=np.NaN
+    units=[]
+    for irep,ifold,train_index,test_index in fold_plan.splits(): # all train/test folds, and repetitions
+        units.append((train_index,test_index,y_subst[train_index],None,(irep,ifold)))
 
-        train_dat_res_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-        train_dat_res_cov[:]=np.NaN
-        
-        if balanced_train_bins:
-            count_min=min(np.bincount(y_train))
-            for c in range(len(u_conds)):
-                temp_dat=X_train[y_train==u_conds[c],:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m[c,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                if balanced_cov:
-                    if residual_cov:
-                        train_dat_res_cov = np.append(train_dat_res_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                    train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0)
-        else:
-            for c in range(len(u_conds)):
-                m[c,:,:]=np.mean(X_train[y_train==u_conds[c],:,:],axis=0)         
-        
-        if not balanced_cov:
-            train_dat_cov=X_train
+    shared['index']=_balanced_train_index(shared,units,fold_plan) # balanced training trials of all units
 
-        if np.isnan(train_dat_res_cov).all():
-            train_dat_res_cov=train_dat_cov
-            
-        for tp in range(ntps):
-            m_train_tp=m[:,:,tp]
-            X_test_tp=X_test[:,:,tp]
-            
-            if dist_metric=='mahalanobis':
-                dat_cov_tp=train_dat_cov[:,:,tp]
-                dat_cov_res_tp=train_dat_res_cov[:,:,tp]
-                if new_version: # euclidian in pca space (same as mahalanobis distance) is faster for high-dimensional data
-                    cov=covdiag(dat_cov_res_tp) # use covariance of the training data for pca
-                    train_dat_cov_avg = dat_cov_tp.mean(axis=0)
-                    X_test_tp_centered = X_test_tp - train_dat_cov_avg
-                    m_train_tp_centered = m_train_tp -train_dat_cov_avg
-                    evals,evecs = np.linalg.eigh(cov)
-                    idx = evals.argsort()[::-1]
-                    evals = evals[idx]
-                    evecs = evecs[:,idx]
-                    evals=evals.clip(1e-10) # avoid division by zero
-                    evals_sqrt = np.sqrt(evals)
-                    # compute euclidan distance in whitented pca space (which is identical to mahalanobis distance)
-                    distances_temp[:,test_index,irep,tp] = distance.cdist(np.dot(m_train_tp_centered,evecs)/evals_sqrt, np.dot(X_test_tp_centered,evecs)/evals_sqrt, 'euclidean')
-                else:                                 
-                    cov=inv(covdiag(dat_cov_tp))                                     
-                    distances_temp[:,test_index,irep,tp]=distance.cdist(m_train_tp,X_test_tp,'mahalanobis', VI=cov)
-            else:                    
-                distances_temp[:,test_index,irep,tp]=distance.cdist(m_train_tp,X_test_tp,'euclidean')
-            if verbose:
-                bar.next()
+    for (train_index,test_index,_,_,(irep,_)),dists in zip(units,run_units(_dist_unit,units,shared,n_jobs=n_jobs)):
+        distances_temp.add(dists,irep,test_index)
+        if verbose:
+            bar.next(ntps)
 
-    distances=np.mean(distances_temp,axis=2,keepdims=False)
+    distances=distances_temp.mean()
     
     pred_cond=np.argmin(distances,axis=0)
     temp=np.transpose(np.tile(y_subst,(pred_cond.shape[1],1)))
     dec_acc=pred_cond==temp
     
-    distance_difference=np.zeros([ntrls,ntps])
+    distance_difference=np.zeros([ntrls,ntps],dtype=distances.dtype)
     
     for cond in u_conds:
         temp1=distances[np.setdiff1d(u_conds,cond),:,:]
         temp2=temp1[:,y_subst==cond,:]
         distance_difference[y_subst==cond,:]=np.mean(temp2,axis=0,keepdims=False)-distances[cond,y_subst==cond,:]    
     
+    # label-permutation null distribution (time*n_perm) of the trial mean of distance_difference, with the same splits
+    # (the covariance and whitening are shared by all permutations)
+    out=()
+    if n_perm:
+        perm=label_permutations(ntrls,n_perm,seed)
+        perm_units=[(train_index,test_index,[0],[None],key) for train_index,test_index,_,_,key in units]
+        out=(_perm_null(shared,perm_units,n_reps,y_subst[perm][None],perm,None,seed,n_jobs=n_jobs),)
+    
     if verbose:
         bar.finish()
-    return distance_difference,distances,dec_acc,pred_cond
+    if keep_reps:
+        return (distance_difference,distances,dec_acc,pred_cond,distances_temp.reps)+out
+    return (distance_difference,distances,dec_acc,pred_cond)+out
 #%%  cross-temporal   
-def dist_nominal_kfold_ct(data,conditions,n_folds=8,n_reps=10,data_trn=None,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True):
+@profiled
+def dist_nominal_kfold_ct(data,conditions,n_folds=8,n_reps=10,data_trn=None,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True,n_jobs=1,seed=None,keep_reps=False,fold_plan=None,out_path=None,dtype=float,cov_float64=True,profiler=None):
     
-    if verbose:
-        from progress.bar import ChargingBar
-
     if data_trn is None:
         data_trn=data
         
-    x_dummy=np.zeros(len(conditions))
     u_conds=np.unique(conditions)
     
     # convert conditions to integers, in case they aren't
@@ -953,9 +1064,17 @@ def dist_nominal_kfold_ct(data,conditions,n_folds=8,n_reps=10,data_trn=None,bala
         y_subst[conditions==u_conds[c]]=c
     y_subst = y_subst.astype(int)
     u_conds=np.unique(y_subst)
+
+    # train/test splits and balanced training trials
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only generate the splits once
+        fold_plan=FoldPlan.cached(np.squeeze(y_subst),n_folds,n_reps,seed,n_classes=len(u_conds))
+    fold_plan.check(np.squeeze(y_subst),kfold=True)
+    # fixed for all work units, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_folds,n_reps=fold_plan.n_folds,fold_plan.n_reps
     
-    X_ts=data
-    X_tr=data_trn    
+    X_ts=np.asarray(data,dtype=dtype)
+    X_tr=np.asarray(data_trn,dtype=dtype)
     if len(X_tr.shape)<3:
         X_tr=np.expand_dims(X_tr,axis=-1)
         
@@ -965,109 +1084,51 @@ def dist_nominal_kfold_ct(data,conditions,n_folds=8,n_reps=10,data_trn=None,bala
     ntrls, nchans, ntps=np.shape(X_ts)
     _,_,ntps_trn=np.shape(X_tr)
     
-    m=np.zeros((len(u_conds),nchans,ntps_trn))   
     
     if verbose:
-        bar = ChargingBar('Processing', max=ntps_trn*n_reps*n_folds)
+        bar = Progress(ntps_trn*n_reps*n_folds,callback=verbose)
     
-    rskf = RepeatedStratifiedKFold(n_splits=n_folds, n_repeats=n_reps)
-        
-    distances_temp=np.empty([len(u_conds),ntrls,n_reps,ntps_trn,ntps])
-    distances_temp[:]=np.NaN  
-    
-    split_counter=0  
-       
+    # output, memory-mapped to out_path if given
+    distances=open_out(out_path,'distances',(len(u_conds),ntrls,ntps_trn,ntps),dtype=dtype)
+    distances_reps=open_out(out_path,'distances_reps',(len(u_conds),ntrls,n_reps,ntps_trn,ntps),dtype=dtype) if keep_reps else None
+
+    # running mean over repetitions, accumulated directly in the output
+    distances_temp=RunningMean(distances.shape,n_reps,keep_reps=keep_reps,dtype=dtype,out=distances,reps_out=distances_reps)
+
+    shared=dict(X_tr=X_tr,X_ts=X_ts,nclasses=len(u_conds),balanced_train_bins=balanced_train_bins,balanced_cov=balanced_cov,
+                residual_cov=residual_cov,dist_metric=dist_metric,new_version=new_version,cov_float64=cov_float64,cross_temporal=True)
+
+    # each work unit handles one block of training time points
+    blocks=time_blocks(ntps_trn,8*len(u_conds)*ntrls*ntps)
+
     y_subst=np.squeeze(y_subst)
-    for train_index, test_index in rskf.split(X=x_dummy,y=y_subst):
-                
-        X_train, X_test = X_tr[train_index,:,:], X_ts[test_index,:,:]
-        y_train, y_test = y_subst[train_index], y_subst[test_index]
-                    
-        irep=int(np.floor(split_counter/n_folds))
-        split_counter=split_counter+1
-      
-        train_dat_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-        train_dat_cov[:]=np.NaN
+    units=[]
+    for irep,ifold,train_index,test_index in fold_plan.splits(): # all train/test folds, and repetitions
+        for tps in blocks:
+            units.append((train_index,test_index,y_subst[train_index],None,(irep,ifold),tps))
 
-        train_dat_res_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-        train_dat_res_cov[:]=np.NaN
-        
-        if balanced_train_bins:
-            count_min=min(np.bincount(y_train))
-            for c in range(len(u_conds)):
-                temp_dat=X_train[y_train==u_conds[c],:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m[c,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                if balanced_cov:
-                    if residual_cov:
-                        train_dat_res_cov = np.append(train_dat_res_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                    train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0)
-        else:
-            for c in range(len(u_conds)):
-                m[c,:,:]=np.mean(X_train[y_train==u_conds[c],:,:],axis=0)         
-        
-        if not balanced_cov:
-            train_dat_cov=X_train
+    shared['index']=_balanced_train_index(shared,units,fold_plan) # balanced training trials of all units
 
-        if np.isnan(train_dat_res_cov).all():
-            train_dat_res_cov=train_dat_cov                       
-        
-        # reshape test data for efficient distance computation
-        X_test_rs=np.moveaxis(X_test,-1,1)
-        X_test_rs=np.reshape(X_test_rs,(len(test_index)*ntps,X_test.shape[1]),order='C')
+    for (train_index,test_index,_,_,(irep,_),tps),dists in zip(units,run_units(_dist_unit,units,shared,n_jobs=n_jobs)):
+        distances_temp.add(dists,irep,test_index,tps)
+        if verbose:
+            bar.next(tps.stop-tps.start)
 
-        for tp in range(ntps_trn):
-            m_train_tp=m[:,:,tp]
-            
-            if dist_metric=='mahalanobis':
-                dat_cov_tp=train_dat_cov[:,:,tp]
-                dat_cov_res_tp=train_dat_res_cov[:,:,tp]
-                if new_version: # with a lot of dimensions, first performing pca and then using euclidian distance is faster (when using cdist)
-                    cov=covdiag(dat_cov_res_tp) # use covariance of the training data for pca
-                    train_dat_cov_avg = dat_cov_tp.mean(axis=0)
-                    X_test_rs_centered = X_test_rs - train_dat_cov_avg
-                    m_train_tp_centered = m_train_tp -train_dat_cov_avg
-                    evals,evecs = np.linalg.eigh(cov)
-                    idx = evals.argsort()[::-1]
-                    evals = evals[idx]
-                    evecs = evecs[:,idx]
-                    evals=evals.clip(1e-10) # avoid division by zero
-                    evals_sqrt = np.sqrt(evals)
-                    # compute euclidan distance in whitented pca space (which is identical to mahalanobis distance)
-                    dists = distance.cdist(np.dot(m_train_tp_centered,evecs)/evals_sqrt, np.dot(X_test_rs_centered,evecs)/evals_sqrt, 'euclidean')
-                else:
-                    cov=inv(covdiag(dat_cov_tp))
-                    dists=distance.cdist(m_train_tp,X_test_rs,'mahalanobis', VI=cov) # compute distances between all test trials, and average train trials
-            else:                    
-                dists=distance.cdist(m_train_tp,X_test_rs,'euclidean')
-            
-            distances_temp[:,test_index,irep,tp,:]=dists.reshape(len(u_conds),len(test_index),ntps)
+    distances=distances_temp.mean(inplace=True)
 
-            if verbose:
-                bar.next()
+    with stage('postproc'):
+        distance_difference,dec_acc,pred_cond=_nominal_ct_postproc(distances,y_subst,u_conds,out_path=out_path)
 
-    distances=np.mean(distances_temp,axis=2,keepdims=False)
-    
-    pred_cond=np.argmin(distances,axis=0)
-    temp=np.transpose(np.tile(y_subst,(pred_cond.shape[2],pred_cond.shape[1],1)))
-    dec_acc=pred_cond==temp
-    
-    distance_difference=np.zeros([ntrls,ntps_trn,ntps])
-    
-    for cond in u_conds:
-        temp1=distances[np.setdiff1d(u_conds,cond),:,:,:]
-        temp2=temp1[:,y_subst==cond,:,:]
-        distance_difference[y_subst==cond,:,:]=np.mean(temp2,axis=0,keepdims=False)-distances[cond,y_subst==cond,:,:]    
-    
     if verbose:
         bar.finish()
+    if keep_reps:
+        return distance_difference,distances,dec_acc,pred_cond,distances_reps
     return distance_difference,distances,dec_acc,pred_cond
+
 #%% categorical decoding, with separate training and testing data  
-def dist_nominal(data,conditions,data_trn,conditions_trn,n_reps=10,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True):
+@profiled
+def dist_nominal(data,conditions,data_trn,conditions_trn,n_reps=10,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True,n_jobs=1,seed=None,keep_reps=False,fold_plan=None,dtype=float,cov_float64=True,profiler=None):
     
-    if verbose:
-        from progress.bar import ChargingBar
-        
     u_conds_test=np.unique(conditions)
     u_conds_train=np.unique(conditions_trn)
     
@@ -1081,9 +1142,17 @@ def dist_nominal(data,conditions,data_trn,conditions_trn,n_reps=10,balanced_trai
 
     y_test=y_test.astype(int)
     y_train=y_train.astype(int)
+
+    # balanced training trials
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only draw the balanced trials once
+        fold_plan=FoldPlan.cached(np.squeeze(y_train),None,n_reps,seed,n_classes=len(u_conds_train))
+    fold_plan.check(np.squeeze(y_train),kfold=False)
+    # fixed for all work units, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_reps=fold_plan.n_reps
     
-    X_ts=data
-    X_tr=data_trn    
+    X_ts=np.asarray(data,dtype=dtype)
+    X_tr=np.asarray(data_trn,dtype=dtype)
     if len(X_tr.shape)<3:
         X_tr=np.expand_dims(X_tr,axis=-1)
         
@@ -1093,77 +1162,32 @@ def dist_nominal(data,conditions,data_trn,conditions_trn,n_reps=10,balanced_trai
     ntrls_tst, nchans_tst, ntps_tst=np.shape(X_ts)
     ntrls_trn, nchans_trn, ntps_trn=np.shape(X_tr)
     
-    m=np.zeros((len(u_conds_train),nchans_trn,ntps_trn))   
     
     if verbose:
-        bar = ChargingBar('Processing', max=ntps_trn*n_reps)
+        bar = Progress(ntps_trn*n_reps,callback=verbose)
             
-    distances_temp=np.empty([len(u_conds_test),ntrls_tst,n_reps,ntps_tst])
-    distances_temp[:]=np.NaN                 
+    distances_temp=RunningMean((len(u_conds_test),ntrls_tst,ntps_tst),n_reps,keep_reps=keep_reps,dtype=dtype) # running mean over repetitions
 
-    X_train, X_test = X_tr, X_ts
-    # y_train=conditions_trn
-    # y_test=conditions            
-      
-    for irep in range(n_reps):
-        train_dat_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-        train_dat_cov[:]=np.NaN
+    shared=dict(X_tr=X_tr,X_ts=X_ts,nclasses=len(u_conds_train),balanced_train_bins=balanced_train_bins,balanced_cov=balanced_cov,
+                residual_cov=residual_cov,dist_metric=dist_metric,new_version=new_version,cov_float64=cov_float64,cross_temporal=False)
 
-        train_dat_res_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-        train_dat_res_cov[:]=np.NaN
-        
-        if balanced_train_bins:
-            count_min=min(np.bincount(y_train))
-            for c in range(len(u_conds_train)):
-                temp_dat=X_train[y_train==u_conds_train[c],:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m[c,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                if balanced_cov:
-                    if residual_cov:
-                        train_dat_res_cov = np.append(train_dat_res_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                    train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0) 
-        else:
-            for c in range(len(u_conds_train)):
-                m[c,:,:]=np.mean(X_train[y_train==u_conds_train[c],:,:],axis=0)         
-        
-        if not balanced_cov:
-            train_dat_cov=X_train                          
-            
-        for tp in range(ntps_trn):
-            m_train_tp=m[:,:,tp]
-            X_test_tp=X_test[:,:,tp]
-            
-            if dist_metric=='mahalanobis':
-                dat_cov_tp=train_dat_cov[:,:,tp]
-                dat_cov_res_tp=train_dat_res_cov[:,:,tp]
-                if new_version: # with a lot of dimensions, first performing pca and then using euclidian distance is faster (when using cdist)
-                    cov=covdiag(dat_cov_res_tp) # use covariance of the training data for pca
-                    train_dat_cov_avg = dat_cov_tp.mean(axis=0)
-                    X_test_rs_centered = X_test_rs - train_dat_cov_avg
-                    m_train_tp_centered = m_train_tp -train_dat_cov_avg
-                    evals,evecs = np.linalg.eigh(cov)
-                    idx = evals.argsort()[::-1]
-                    evals = evals[idx]
-                    evecs = evecs[:,idx]
-                    evals=evals.clip(1e-10) # avoid division by zero
-                    evals_sqrt = np.sqrt(evals)
-                    # compute euclidan distance in whitented pca space (which is identical to mahalanobis distance)
-                    distances_temp[:,:,irep,tp] = distance.cdist(np.dot(m_train_tp_centered,evecs)/evals_sqrt, np.dot(X_test_tp_centered,evecs)/evals_sqrt, 'euclidean')
-                else:                                 
-                    cov=inv(covdiag(dat_cov_tp))                                     
-                    distances_temp[:,:,irep,tp]=distance.cdist(m_train_tp,X_test_tp,'mahalanobis', VI=cov)
-            else:                    
-                distances_temp[:,:,irep,tp]=distance.cdist(m_train_tp,X_test_tp,'euclidean')
-            if verbose:
-                bar.next()
+    y_test=np.squeeze(y_test)
+    units=[(None,None,y_train,None,(irep,)) for irep,_,_,_ in fold_plan.splits()]
+
+    shared['index']=_balanced_train_index(shared,units,fold_plan) # balanced training trials of all units
 
-    distances=np.mean(distances_temp,axis=2,keepdims=False)
+    for (_,_,_,_,(irep,)),dists in zip(units,run_units(_dist_unit,units,shared,n_jobs=n_jobs)):
+        distances_temp.add(dists,irep,None)
+        if verbose:
+            bar.next(ntps_trn)
+
+    distances=distances_temp.mean()
     
     pred_cond=np.argmin(distances,axis=0)
     temp=np.transpose(np.tile(y_test,(pred_cond.shape[1],1)))
     dec_acc=pred_cond==temp
     
-    distance_difference=np.zeros([ntrls_tst,ntps_tst])
+    distance_difference=np.zeros([ntrls_tst,ntps_tst],dtype=distances.dtype)
     
     for cond in u_conds_test:
         temp1=distances[np.setdiff1d(u_conds_test,cond),:,:]
@@ -1172,13 +1196,12 @@ def dist_nominal(data,conditions,data_trn,conditions_trn,n_reps=10,balanced_trai
     
     if verbose:
         bar.finish()
+    if keep_reps:
+        return distance_difference,distances,dec_acc,pred_cond,distances_temp.reps
     return distance_difference,distances,dec_acc,pred_cond
 #%%  cross-temporal, with separate training and testing data, no cross-validation   
-def dist_nominal_ct(data,conditions,data_trn,conditions_trn,n_reps=10,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True):
-    
-    if verbose:
-        from progress.bar import ChargingBar
-
+@profiled
+def dist_nominal_ct(data,conditions,data_trn,conditions_trn,n_reps=10,balanced_train_bins=True,balanced_cov=False,residual_cov=False,dist_metric='mahalanobis',verbose=True,new_version=True,n_jobs=1,seed=None,keep_reps=False,fold_plan=None,out_path=None,dtype=float,cov_float64=True,profiler=None):
     
     u_conds_test=np.unique(conditions)
     u_conds_train=np.unique(conditions_trn)
@@ -1192,11 +1215,19 @@ def dist_nominal_ct(data,conditions,data_trn,conditions_trn,n_reps=10,balanced_t
         y_train[conditions_trn==u_conds_train[c]]=c
     y_test=y_test.astype(int)
     y_train=y_train.astype(int)
+
+    # balanced training trials
+    if fold_plan is None: # memoized, so repeated calls on the same trials (and seed) only draw the balanced trials once
+        fold_plan=FoldPlan.cached(np.squeeze(y_train),None,n_reps,seed,n_classes=len(u_conds_train))
+    fold_plan.check(np.squeeze(y_train),kfold=False)
+    # fixed for all work units, so results are reproducible for any n_jobs (unseeded: the seed of the plan, which isn't cached)
+    seed=fold_plan.seed if seed is None else resolve_seed(seed)
+    n_reps=fold_plan.n_reps
     
     u_conds=np.unique(y_train)
 
-    X_ts=data
-    X_tr=data_trn    
+    X_ts=np.asarray(data,dtype=dtype)
+    X_tr=np.asarray(data_trn,dtype=dtype)
     if len(X_tr.shape)<3:
         X_tr=np.expand_dims(X_tr,axis=-1)
         
@@ -1206,94 +1237,221 @@ def dist_nominal_ct(data,conditions,data_trn,conditions_trn,n_reps=10,balanced_t
     ntrls_tst, nchans_tst, ntps_tst=np.shape(X_ts)
     ntrls_trn, nchans_trn, ntps_trn=np.shape(X_tr)
     
-    m=np.zeros((len(u_conds),nchans_trn,ntps_trn))   
     
     if verbose:
-        bar = ChargingBar('Processing', max=ntps_trn*n_reps)
+        bar = Progress(ntps_trn*n_reps,callback=verbose)
         
-    distances_temp=np.empty([len(u_conds),ntrls_tst,n_reps,ntps_trn,ntps_tst])
-    distances_temp[:]=np.NaN  
-    
-    X_train, X_test = X_tr, X_ts
-    # y_train=conditions_trn
-    # y_test=conditions     
-       
+    # output, memory-mapped to out_path if given
+    distances=open_out(out_path,'distances',(len(u_conds),ntrls_tst,ntps_trn,ntps_tst),dtype=dtype)
+    distances_reps=open_out(out_path,'distances_reps',(len(u_conds),ntrls_tst,n_reps,ntps_trn,ntps_tst),dtype=dtype) if keep_reps else None
+
+    # running mean over repetitions, accumulated directly in the output
+    distances_temp=RunningMean(distances.shape,n_reps,keep_reps=keep_reps,dtype=dtype,out=distances,reps_out=distances_reps)
+
+    shared=dict(X_tr=X_tr,X_ts=X_ts,nclasses=len(u_conds),balanced_train_bins=balanced_train_bins,balanced_cov=balanced_cov,
+                residual_cov=residual_cov,dist_metric=dist_metric,new_version=new_version,cov_float64=cov_float64,cross_temporal=True)
+
+    # each work unit handles one block of training time points
+    blocks=time_blocks(ntps_trn,8*len(u_conds)*ntrls_tst*ntps_tst)
+
     y_test=np.squeeze(y_test)
-    for irep in range(n_reps):
-                
-        train_dat_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-        train_dat_cov[:]=np.NaN
+    units=[(None,None,y_train,None,(irep,),tps) for irep,_,_,_ in fold_plan.splits() for tps in blocks]
 
-        train_dat_res_cov = np.empty((0,X_train.shape[1],X_train.shape[2]))
-        train_dat_res_cov[:]=np.NaN
-        
-        if balanced_train_bins:
-            count_min=min(np.bincount(y_train))
-            for c in range(len(u_conds)):
-                temp_dat=X_train[y_train==u_conds[c],:,:]
-                ind=random.sample(list(range(temp_dat.shape[0])),count_min)
-                m[c,:,:]=np.mean(temp_dat[ind,:,:],axis=0)
-                if balanced_cov:
-                    if residual_cov:
-                        train_dat_res_cov = np.append(train_dat_res_cov, temp_dat[ind,:,:]-np.mean(temp_dat[ind,:,:],axis=0), axis=0)
-                    train_dat_cov = np.append(train_dat_cov, temp_dat[ind,:,:], axis=0)
-        else:
-            for c in range(len(u_conds)):
-                m[c,:,:]=np.mean(X_train[y_train==u_conds[c],:,:],axis=0)         
-        
-        if not balanced_cov:
-            train_dat_cov=X_train
+    shared['index']=_balanced_train_index(shared,units,fold_plan) # balanced training trials of all units
 
-        if np.isnan(train_dat_res_cov).all():
-            train_dat_res_cov=train_dat_cov   
-        
-        # reshape test data for efficient distance computation
-        X_test_rs=np.moveaxis(X_test,-1,1)
-        X_test_rs=np.reshape(X_test_rs,(ntrls_tst*ntps_tst,X_test.shape[1]),order='C')
+    for (_,_,_,_,(irep,),tps),dists in zip(units,run_units(_dist_unit,units,shared,n_jobs=n_jobs)):
+        distances_temp.add(dists,irep,None,tps)
+        if verbose:
+            bar.next(tps.stop-tps.start)
 
-        for tp in range(ntps_trn):
-            m_train_tp=m[:,:,tp]
-            
-            if dist_metric=='mahalanobis':
-                dat_cov_tp=train_dat_cov[:,:,tp]
-                dat_cov_res_tp=train_dat_res_cov[:,:,tp]
-                if new_version: # with a lot of dimensions, first performing pca and then using euclidian distance is faster (when using cdist)
-                    cov=covdiag(dat_cov_res_tp) # use covariance of the training data for pca
-                    train_dat_cov_avg = dat_cov_tp.mean(axis=0)
-                    X_test_rs_centered = X_test_rs - train_dat_cov_avg
-                    m_train_tp_centered = m_train_tp -train_dat_cov_avg
-                    evals,evecs = np.linalg.eigh(cov)
-                    idx = evals.argsort()[::-1]
-                    evals = evals[idx]
-                    evecs = evecs[:,idx]
-                    evals=evals.clip(1e-10) # avoid division by zero
-                    evals_sqrt = np.sqrt(evals)
-                        # compute euclidan distance in whitented pca space (which is identical to mahalanobis distance)
-                    dists = distance.cdist(np.dot(m_train_tp_centered,evecs)/evals_sqrt, np.dot(X_test_rs_centered,evecs)/evals_sqrt, 'euclidean')
-                else:
-                    cov=inv(covdiag(dat_cov_tp))
-                    dists=distance.cdist(m_train_tp,X_test_rs,'mahalanobis', VI=cov) # compute distances between all test trials, and average train trials
-            else:                    
-                dists=distance.cdist(m_train_tp,X_test_rs,'euclidean')
-            
-            distances_temp[:,:,irep,tp,:]=dists.reshape(len(u_conds),ntrls_tst,ntps_tst)
+    distances=distances_temp.mean(inplace=True)
 
-            if verbose:
-                bar.next()
+    with stage('postproc'):
+        distance_difference,dec_acc,pred_cond=_nominal_ct_postproc(distances,y_test,u_conds,out_path=out_path)
 
-    distances=np.mean(distances_temp,axis=2,keepdims=False)
-    
-    pred_cond=np.argmin(distances,axis=0)
-    temp=np.transpose(np.tile(y_test,(pred_cond.shape[2],pred_cond.shape[1],1)))
-    dec_acc=pred_cond==temp
-    
-    distance_difference=np.zeros([ntrls_tst,ntps_trn,ntps_tst])
-    
-    for cond in u_conds:
-        temp1=distances[np.setdiff1d(u_conds,cond),:,:,:]
-        temp2=temp1[:,y_test==cond,:,:]
-        distance_difference[y_test==cond,:,:]=np.mean(temp2,axis=0,keepdims=False)-distances[cond,y_test==cond,:,:]    
-    
     if verbose:
         bar.finish()
-    return distance_difference,distances,dec_acc,pred_cond
\ No newline at end of file
+    if keep_reps:
+        return distance_difference,distances,dec_acc,pred_cond,distances_reps
+    return distance_difference,distances,dec_acc,pred_cond
+#%% fitted decoders, for scoring new trials (e.g. online, one trial at a time) without any covariance estimation
+class _FittedDists:
+
+    '''
+    class means and whitening matrices of all time points, fitted once on the training trials,
+    so that the distances of new trials only take one matrix product per time point,
+    with more channels than training trials, the trial space (dual) form of _whiten_dual instead (time*n*trials, not time*n*n)
+    '''
+
+    def __init__(self,dist_metric='mahalanobis',dtype=float,cov_float64=True):
+
+        self.dist_metric=dist_metric
+        self.dtype=dtype
+        self.cov_float64=cov_float64
+
+    def _prep(self,X):
+
+        X=np.asarray(X,dtype=self.dtype)
+        if len(X.shape)<3:
+            X=np.expand_dims(X,axis=-1)
+
+        return X
+
+    def _fit(self,X,m):
+
+        '''
+        X (trials*n*time): training trials, used for the covariance (all trials)
+        m (classes*n*time): class means
+        '''
+
+        ntps,nchans=X.shape[2],X.shape[1]
+
+        self.W,self.dual,self.W_tp=None,None,{}
+        if self.dist_metric=='mahalanobis' and nchans>X.shape[0]:
+            dsq=np.empty((ntps,nchans),dtype=X.dtype)
+            R=np.empty((ntps,nchans,X.shape[0]),dtype=X.dtype)
+            self.mu=np.empty((ntps,nchans),dtype=X.dtype)
+            ok=np.empty(ntps,dtype=bool)
+            for tps in time_blocks(ntps,8*nchans*X.shape[0]):
+                dsq[tps],R[tps],self.mu[tps],ok[tps]=_whiten_dual(X[:,:,tps],X[:,:,tps],cov_float64=self.cov_float64)
+            self.dual=(dsq,R)
+            for tp in np.flatnonzero(~ok): # (almost) no shrinkage, whitening matrix as in _mahal_dists_dual
+                self.W_tp[tp]=_whiten_stack(X[:,:,tp:tp+1],X[:,:,tp:tp+1],cov_float64=self.cov_float64)[0][0]
+        elif self.dist_metric=='mahalanobis':
+            self.W=np.empty((ntps,nchans,nchans),dtype=X.dtype)
+            self.mu=np.empty((ntps,nchans),dtype=X.dtype)
+            for tps in _tp_blocks(ntps,nchans):
+                self.W[tps],self.mu[tps]=_whiten_stack(X[:,:,tps],X[:,:,tps],cov_float64=self.cov_float64)
+        else:
+            self.W,self.mu=None,np.zeros((ntps,nchans),dtype=X.dtype)
+
+        self.m_w=self._project(m) # class means in whitened space (centered only, in the dual form), time*classes*n
+
+        return self
+
+    def _project(self,X):
+
+        # trials*n*time to (whitened, unless dual) time*trials*n
+
+        X_w=np.ascontiguousarray(np.moveaxis(X,-1,0))-self.mu[:,None,:]
+        if self.W is not None:
+            X_w=np.matmul(X_w,self.W)
+
+        return X_w
+
+    def distances(self,X):
+
+        '''
+        X (trials*n*time): new trials (a single trial: X[None])
+        returns the distances (classes*trials*time) between the fitted class means and the trials
+        '''
+
+        X_w=self._project(self._prep(X))
+        if self.dual is None:
+            return np.sqrt(sq_dists(self.m_w,X_w)).transpose(1,2,0)
+
+        dsq,R=self.dual
+        with np.errstate(invalid='ignore'):
+            dists=_dual_dists(self.m_w,X_w,dsq[:,None,:],R)
+        for tp,W in self.W_tp.items():
+            dists[tp]=np.sqrt(sq_dists(np.matmul(self.m_w[tp],W),np.matmul(X_w[tp],W)))
+
+        return dists.transpose(1,2,0)
+
+class ThetaDecoder(_FittedDists):
+
+    '''
+    orientation decoder (see dist_theta) fitted once, class means of all training trials (no balancing or repetitions)
+
+    angspace, ang_steps, basis_set, dist_metric, dtype, cov_float64 as in dist_theta
+
+    fit(X,theta) computes the (basis-set smoothed) class means of each orientation space and the whitening of each time point,
+    transform(X,theta=None) returns dec_cos (trials*time, None without theta), the distances (ang_steps*bins*trials*time,
+    mean-centered across bins), and the decoded orientation (trials*time, angle of the distance-weighted bins)
+    '''
+
+    def __init__(self,angspace='default',ang_steps=4,basis_set=True,dist_metric='mahalanobis',dtype=float,cov_float64=True):
+
+        super().__init__(dist_metric=dist_metric,dtype=dtype,cov_float64=cov_float64)
+        self.angspace=angspace
+        self.ang_steps=ang_steps
+        self.basis_set=basis_set
+
+    def fit(self,X,theta):
+
+        X=self._prep(X)
+
+        angspace,ang_steps=self.angspace,self.ang_steps
+        if type(angspace)==str:
+            if angspace=='default':
+                angspace=np.arange(-np.pi,np.pi,np.pi/8)
+
+        if np.array_equal(angspace,np.unique(theta)):
+            ang_steps=1
+
+        bin_width=np.diff(angspace)[0]
+        self.angspaces=np.stack([angspace+ans*bin_width/ang_steps for ans in range(0,ang_steps)])
+        self.angspace_full=np.reshape(self.angspaces,(self.angspaces.shape[0]*self.angspaces.shape[1]),order='F')
+
+        # class means of each orientation space, smoothed with the (cached) basis set kernel
+        m=[]
+        for angspace_temp in self.angspaces:
+            y_subst=np.argmin(abs(circ_dist(angspace_temp,theta,all_pairs=True)),axis=1)
+            m_ans=class_means(X,y_subst,len(angspace))
+            m.append(basis_set_fun(m_ans,angspace_temp,basis_smooth='default') if self.basis_set else m_ans)
+
+        return self._fit(X,np.concatenate(m))
+
+    def transform(self,X,theta=None):
+
+        ang_steps,nbins=self.angspaces.shape
+
+        distances=self.distances(X)
+        distances=np.reshape(distances,(ang_steps,nbins)+distances.shape[1:])
+        distances-=np.mean(distances,axis=1,keepdims=True) # mean-center across bins of each orientation space
+
+        theta_pred=np.angle(np.einsum('ab,abn...->n...',np.exp(1j*self.angspaces),-distances))
+
+        dec_cos=None
+        if theta is not None:
+            cos_theta_dists=np.cos(self.angspaces[:,:,None]-np.reshape(theta,(1,1,-1))).astype(distances.dtype)
+            dec_cos=-np.einsum('abn,abn...->n...',cos_theta_dists,distances)/(ang_steps*nbins)
+
+        return dec_cos,distances,theta_pred
+
+class NominalDecoder(_FittedDists):
+
+    '''
+    decoder of nominal conditions (see dist_nominal) fitted once, class means of all training trials (no balancing or repetitions)
+
+    dist_metric, dtype, cov_float64 as in dist_nominal
+
+    fit(X,conditions) computes the class means and the whitening of each time point (classes: the sorted unique conditions),
+    transform(X,conditions=None) returns distance_difference (trials*time, None without conditions),
+    the distances (classes*trials*time), and the predicted class (index into classes, trials*time)
+    '''
+
+    def fit(self,X,conditions):
+
+        X=self._prep(X)
+
+        self.classes=np.unique(conditions)
+        y=np.searchsorted(self.classes,np.ravel(conditions))
+
+        return self._fit(X,class_means(X,y,len(self.classes)))
+
+    def transform(self,X,conditions=None):
+
+        distances=self.distances(X)
+        pred_cond=np.argmin(distances,axis=0)
+
+        distance_difference=None
+        if conditions is not None: # mean distance to the other classes minus the distance to the own class
+            unknown=~np.isin(np.ravel(conditions),self.classes)
+            if np.any(unknown):
+                raise ValueError('conditions not seen in fit: '+str(np.unique(np.ravel(conditions)[unknown])))
+            y=np.searchsorted(self.classes,np.ravel(conditions))
+            own=np.take_along_axis(distances,y[None,:,None],axis=0)[0]
+            distance_difference=(np.sum(distances,axis=0)-own)/(len(self.classes)-1)-own
+
+        return distance_difference,distances,pred_cond